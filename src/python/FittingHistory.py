@@ -0,0 +1,302 @@
+'''@cond
+   ooo        ooooo           oooooooooo.             ooooo      ooo
+   `88.       .888'           `888'   `Y8b            `888b.     `8'
+    888b     d'888   .ooooo.   888      888  .ooooo.   8 `88b.    8   .oooo.
+    8 Y88. .P  888  d88' `88b  888      888 d88' `88b  8   `88b.  8  `P  )88b
+    8  `888'   888  888   888  888      888 888ooo888  8     `88b.8   .oP"888
+    8    Y     888  888   888  888     d88' 888    .o  8       `888  d8(  888
+   o8o        o888o `Y8bod8P' o888bood8P'   `Y8bod8P' o8o        `8  `Y888""8o
+
+Copyright
+    2014-2016 MoDeNa Consortium, All rights reserved.
+
+License
+    This file is part of Modena.
+
+    The Modena interface library is free software; you can redistribute it
+    and/or modify it under the terms of the GNU Lesser General Public License
+    as published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    Modena is distributed in the hope that it will be useful, but WITHOUT ANY
+    WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+    FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+    details.
+
+    You should have received a copy of the GNU General Public License along
+    with Modena.  If not, see <http://www.gnu.org/licenses/>.
+@endcond'''
+
+"""
+@namespace python.FittingHistory
+@brief     Module recording the cost of the parameter fitting
+@details
+           Every run of the ParameterFitting task is profiled by a
+           FitProfiler and stored as a FittingRecord in the collection
+           'fitting_history'. Running the module reports the models and fits
+           that took longest:
+
+               python -m modena.FittingHistory --slowest 10 --expensive 10
+
+@copyright 2014-2016, MoDeNa Project. GNU Public License.
+"""
+
+import time
+import datetime
+import argparse
+import contextlib
+from mongoengine import *
+
+##
+# @addtogroup python_interface_library
+# @{
+
+class FittingRecord(DynamicDocument):
+    """
+    @brief    Cost of one run of the ParameterFitting task of a model
+    @details
+              The times are in seconds. evaluationTime is the time the
+              task itself spent in the surrogate model (libmodena or NumPy),
+              overheadTime is the remaining wall time of the task, i.e. the
+              optimizer, Python, R and waiting for worker processes.
+              workerEvaluationTime is the time spent in the surrogate model
+              summed over the worker processes of fitEach, which run in
+              parallel to the task. The evaluation counters include the
+              workers. fits holds one entry per optimizer run.
+    """
+    model = StringField(required=True)
+    strategy = StringField()
+    date = DateTimeField()
+    nSamples = IntField()
+    wallTime = FloatField()
+    evaluationTime = FloatField()
+    workerEvaluationTime = FloatField()
+    overheadTime = FloatField()
+    residualEvaluations = IntField()
+    jacobianEvaluations = IntField()
+    pointsEvaluated = IntField()
+    iterations = IntField()
+    ssq = FloatField()
+    fits = ListField(DictField())
+    meta = {
+        'collection': 'fitting_history',
+        'indexes': ['model', '-wallTime'],
+    }
+
+
+class FitProfiler(object):
+    """
+    @brief    Context manager profiling a run of the parameter fitting
+    @details
+              While the context is active the profiler is available as
+              FitProfiler.current, the surrogate model and the fitting
+              strategies report to it through the class methods evaluation
+              and fitted, which do nothing if no profiler is active. The
+              record is stored when the context is left.
+    """
+    # Profiler of the running fit, inherited by forked processes
+    current = None
+
+    def __init__(self, model, strategy=None):
+        self.model = model
+        self.strategy = type(strategy).__name__ if strategy else None
+        self.reset()
+
+
+    def reset(self):
+        """
+        @brief    Clear the counters, e.g. in a worker process
+        """
+        self.counters = {
+            'evaluationTime': 0.0,
+            'residualEvaluations': 0,
+            'jacobianEvaluations': 0,
+            'pointsEvaluated': 0,
+        }
+        self.workerEvaluationTime = 0.0
+        self.fits = []
+
+
+    def state(self):
+        """
+        @brief    Counters to be merged into the profiler of another process
+        """
+        return self.counters, self.fits
+
+
+    def merge(self, state):
+        """
+        @brief    Add the counters of a worker process, see state
+        @details
+                  The evaluation time of the worker is kept apart, since it
+                  overlaps with the wall time of this process.
+        """
+        counters, fits = state
+        for k, v in counters.iteritems():
+            if k == 'evaluationTime':
+                self.workerEvaluationTime += v
+            else:
+                self.counters[k] += v
+        self.fits.extend(fits)
+
+
+    def __enter__(self):
+        self.date = datetime.datetime.utcnow()
+        self.start = time.time()
+        FitProfiler.current = self
+        return self
+
+
+    def __exit__(self, *exc):
+        FitProfiler.current = None
+        try:
+            self.record(time.time() - self.start).save()
+        except Exception as e:
+            # The history must never break the fitting
+            print 'Could not store fitting history: %s' % e
+        return False
+
+
+    def record(self, wallTime):
+        """
+        @brief    Summarise the run
+        @returns  (FittingRecord) record of the run
+        """
+        return FittingRecord(
+            model=self.model._id,
+            strategy=self.strategy,
+            date=self.date,
+            nSamples=getattr(self.model, 'nSamples', 0),
+            wallTime=wallTime,
+            workerEvaluationTime=self.workerEvaluationTime,
+            overheadTime=wallTime - self.counters['evaluationTime'],
+            iterations=sum(f['iterations'] for f in self.fits),
+            ssq=self.fits[-1]['ssq'] if self.fits else None,
+            fits=self.fits,
+            **self.counters
+        )
+
+
+    @classmethod
+    @contextlib.contextmanager
+    def evaluation(cls, kind, nPoints):
+        """
+        @brief    Time an evaluation of the surrogate model
+        @param    kind (str) 'residualEvaluations' or 'jacobianEvaluations'
+        @param    nPoints (int) number of points evaluated
+        """
+        profiler = cls.current
+        if profiler is None:
+            yield
+            return
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            profiler.counters['evaluationTime'] += time.time() - start
+            profiler.counters[kind] += 1
+            profiler.counters['pointsEvaluated'] += nPoints
+
+
+    @classmethod
+    def fitted(cls, nSamples, wallTime, iterations, ssq):
+        """
+        @brief    Record a run of the optimizer
+        @param    nSamples (int) number of samples fitted
+        @param    wallTime (float) time of the run
+        @param    iterations (int) iterations of the optimizer
+        @param    ssq (float) final sum of squared residuals
+        """
+        if cls.current is not None:
+            cls.current.fits.append({
+                'nSamples': nSamples,
+                'wallTime': wallTime,
+                'iterations': iterations,
+                'ssq': ssq,
+            })
+
+
+def slowestModels(n=10):
+    """
+    @brief    Models with the largest total fitting time
+    @returns  (list) dicts with the totals of every model
+    """
+    return list(
+        FittingRecord._get_collection().aggregate([
+            {
+                '$group': {
+                    '_id': '$model',
+                    'fits': { '$sum': 1 },
+                    'wallTime': { '$sum': '$wallTime' },
+                    'evaluationTime': { '$sum': '$evaluationTime' },
+                    'workerEvaluationTime': {
+                        '$sum': '$workerEvaluationTime'
+                    },
+                    'residualEvaluations': { '$sum': '$residualEvaluations' },
+                }
+            },
+            { '$sort': { 'wallTime': -1 } },
+            { '$limit': n },
+        ])
+    )
+
+
+def mostExpensiveFits(n=10, model=None):
+    """
+    @brief    Runs of the parameter fitting that took longest
+    @param    model (str) restrict to one model
+    @returns  (QuerySet) FittingRecords
+    """
+    records = FittingRecord.objects(model=model) if model \
+        else FittingRecord.objects
+    return records.order_by('-wallTime').limit(n)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Report the cost of the parameter fitting of MoDeNa'
+    )
+    parser.add_argument(
+        '--slowest', type=int, default=10, metavar='N',
+        help='number of models with the largest total fitting time'
+    )
+    parser.add_argument(
+        '--expensive', type=int, default=10, metavar='N',
+        help='number of fits that took longest'
+    )
+    parser.add_argument('--model', help='only report fits of this model')
+    args = parser.parse_args(argv)
+
+    if not args.model:
+        print 'Slowest models:'
+        print '%-40s %6s %12s %12s %12s %12s' % (
+            'model', 'fits', 'wall [s]', 'eval [s]', 'worker [s]',
+            'residuals'
+        )
+        for m in slowestModels(args.slowest):
+            print '%-40s %6i %12.3f %12.3f %12.3f %12i' % (
+                m['_id'], m['fits'], m['wallTime'], m['evaluationTime'],
+                m['workerEvaluationTime'], m['residualEvaluations']
+            )
+        print
+
+    print 'Most expensive fits:'
+    print '%-40s %-24s %6s %10s %10s %10s %8s %6s %12s' % (
+        'model', 'strategy', 'n', 'wall [s]', 'eval [s]', 'worker [s]',
+        'resid', 'iter', 'ssq'
+    )
+    for r in mostExpensiveFits(args.expensive, args.model):
+        print '%-40s %-24s %6i %10.3f %10.3f %10.3f %8i %6i %12.4g' % (
+            r.model, r.strategy, r.nSamples or 0, r.wallTime,
+            r.evaluationTime, r.workerEvaluationTime or 0.0,
+            r.residualEvaluations, r.iterations,
+            r.ssq if r.ssq is not None else float('nan')
+        )
+
+
+if __name__ == '__main__':
+    main()
+
+##
+# @} # end of python_interface_library
@@ -42,7 +42,11 @@ import six
 import abc
 import sys
 import copy
+import time
+import multiprocessing
+import numpy
 import modena
+from modena.FittingHistory import FitProfiler
 from fireworks import Firework, Workflow, FWAction, FireTaskBase, ScriptTask
 from fireworks.utilities.fw_serializers import FWSerializable, \
     recursive_serialize, recursive_deserialize, serialize_fw
@@ -50,22 +54,142 @@ import fireworks.utilities.fw_serializers as fw_serializers
 from fireworks.utilities.fw_utilities import explicit_serialize
 from fireworks.utilities.fw_serializers import load_object
 from collections import defaultdict
-from rpy2.robjects.packages import importr
-import rpy2.robjects as robjects
-import rpy2.rinterface as rinterface
-from rpy2.robjects.vectors import FloatVector
-from numpy import array
+from numpy import array, clip
 from numpy.random import choice, seed
+from scipy.optimize import least_squares
 from blessings import Terminal
 
-# Import R libraries
-rinterface.initr()
-nlmrt = importr('nlmrt')
-lhs = importr('lhs')
+# R libraries, loaded on first use by importR
+nlmrt = None
+lhs = None
 
 # Create terminal for colour output
 term = Terminal()
 
+# Strategy and model of the fits running in parallel, inherited by the forked
+# processes of ParameterFittingStrategy.fitEach
+fitState = None
+
+
+def importR():
+    """
+    @brief    Start the embedded R interpreter and load the R libraries
+    @details
+              R is only needed by the 'nlmrt' optimizer and the LHS sampling,
+              so that it is started when one of them is used first.
+    """
+    global nlmrt, lhs
+
+    if nlmrt is None:
+        import rpy2.rinterface as rinterface
+        from rpy2.robjects.packages import importr
+
+        rinterface.initr()
+        nlmrt = importr('nlmrt')
+        lhs = importr('lhs')
+
+
+def leastSquaresScipy(residuals, parameters, lower, upper, jacobian=None):
+    """
+    @brief    Bounded non-linear least squares fit with SciPy
+    @details
+              Uses the trust region reflective method of least_squares.
+              Parameters whose lower and upper bounds are equal are fixed,
+              i.e. removed from the problem, since least_squares requires
+              lower < upper.
+    @param    residuals (function) residual vector of a parameter vector
+    @param    parameters (list) starting point, moved into the bounds
+    @param    lower (list) lower bounds of the parameters
+    @param    upper (list) upper bounds of the parameters
+    @param    jacobian (function|str) Jacobian of the residuals or finite
+              difference scheme ('2-point', default, or '3-point')
+    @returns  (tuple) fitted parameters and a dict with the number of
+              iterations and the final sum of squared residuals ('ssq')
+    """
+    lower = array(lower, dtype=float)
+    upper = array(upper, dtype=float)
+    x0 = clip(array(parameters, dtype=float), lower, upper)
+    free = lower < upper
+
+    if not free.any():
+        r = residuals(x0)
+        return x0.tolist(), {
+            'iterations': 0,
+            'ssq': float(numpy.dot(r, r)),
+        }
+
+    def full(x):
+        p = x0.copy()
+        p[free] = x
+        return p
+
+    def jac(x):
+        return jacobian(full(x))[:, free]
+
+    result = least_squares(
+        lambda x: residuals(full(x)),
+        x0[free],
+        jac=jac if callable(jacobian) else jacobian or '2-point',
+        bounds=(lower[free], upper[free]),
+        method='trf'
+    )
+
+    # trf evaluates the Jacobian once per iteration
+    return full(result.x).tolist(), {
+        'iterations': int(result.njev or result.nfev),
+        'ssq': 2*float(result.cost),
+    }
+
+
+def leastSquaresNlmrt(residuals, parameters, lower, upper, jacobian=None):
+    """
+    @brief    Bounded non-linear least squares fit with nlmrt::nlfb in R
+    @details
+              Kept to reproduce fits of earlier versions. Every evaluation of
+              the residuals is converted to R. Finite difference schemes are
+              replaced by the one of nlfb.
+    @param    see leastSquaresScipy
+    @returns  see leastSquaresScipy
+    """
+    importR()
+    import rpy2.robjects as robjects
+    import rpy2.rinterface as rinterface
+    from rpy2.robjects.vectors import FloatVector
+
+    def jacfn(parameters):
+        J = jacobian(list(parameters))
+        return robjects.r.matrix(
+            FloatVector(J.ravel(order='F')), nrow=J.shape[0]
+        )
+
+    def resfn(parameters):
+        return FloatVector(residuals(list(parameters)).tolist())
+
+
+    nlfb = nlmrt.nlfb(
+        start=FloatVector(parameters),
+        resfn=rinterface.rternalize(resfn),
+        jacfn=rinterface.rternalize(jacfn) if callable(jacobian) \
+            else rinterface.NULL,
+        trace=rinterface.FALSE,
+        lower=FloatVector(lower),
+        upper=FloatVector(upper),
+        maskidx=rinterface.NULL
+    )
+
+    # optimised coefficients
+    return list(nlfb[nlfb.names.index('coefficients')]), {
+        'iterations': int(nlfb[nlfb.names.index('jeval')][0]),
+        'ssq': float(nlfb[nlfb.names.index('ssquares')][0]),
+    }
+
+
+# Least squares optimizers of ParameterFittingStrategy, see 'optimizer'
+optimizers = {
+    'scipy': leastSquaresScipy,
+    'nlmrt': leastSquaresNlmrt,
+}
+
 ##
 # @addtogroup python_interface_library
 # @{
@@ -218,6 +342,41 @@ class ImproveErrorStrategy(StrategyBaseClass):
         return wf
 
 
+def initFitWorker():
+    """
+    @brief    Prepare a worker process of ParameterFittingStrategy.fitEach
+    @details
+              pymongo does not support using a client across fork. The
+              workers therefore do not write to the database, points outside
+              the bounds of substitute models are returned to the parent.
+    """
+    modena.SurrogateModel.deferOutsidePoints()
+
+
+def fitAndValidate(job):
+    """
+    @brief    Run one fit of ParameterFittingStrategy.fitEach in a worker
+    @param    job (tuple) test indices and starting parameters
+    @returns  (tuple) result, profiler state and outside points
+    """
+    strategy, model, cModel = fitState
+    testIndices, parameters = job
+
+    # The profiler is a copy, its counters are returned to the parent
+    profiler = FitProfiler.current
+    if profiler is not None:
+        profiler.reset()
+
+    result = strategy.fitAndValidate(
+        model, testIndices, parameters, cModel.clone(parameters)
+    )
+    return (
+        result,
+        profiler.state() if profiler is not None else None,
+        modena.SurrogateModel.takeDeferredOutsidePoints()
+    )
+
+
 class ParameterFittingStrategy(StrategyBaseClass):
     """
     @brief   Base Class for creating parameter fitting strategies.
@@ -238,65 +397,429 @@ class ParameterFittingStrategy(StrategyBaseClass):
         )
 
 
-    def errorTest(model, parameters, testIndices):
+    def initialParameters(self, model):
         """
-        @param model MoDeNa surrogate model
-        @param parameters list
-        @param testIndicies
+        @brief    Parameters the fitting starts from
+        @returns  (list) parameters of the model or the centre of their range
         """
-        def fitData(testIndices):
-            for i in testPoint:
-                yield i
+        parameters = list(model.parameters)
+        if not len(parameters):
+            parameters = [None] * len(model.surrogateFunction.parameters)
+            for k, v in model.surrogateFunction.parameters.iteritems():
+                parameters[v.argPos] = (v.min + v.max)/2
+
+        return parameters
+
 
-        # Instantiate the surrogate model
-        cModel = modena.libmodena.modena_model_t(
-             model,
-             parameters=list(parameters)
+    def parameterBounds(self, model):
+        """
+        @brief    Bounds of the parameters of the surrogate function
+        @returns  (tuple) lists of the lower and upper bounds
+        """
+        n = len(model.surrogateFunction.parameters)
+        min_parameters = [None]*n
+        max_parameters = [None]*n
+        for k, v in model.surrogateFunction.parameters.iteritems():
+            min_parameters[v.argPos] = v.min
+            max_parameters[v.argPos] = v.max
+
+        return min_parameters, max_parameters
+
+
+    def outputFactors(self, model):
+        """
+        @brief    Factors the residuals of every output are multiplied with
+        @details
+                  The residual of an output is divided by its scale and
+                  multiplied by its weight, so that outputs of different
+                  magnitude are fitted together. The option 'outputScaling'
+                  is a dict of scales or 'range' to use the range of the
+                  samples of every output, 'outputWeights' is a dict of
+                  weights. Missing outputs default to 1.
+        @returns  (numpy.ndarray) factors ordered as the keys of
+                  model.outputs, or None if all factors are 1
+        """
+        scaling = self.get('outputScaling', None)
+        weights = self.get('outputWeights', None)
+        if not scaling and not weights:
+            return None
+
+        if scaling == 'range':
+            inputs, outputs = model.fitDataMatrix()
+            scaling = dict(
+                (k, outputs[:, j].max() - outputs[:, j].min() or 1.0)
+                for j, k in enumerate(model.outputs.keys())
+            )
+
+        scaling = scaling or {}
+        weights = weights or {}
+        return numpy.array(
+            [
+                float(weights.get(k, 1.0))/scaling.get(k, 1.0)
+                for k in model.outputs.keys()
+            ]
         )
 
-        return max(
-            abs(i) for i in model.error(
+
+    def residualTransform(self, model):
+        """
+        @brief    Transform of the residuals of every output
+        @details
+                  The option 'residualTransform' is one of 'absolute'
+                  (default), 'relative' or 'log', or a dict with the
+                  transform of every output. The transforms apply to the
+                  fit and to the error compared to 'maxError'.
+        @returns  (list) transforms ordered as the keys of model.outputs
+        """
+        transform = self.get('residualTransform', 'absolute')
+        if isinstance(transform, dict):
+            return [
+                transform.get(k, 'absolute') for k in model.outputs.keys()
+            ]
+        return [transform]*len(model.outputs)
+
+
+    def fit(self, model, testIndices, parameters=None, cModel=None):
+        """
+        @brief    Fit the parameters to all samples except testIndices
+        @details
+                  The least squares problem is solved by the optimizer
+                  'optimizer' (default 'scipy', see optimizers). The analytic
+                  Jacobian of the surrogate function is used if available,
+                  the option 'jacobian' selects a finite difference scheme
+                  instead.
+        @param    model MoDeNa surrogate model
+        @param    testIndices (list) indices of the samples left out
+        @param    parameters (list) starting point, see initialParameters
+        @param    cModel (modena_model_t) evaluator whose parameters are
+                  changed during the fit, default a new one
+        @returns  (list) fitted parameters
+        """
+        testIndices = set(testIndices)
+        trainIndices = [
+            i for i in xrange(model.nSamples) if i not in testIndices
+        ]
+
+        if parameters is None:
+            parameters = self.initialParameters(model)
+        min_parameters, max_parameters = self.parameterBounds(model)
+
+        # Instantiate the surrogate model once, only the parameters change
+        if cModel is None:
+            cModel = model.evaluator(parameters)
+
+        # All outputs are fitted at once from the stacked residuals
+        outputFactors = self.outputFactors(model)
+        transform = self.residualTransform(model)
+
+        # ------------------------------ Function --------------------------- #
+        def errorFit(parameters):
+
+            cModel.parameters = parameters
+
+            return model.errorVector(
                 cModel,
-                idxGenerator=fitData(testPoint),
-                checkBounds=False
+                idxGenerator=trainIndices,
+                checkBounds=False,
+                transform=transform,
+                outputFactors=outputFactors
             )
+        # ------------------------------------------------------------------- #
+
+        # ------------------------------ Function --------------------------- #
+        def jacobianFit(parameters):
+
+            cModel.parameters = parameters
+
+            return model.errorJacobian(
+                cModel,
+                idxGenerator=trainIndices,
+                checkBounds=False,
+                transform=transform,
+                outputFactors=outputFactors
+            )
+        # ------------------------------------------------------------------- #
+
+        jacobian = self.get('jacobian', None)
+        if jacobian is None and model.hasJacobian():
+            jacobian = jacobianFit
+
+        # perform fitting (nonlinear MSSQ)
+        start = time.time()
+        parameters, info = optimizers[self.get('optimizer', 'scipy')](
+            errorFit,
+            parameters,
+            min_parameters,
+            max_parameters,
+            jacobian=jacobian
+        )
+        FitProfiler.fitted(
+            len(trainIndices), time.time() - start, **info
+        )
+
+        return parameters
+
+
+    def residuals(self, model, parameters, indices, cModel=None):
+        """
+        @brief    Residuals of the samples indices
+        @details
+                  The residuals of all outputs are stacked sample by sample
+                  and multiplied by their outputFactors.
+        @param    cModel (modena_model_t) evaluator to use, default a new one
+        @returns  (numpy.ndarray) residuals
+        """
+        if cModel is None:
+            # Instantiate the surrogate model
+            cModel = model.evaluator(parameters)
+        else:
+            cModel.parameters = parameters
+
+        return model.errorVector(
+            cModel,
+            idxGenerator=indices,
+            checkBounds=False,
+            transform=self.residualTransform(model),
+            outputFactors=self.outputFactors(model)
         )
 
 
-    # errorFit function can only take a single arguemnt (parameters) when it
-    # is called from R. Using wrapper class instead!
-    class errorFit:
+    def residualsJacobian(self, model, parameters, indices, cModel=None):
         """
+        @brief    Residuals of the samples indices and their Jacobian
+        @details
+                  The analytic Jacobian with respect to the parameters is used
+                  if available. Otherwise it is computed by forward
+                  differences, every column is one evaluation of all samples.
+                  Steps point into the parameter bounds.
+        @param    cModel (modena_model_t) evaluator to use, default a new one
+        @returns  (tuple) residuals and Jacobian as numpy.ndarray
         """
-        def __init__(self, *args, **kwargs):
-            self.model = args[0]
-            self.testPoint = args[1]
+        if cModel is None:
+            # Instantiate the surrogate model
+            cModel = model.evaluator(parameters)
+        else:
+            cModel.parameters = parameters
+
+        if model.hasJacobian() and self.get('jacobian', None) is None:
+            outputFactors = self.outputFactors(model)
+            transform = self.residualTransform(model)
+            return (
+                model.errorVector(
+                    cModel,
+                    idxGenerator=indices,
+                    checkBounds=False,
+                    transform=transform,
+                    outputFactors=outputFactors
+                ),
+                model.errorJacobian(
+                    cModel,
+                    idxGenerator=indices,
+                    checkBounds=False,
+                    transform=transform,
+                    outputFactors=outputFactors
+                )
+            )
 
-        def function(parameters):
+        parameters = numpy.array(parameters, dtype=float)
+        min_parameters, max_parameters = self.parameterBounds(model)
 
-            def fitData(n, testPoint):
-                for i in xrange(n):
-                    if i not in testPoint:
-                         yield i
+        r = self.residuals(model, parameters, indices, cModel)
+        J = numpy.empty((len(r), len(parameters)))
+        for k in xrange(len(parameters)):
+            h = numpy.sqrt(numpy.finfo(float).eps)*max(1.0, abs(parameters[k]))
+            if parameters[k] + h > max_parameters[k]:
+                h = -h
+            p = parameters.copy()
+            p[k] += h
+            J[:, k] = (self.residuals(model, p, indices, cModel) - r)/h
 
+        return r, J
+
+
+    def validate(self, model, parameters, testIndices, cModel=None):
+        """
+        @brief    Maximum absolute error of the samples testIndices
+        @details
+                  The error is measured after residualTransform, e.g. it is
+                  relative for 'relative'. Sample weights are not applied.
+                  If the option 'maxError' is a dict, the error of every
+                  output is divided by its maximum error (outputs missing in
+                  the dict are not checked). The result is then compared to
+                  1, see maxErrorExceeded.
+        @param    cModel (modena_model_t) evaluator to use, default a new one
+        """
+        if cModel is None:
             # Instantiate the surrogate model
-            cModel = modena.libmodena.modena_model_t(
-                model=model,
-                parameters=list(parameters)
+            cModel = model.evaluator(parameters)
+        else:
+            cModel.parameters = parameters
+
+        error = abs(
+            model.errorMatrix(
+                cModel,
+                idxGenerator=testIndices,
+                checkBounds=False,
+                transform=self.residualTransform(model)
             )
+        )
+        if not error.size:
+            return 0.0
 
-            return FloatVector(
-                list(
-                    model.error(
-                        cModel,
-                        idxGenerator=fitData(model.nSamples, self.testPoint),
-                        checkBounds=False
-                    )
-                )
+        maxError = self.get('maxError', None)
+        if isinstance(maxError, dict):
+            error = error/numpy.array(
+                [maxError.get(k, numpy.inf) for k in model.outputs.keys()]
+            )
+
+        return error.max()
+
+
+    def maxErrorExceeded(self, error):
+        """
+        @brief    Check an error returned by validate against 'maxError'
+        @returns  (bool) True if the parameters are not valid
+        """
+        if isinstance(self['maxError'], dict):
+            return error > 1.0
+        return error > self['maxError']
+
+
+    def fitAndValidate(self, model, testIndices, parameters, cModel=None):
+        """
+        @brief    Fit leaving out testIndices and validate on them
+        @param    cModel (modena_model_t) evaluator to use, default a new one
+        @returns  (tuple) fitted parameters and their error
+        """
+        if cModel is None:
+            cModel = model.evaluator(parameters)
+
+        parameters = self.fit(model, testIndices, parameters, cModel)
+        return (
+            parameters,
+            self.validate(model, parameters, testIndices, cModel)
+        )
+
+
+    def commitParameters(self, model, parameters, testIndices=[]):
+        """
+        @brief    Store the fitted parameters in the database
+        @details
+                  The parameters are only stored if no other task changed
+                  them since the model was loaded, see
+                  SurrogateModel.commitParameters. Otherwise the model is
+                  reloaded (including the samples added by other tasks) and
+                  the parameters are fitted again, starting from those of the
+                  other task. This is repeated up to 'commitRetries' (default
+                  5) times. The parameters fitted again are validated on
+                  testIndices, or on all samples if there are none, and
+                  ConcurrentUpdate is raised if they exceed 'maxError'.
+        @param    model MoDeNa surrogate model
+        @param    parameters (list) fitted parameters
+        @param    testIndices (list) samples left out of the fit, see fit
+        @returns  (list) parameters stored
+        """
+        for i in xrange(self.get('commitRetries', 5)):
+            if model.commitParameters(parameters):
+                return parameters
+
+            print(
+                'Model %s was changed by another task, ' % model._id
+              + 'fitting parameters again.'
+            )
+            model = modena.SurrogateModel.load(model._id)
+            parameters = self.fit(
+                model, testIndices, list(model.parameters) or None
             )
 
+            if self.get('maxError', None) is not None:
+                maxError = self.validate(
+                    model,
+                    parameters,
+                    testIndices or xrange(model.nSamples)
+                )
+                if self.maxErrorExceeded(maxError):
+                    raise ConcurrentUpdate(
+                        'Parameters of model %s fitted again ' % model._id
+                      + 'after a concurrent update are not valid'
+                    )
+
+        raise ConcurrentUpdate(
+            'Could not store the parameters of model %s' % model._id
+        )
+
+
+    def fitEach(self, model, testSets, parameters=None, stop=None):
+        """
+        @brief    Fit the model once for every set of test samples
+        @details
+                  Every fit uses all samples but the test set and is
+                  validated on the test set. The fits are independent and run
+                  in waves of 'nProcesses' forked processes (default 0, i.e.
+                  all cores; 1 runs the fits in this process). Points outside
+                  the bounds of substitute models found by the workers are
+                  stored by this process. Every wave starts from the
+                  parameters with the smallest error found so far. The
+                  surrogate model is instantiated once, every fit uses a
+                  clone of it.
+        @param    model MoDeNa surrogate model
+        @param    testSets (list) lists of indices of the test samples
+        @param    parameters (list) starting point, see initialParameters
+        @param    stop (callable) called with the results after every wave,
+                  the remaining test sets are skipped if it returns True
+        @returns  (list) tuples of parameters and error, one per test set
+                  fitted
+        """
+        global fitState
 
+        if parameters is None:
+            parameters = self.initialParameters(model)
 
+        nProcesses = self.get('nProcesses', 0) or multiprocessing.cpu_count()
+        nProcesses = max(1, min(nProcesses, len(testSets)))
+
+        cModel = model.evaluator(parameters)
+
+        pool = None
+        if nProcesses > 1:
+            # Load everything the fits need before forking
+            model.fitDataMatrix()
+            fitState = (self, model, cModel)
+            pool = multiprocessing.Pool(nProcesses, initFitWorker)
+
+        results = []
+        best = (parameters, None)
+        try:
+            for i in xrange(0, len(testSets), nProcesses):
+                jobs = [(t, best[0]) for t in testSets[i:i + nProcesses]]
+                if pool:
+                    wave = []
+                    for r, state, outside in pool.map(fitAndValidate, jobs):
+                        if state is not None:
+                            FitProfiler.current.merge(state)
+                        for args in outside:
+                            modena.SurrogateModel.storeOutsidePoints(*args)
+                        wave.append(r)
+                else:
+                    wave = [
+                        self.fitAndValidate(model, t, p, cModel.clone(p))
+                        for t, p in jobs
+                    ]
+
+                for r in wave:
+                    if best[1] is None or r[1] < best[1]:
+                        best = r
+                results.extend(wave)
+
+                if stop is not None and stop(results):
+                    break
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+                fitState = None
+
+        return results
 
 
 class SamplingStrategy(StrategyBaseClass):
@@ -320,14 +843,8 @@ class SamplingStrategy(StrategyBaseClass):
                   {'key1': [ * , ^ , < ] , 'key2': [ * , ^ , < ] , ... }
         """
 
-        sampleRange = {
-            k: {
-                'min': min(model.fitData[k]),
-                'max': max(model.fitData[k])
-            } for k in model.inputs.keys()
-        }
-
-        points = array(lhs.randomLHS(nPoints, len(sampleRange))).tolist()
+        importR()
+        points = array(lhs.randomLHS(nPoints, len(sr))).tolist()
 
         return {
             key: [
@@ -414,8 +931,8 @@ class InitialData(InitialisationStrategy):
         # Get initial data
         points = self.newPoints(model)
 
-        # Save initial data in database
-        model.updateFitDataFromFwSpec(points)
+        # Save initial data in database, all samples in one batch
+        model.appendSamples(points)
         model.updateMinMax()
         model.save()
 
@@ -445,17 +962,66 @@ class ExtendSpaceStochasticSampling(OutOfBoundsStrategy, SamplingStrategy):
     """
     @brief    Class for extending the design space using stochastic sampling.
     @details
-              Strategy used to extend the domain of a surrogate model.
+              Strategy used to extend the domain of a surrogate model. At
+              most 'nNewPoints' points are added, also if more points were
+              found outside the bounds, see selectOutsidePoints.
     """
     def __init__(self, *args, **kwargs):
         OutOfBoundsStrategy.__init__(self, *args, **kwargs)
 
 
+    def selectOutsidePoints(self, model, outsidePoints):
+        """
+        @brief    Select at most 'nNewPoints' of the outside points
+        @details
+                  Every selected point adds a limit point, i.e. one detailed
+                  simulation. The points with the smallest and largest value
+                  of every input come first, since they span the bounding box
+                  of all outside points. The remaining points are taken at
+                  regular intervals.
+        @returns  (list) selected outside points
+        """
+        n = self['nNewPoints']
+        if len(outsidePoints) <= n:
+            return outsidePoints
+
+        selected = []
+        for k in model.inputs.keys():
+            for f in (min, max):
+                i = f(
+                    xrange(len(outsidePoints)),
+                    key=lambda i: outsidePoints[i][k]
+                )
+                if i not in selected:
+                    selected.append(i)
+
+        rest = [c for c in xrange(len(outsidePoints)) if c not in selected]
+        m = max(n - len(selected), 0)
+        selected.extend(rest[j*len(rest)/m] for j in xrange(m))
+
+        return [outsidePoints[s] for s in selected[:n]]
+
+
     def newPoints(self, model, **kwargs):
-        # Get a sampling range around the outside point and create points
-        sampleRange, limitPoint = model.extendedRange(kwargs['outsidePoint'])
-        sp = self.samplePoints(model, sampleRange, self['nNewPoints']-1)
-        return  { k: v + [limitPoint[k]] for k, v in sp.iteritems() }
+        # Get a sampling range around every outside point and create points.
+        # The new points are shared among the outside points, each of which
+        # contributes its limit point.
+        outsidePoints = self.selectOutsidePoints(
+            model, kwargs.get('outsidePoints') or [kwargs['outsidePoint']]
+        )
+        nOutside = len(outsidePoints)
+        nPoints = max(self['nNewPoints'] - nOutside, 0)
+
+        newPoints = defaultdict(list)
+        for i, outsidePoint in enumerate(outsidePoints):
+            sampleRange, limitPoint = model.extendedRange(outsidePoint)
+            n = nPoints/nOutside + (i < nPoints % nOutside)
+            sp = self.samplePoints(model, sampleRange, n) if n else {}
+            for k in limitPoint:
+                newPoints[k].extend(sp.get(k, []))
+                newPoints[k].append(limitPoint[k])
+
+        return dict(newPoints)
 
 
 @explicit_serialize
@@ -473,12 +1039,13 @@ class StochasticSampling(ImproveErrorStrategy, SamplingStrategy):
         """
         @brief    Add samples to the current range if needed by ParFit.
         """
-        # Get a sampling range from fitData. Note: Cannot use MinMax must not
-        # be updated, yet
+        # Get a sampling range from the samples. Note: Cannot use MinMax must
+        # not be updated, yet
+        currentRange = model.currentSampleRange()
         sampleRange = {
             k: {
-                'min': min(model.fitData[k]),
-                'max': max(model.fitData[k])
+                'min': currentRange[k].min,
+                'max': currentRange[k].max
             } for k in model.inputs.keys()
         }
 
@@ -492,138 +1059,202 @@ class StochasticSampling(ImproveErrorStrategy, SamplingStrategy):
 
 # leastsq(func, x0, args=(), Dfun=None, full_output=0, col_deriv=0, ftol=1.49012e-08, xtol=1.49012e-08, gtol=0.0, maxfev=0, epsfcn=None, factor=100, diag=None)
 
-@explicit_serialize
-class LeaveOneOut(ParameterFittingStrategy):
+class CrossValidation(ParameterFittingStrategy):
+    """
+    @brief    Base class of cross-validation strategies
+    @details
+              Derived classes split the samples into folds, see testSets.
+              For every fold the parameters are fitted to the other samples
+              and validated on the fold. The folds run in parallel, see
+              'nProcesses' in fitEach. The model is valid if the mean error
+              of the folds plus 'confidence' (default 2) standard errors is
+              below 'maxError'. The remaining folds are skipped as soon as
+              the mean error is further than that from 'maxError', but not
+              before 'minFolds' (default 3) folds are done.
+
+              If the model is valid the parameters are fitted to all
+              samples, starting from the best fold. Otherwise the
+              'improveErrorStrategy' is executed.
+
+              Options: maxError, improveErrorStrategy, confidence, minFolds,
+              nProcesses
+    """
 
     def __init__(self, *args, **kwargs):
+        ParameterFittingStrategy.__init__(self, *args, **kwargs)
+
+
+    @abc.abstractmethod
+    def testSets(self, nSamples):
         """
+        @brief    Split the samples into folds
+        @returns  (list) lists of indices of the test samples of every fold
         """
-        ParameterFittingStrategy.__init__(self, *args, **kwargs)
+        raise NotImplementedError('testSets not implemented!')
 
 
-    def split(self, nSamples):
+    def errorBound(self, errors):
         """
+        @brief    Confidence interval of the mean error of the folds
+        @returns  (tuple) lower and upper bound of the mean error
         """
-        vs = range(nSamples) # validation samples
-        ts = ( tuple(vs[0:i] + vs[i+1:]) for (i, si) in enumerate(vs) )
-        return vs
+        errors = numpy.asarray(errors, dtype=float)
+        mean = errors.mean()
+        if len(errors) < 2:
+            return mean, mean
 
+        se = errors.std(ddof=1)/numpy.sqrt(len(errors))
+        z = self.get('confidence', 2.0)
+        return mean - z*se, mean + z*se
 
-    def validation(sel):
-        pass
 
+    def decided(self, results):
+        """
+        @brief    Stopping rule of the folds, see fitEach
+        @returns  (bool) True if the remaining folds cannot change the result
+        """
+        if len(results) < self.get('minFolds', 3):
+            return False
 
-    def fit(self, model, valIndices):
-        pass
+        lower, upper = self.errorBound([e for p, e in results])
+        return self.maxErrorExceeded(lower) \
+            or not self.maxErrorExceeded(upper)
 
 
     def newPointsFWAction(self, model, **kwargs):
-        """
-        * Get training and validation sets
-        * Regression
-        * Validation
-        * if valid, return empty workflow, else perform DoE.
-        """
+        # Make sure the folds are chosen in a deterministic manner
+        seed(model.nSamples)
 
-        #loo = LeaveOneOut()
-        points = [ [ 0.0 for j in xrange(model.nSamples) ] for i in \
-                                 xrange(model.surrogateFunction.inputs_size())]
-        for (k, v) in model.inputs.iteritems():
-            points[model.inputs_argPos(k)] = inputs[k]
+        results = self.fitEach(
+            model, self.testSets(model.nSamples), stop=self.decided
+        )
+        best_parameters, bestError = min(results, key=lambda r: r[1])
+        lower, upper = self.errorBound([e for p, e in results])
 
-        # Transpose
-        points = zip(*points)
-        testIndicies = self.split()
+        print(
+            'Cross-validation error = %g +- %g (%i folds)' % (
+                (upper + lower)/2, (upper - lower)/2, len(results)
+            )
+        )
+        if self.maxErrorExceeded(upper):
+            print(
+                'Parameters ' + term.red + 'not' + term.normal
+              + ' valid, adding samples.'
+            )
+            print(
+                'current parameters = [%s]' % ', '.join(
+                    '%g' % k for k in best_parameters
+                )
+            )
 
+            return FWAction(
+                detours=self['improveErrorStrategy'].workflow(model)
+            )
 
-@explicit_serialize
-class Test(ParameterFittingStrategy):
+        else:
+            new_parameters = self.fit(model, [], best_parameters)
 
+            print(
+                'old parameters = [%s]' % ', '.join(
+                    '%g' % k for k in model.parameters
+                )
+            )
+            print(
+                'new parameters = [%s]' % ', '.join(
+                    '%g' % k for k in new_parameters
+                )
+            )
 
-    def __init__(self, *args, **kwargs):
-        """
-        """
-        ParameterFittingStrategy.__init__(self, *args, **kwargs)
+            # Update database
+            self.commitParameters(model, new_parameters)
 
+            # return nothing to restart normal operation
+            return FWAction()
 
-    def validationSets(self, n, testIndices):
-        for i in xrange(n):
-            if i not in testIndices:
-                 yield i
 
+@explicit_serialize
+class KFold(CrossValidation):
+    """
+    @brief    k-fold cross-validation
+    @details
+              The samples are shuffled and split into 'nFolds' (default 5)
+              folds of equal size. See CrossValidation.
+    """
 
+    def __init__(self, *args, **kwargs):
+        CrossValidation.__init__(self, *args, **kwargs)
 
-    def split(self, nSamples):
-        """
-        s = [ ( ( training_set ), validation_point ), ... ]
-        """
-        s = range(nSamples) # validation samples
-        training_samples = ( tuple(s[0:i]+s[i+1:]) for (i, si) in enumerate(s) )
-        return ( training_samples, s )
 
+    def testSets(self, nSamples):
+        nFolds = max(2, min(self.get('nFolds', 5), nSamples))
+        shuffled = choice(nSamples, size=nSamples, replace=False)
+        return [
+            sorted(fold) for fold in numpy.array_split(shuffled, nFolds)
+        ]
 
-    def fit(self, model, testIndices):
-        """
-        """
-        # ------------------------------ Function --------------------------- #
-        def errorFit(parameters):
 
-            def fitData(n, testIndices):
-                for i in xrange(n):
-                    if i not in testIndices:
-                         yield i
+@explicit_serialize
+class MonteCarloCrossValidation(CrossValidation):
+    """
+    @brief    Repeated random subsampling cross-validation
+    @details
+              Every one of the 'nRepeats' (default 10) folds leaves out a
+              random 'testDataPercentage' (default 0.2) of the samples. See
+              CrossValidation.
+    """
 
-            # Instantiate the surrogate model
-            cModel = modena.libmodena.modena_model_t(model=model,parameters=list(parameters))
+    def __init__(self, *args, **kwargs):
+        CrossValidation.__init__(self, *args, **kwargs)
 
-            return FloatVector(list(model.error(cModel,idxGenerator=fitData(model.nSamples, testIndices),checkBounds=False)))
-        # ------------------------------------------------------------------- #
 
-        new_parameters = model.parameters
-        if not len(new_parameters):
-            new_parameters = [None] * len(model.surrogateFunction.parameters)
-            for k, v in model.surrogateFunction.parameters.iteritems():
-                new_parameters[v.argPos] = (v.min + v.max)/2
+    def testSets(self, nSamples):
+        size = max(1, int(self.get('testDataPercentage', 0.2)*nSamples))
+        return [
+            sorted(choice(nSamples, size=size, replace=False))
+            for i in xrange(self.get('nRepeats', 10))
+        ]
 
-        # make objects usable in R
-        R_par = FloatVector(new_parameters)
-        R_res = rinterface.rternalize(errorFit)
 
-        max_parameters = [None]*len(new_parameters)
-        min_parameters = [None]*len(new_parameters)
-        for k, v in model.surrogateFunction.parameters.iteritems():
-            min_parameters[v.argPos] = v.min
-            max_parameters[v.argPos] = v.max
+@explicit_serialize
+class LeaveOneOut(CrossValidation):
+    """
+    @brief    Leave-one-out cross-validation
+    @details
+              Every sample is a fold of its own. See CrossValidation.
+    """
 
-        # perform fitting (nonlinear MSSQ)
-        nlfb = nlmrt.nlfb(start=R_par,resfn=R_res,jacfn=rinterface.NULL,trace=rinterface.FALSE,lower=FloatVector(min_parameters),upper=FloatVector(max_parameters),maskidx=rinterface.NULL)
+    def __init__(self, *args, **kwargs):
+        CrossValidation.__init__(self, *args, **kwargs)
 
-        # optimised coefficients and sum of squares
-        nlfb_coeffs = nlfb[nlfb.names.index('coefficients')]
-        nlfb_ssqres = nlfb[nlfb.names.index('ssquares')]
-        new_parameters = list(nlfb_coeffs)
 
-        return new_parameters
+    def testSets(self, nSamples):
+        return [ [i] for i in xrange(nSamples) ]
 
 
-    def validate(self, model, parameters, testIndices):
+@explicit_serialize
+class Test(ParameterFittingStrategy):
+
+
+    def __init__(self, *args, **kwargs):
         """
         """
+        ParameterFittingStrategy.__init__(self, *args, **kwargs)
 
-        # ------------------------------ Function --------------------------- #
-        def errorTest(parameters):
 
-            def fitData(testIndices):
-                for i in testIndices:
-                     yield i
+    def validationSets(self, n, testIndices):
+        for i in xrange(n):
+            if i not in testIndices:
+                 yield i
 
-            # Instantiate the surrogate model
-            cModel = modena.libmodena.modena_model_t(model,parameters=list(parameters))
 
-            return max(abs(i) for i in model.error(cModel,idxGenerator=fitData(testIndices),checkBounds=False))
-        # ------------------------------------------------------------------- #
-        return errorTest(parameters)
 
+    def split(self, nSamples):
+        """
+        s = [ ( ( training_set ), validation_point ), ... ]
+        """
+        s = range(nSamples) # validation samples
+        training_samples = ( tuple(s[0:i]+s[i+1:]) for (i, si) in enumerate(s) )
+        return ( training_samples, s )
 
 
     def newPointsFWAction(self, model, **kwargs):
@@ -636,29 +1267,25 @@ class Test(ParameterFittingStrategy):
 
         training_sets, validation_sets = self.split(model.nSamples)
 
-        parameters = [ self.fit(model, [v_set] ) for v_set in validation_sets ]
-        errors = [ self.validate(model, pi, [vi] ) for (pi, vi) in zip(parameters, validation_sets) ]
+        parameters, errors = zip(
+            *self.fitEach(model, [ [v_set] for v_set in validation_sets ])
+        )
 
         maxError = min(errors)
         new_parameters = parameters[errors.index(maxError)]
 
         print 'Maximum Error = %s' % maxError
-        if maxError > self['maxError']:
+        if self.maxErrorExceeded(maxError):
             print('Parameters ' + term.red + 'not' + term.normal + ' valid, adding samples.')
             print('current parameters = [%s]' % ', '.join('%g' % k for k in new_parameters))
 
-            # Update database
-            model.save()
-
             return FWAction(detours=self['improveErrorStrategy'].workflow(model))
 
         else:
             print('old parameters = [%s]' % ', '.join('%g' % k for k in model.parameters))
             print('new parameters = [%s]' % ', '.join('%g' % k for k in new_parameters))
 
-            model["parameters"] = new_parameters
-            model.updateMinMax()
-            model.save()
+            self.commitParameters(model, new_parameters)
 
             # return nothing to restart normal operation
             return FWAction()
@@ -706,95 +1333,19 @@ class NonLinFitWithErrorContol(ParameterFittingStrategy):
             )
         )
 
-        # ------------------------------ Function --------------------------- #
-        def errorFit(parameters):
+        testIndices = sorted(testIndices)
 
-            def fitData(n, testIndices):
-                for i in xrange(n):
-                    if i not in testIndices:
-                         yield i
-
-            # Instantiate the surrogate model
-            cModel = modena.libmodena.modena_model_t(
-                model=model,
-                parameters=list(parameters)
-            )
-
-            return FloatVector(
-                list(
-                    model.error(
-                        cModel,
-                        idxGenerator=fitData(model.nSamples, testIndices),
-                        checkBounds=False
-                    )
-                )
-            )
-        # ------------------------------------------------------------------- #
-
-        # ------------------------------ Function --------------------------- #
-        def errorTest(parameters):
-
-            def fitData(testIndices):
-                for i in testIndices:
-                     yield i
-
-            # Instantiate the surrogate model
-            cModel = modena.libmodena.modena_model_t(
-                model,
-                parameters=list(parameters)
-            )
-
-            return max(
-                abs(i) for i in model.error(
-                    cModel,
-                    idxGenerator=fitData(testIndices),
-                    checkBounds=False
-                )
-            )
-        # ------------------------------------------------------------------- #
-
-        new_parameters = model.parameters
-        if not len(new_parameters):
-            new_parameters = [None] * len(model.surrogateFunction.parameters)
-            for k, v in model.surrogateFunction.parameters.iteritems():
-                new_parameters[v.argPos] = (v.min + v.max)/2
-
-        # make objects usable in R
-        R_par = FloatVector(new_parameters)
-        R_res = rinterface.rternalize(errorFit)
-
-        max_parameters = [None]*len(new_parameters)
-        min_parameters = [None]*len(new_parameters)
-        for k, v in model.surrogateFunction.parameters.iteritems():
-            min_parameters[v.argPos] = v.min
-            max_parameters[v.argPos] = v.max
-
-        # perform fitting (nonlinear MSSQ)
-        nlfb = nlmrt.nlfb(
-            start=R_par,
-            resfn=R_res,
-            jacfn=rinterface.NULL,
-            trace=rinterface.FALSE,
-            lower=FloatVector(min_parameters),
-            upper=FloatVector(max_parameters),
-            maskidx=rinterface.NULL
-        )
-        del max_parameters
-        del min_parameters
-
-        # optimised coefficients and sum of squares
-        nlfb_coeffs = nlfb[nlfb.names.index('coefficients')]
-        nlfb_ssqres = nlfb[nlfb.names.index('ssquares')]
-        new_parameters = list(nlfb_coeffs)
+        # perform fitting (nonlinear MSSQ) to the remaining samples
+        new_parameters = self.fit(model, testIndices)
 
         # The following code block will check the error and call the ImproveEr-
         # rorStrategy to add more points to the design of experiments if the m-
         # odel is not validated
 
-        maxError = errorTest(new_parameters)
+        maxError = self.validate(model, new_parameters, testIndices)
 
         print 'Maximum Error = %s' % maxError
-        if maxError > self['maxError']:
+        if self.maxErrorExceeded(maxError):
             print(
                 'Parameters ' + term.red + 'not' + term.normal
               + ' valid, adding samples.'
@@ -805,9 +1356,6 @@ class NonLinFitWithErrorContol(ParameterFittingStrategy):
                 )
             )
 
-            # Update database
-            model.save()
-
             return FWAction(
                 detours=self['improveErrorStrategy'].workflow(model)
             )
@@ -825,11 +1373,7 @@ class NonLinFitWithErrorContol(ParameterFittingStrategy):
             )
 
             # Update database
-            # TODO: This is not save if the model is updated by another fitting
-            #                                         task running concurrently
-            model.parameters = new_parameters
-            model.updateMinMax()
-            model.save()
+            self.commitParameters(model, new_parameters, testIndices)
 
             # return nothing to restart normal operation
             return FWAction()
@@ -863,121 +1407,246 @@ class NonLinFitToPointWithSmallestError(ParameterFittingStrategy):
 
     def newPointsFWAction(self, model, **kwargs):
 
-        new_parameters = model.parameters
-        if not len(new_parameters):
-            new_parameters = [None] * len(model.surrogateFunction.parameters)
-            for k, v in model.surrogateFunction.parameters.iteritems():
-                new_parameters[v.argPos] = (v.min + v.max)/2
+        # Leave out every sample once, see 'nProcesses' in fitEach
+        results = self.fitEach(
+            model, [ [i] for i in xrange(model.nSamples) ]
+        )
+        new_parameters, maxError = min(results, key=lambda r: r[1])
 
-        max_parameters = [None]*len(new_parameters)
-        min_parameters = [None]*len(new_parameters)
-        for k, v in model.surrogateFunction.parameters.iteritems():
-            min_parameters[v.argPos] = v.min
-            max_parameters[v.argPos] = v.max
+        print 'Maximum Error = %s' % maxError
+        print(
+            'old parameters = [%s]' % ', '.join(
+                '%g' % k for k in model.parameters
+            )
+        )
+        print(
+            'new parameters = [%s]' % ', '.join(
+                '%g' % k for k in new_parameters
+            )
+        )
 
-        maxError = 1000
-        coeffs = None
-        for i in xrange(model.nSamples):
-            testPoint = [i]
+        # Update database
+        self.commitParameters(model, new_parameters)
 
-            # -------------------------- Function --------------------------- #
-            def errorTest(parameters):
+        # return nothing to restart normal operation
+        return FWAction()
 
-                def fitData(testIndices):
-                    for i in testPoint:
-                         yield i
 
-                # Instantiate the surrogate model
-                cModel = modena.libmodena.modena_model_t(
-                    model,
-                    parameters=list(parameters)
-                )
+@explicit_serialize
+class IncrementalNonLinFit(ParameterFittingStrategy):
+    """
+    @brief    Parameter fitting updating the previous fit with new samples
+    @details
+              The residuals and their Jacobian at the parameters of the model
+              are kept in a cache (see SurrogateModel.loadFitCache), which
+              only applies to the output factors and transforms it was
+              computed with. The newest 'testDataPercentage' (default 0.2) of
+              the samples added since the cache was built are held out for
+              validation, see splitNewSamples. For the other new samples only
+              the residuals and Jacobian are computed and a single damped
+              Gauss-Newton (Levenberg-Marquardt) step is taken from the
+              parameters of the model. The step is only accepted if it
+              reduces the sum of squares. Otherwise the parameters are fitted
+              to all samples but the held out ones, see fit.
+
+              The parameters are valid if the maximum error of the held out
+              samples is below 'maxError'. They are then stored and the cache
+              is updated, otherwise the 'improveErrorStrategy' is executed.
+              The held out samples enter the next update. The Jacobian of the
+              step is updated by Broyden's method and evaluated again after
+              'jacobianUpdates' (default 5) steps.
+
+              Options: maxError, improveErrorStrategy, damping (default 1e-3),
+              testDataPercentage, jacobianUpdates
+    """
 
-                return max(
-                    abs(i) for i in model.error(
-                        cModel,
-                        idxGenerator=fitData(testPoint),
-                        checkBounds=False
-                    )
-                )
+    def __init__(self, *args, **kwargs):
+        ParameterFittingStrategy.__init__(self, *args, **kwargs)
 
-            # -------------------------- Function --------------------------- #
-            def errorFit(parameters):
 
-                def fitData(n, testPoint):
-                    for i in xrange(n):
-                        if i not in testPoint:
-                             yield i
+    def splitNewSamples(self, model, first):
+        """
+        @brief    Split the samples added since first into training and test
+        @details
+                  The newest samples are held out, so that the samples used
+                  for fitting always start at the first sample (see the
+                  cache). At least one sample is fitted.
+        @param    first (int) index of the first new sample
+        @returns  (int) number of samples fitted, the rest is held out
+        """
+        nNew = model.nSamples - first
+        nTest = max(1, int(self.get('testDataPercentage', 0.2)*nNew))
+        return max(model.nSamples - nTest, min(1, model.nSamples))
 
-                # Instantiate the surrogate model
-                cModel = modena.libmodena.modena_model_t(
-                    model=model,
-                    parameters=list(parameters)
-                )
 
-                return FloatVector(
-                    list(
-                        model.error(
-                            cModel,
-                            idxGenerator=fitData(model.nSamples, testPoint),
-                            checkBounds=False
-                        )
-                    )
-                )
-            # --------------------------------------------------------------- #
-
-            # make objects usable in R
-            R_res = rinterface.rternalize(errorFit)
-            R_par = FloatVector(new_parameters)
-
-            # perform fitting (nonlinear MSSQ)
-            nlfb = nlmrt.nlfb(
-                start=R_par,
-                resfn=R_res,
-                jacfn=rinterface.NULL,
-                trace=rinterface.FALSE,
-                lower=FloatVector(min_parameters),
-                upper=FloatVector(max_parameters),
-                maskidx=rinterface.NULL
+    def updateStep(self, model, cache, nTrain):
+        """
+        @brief    Try to update the parameters of the model with one step
+        @param    cache (dict) see setFitCache
+        @param    nTrain (int) number of samples to fit
+        @returns  (tuple) parameters, residuals, Jacobian and number of
+                  Broyden updates of the Jacobian, or None if the step does
+                  not reduce the sum of squares
+        """
+        parameters = numpy.array(model.parameters)
+
+        # Residuals and Jacobian of the new samples only
+        r, J = self.residualsJacobian(
+            model, parameters, xrange(cache['nSamples'], nTrain)
+        )
+        r = numpy.concatenate((cache['r'], r))
+        J = numpy.vstack(
+            (numpy.reshape(cache['J'], (-1, len(parameters))), J)
+        )
+
+        JTJ = numpy.dot(J.T, J)
+        A = JTJ + self.get('damping', 1e-3)*numpy.diag(numpy.diag(JTJ))
+        try:
+            step = numpy.linalg.solve(A, -numpy.dot(J.T, r))
+        except numpy.linalg.LinAlgError:
+            return None
+
+        min_parameters, max_parameters = self.parameterBounds(model)
+        new_parameters = numpy.clip(
+            parameters + step, min_parameters, max_parameters
+        )
+        new_r = self.residuals(model, new_parameters, xrange(nTrain))
+        if numpy.dot(new_r, new_r) >= numpy.dot(r, r):
+            return None
+
+        # The Jacobian is evaluated again after 'jacobianUpdates' steps,
+        # otherwise Broyden's method updates it for the step actually taken
+        updates = cache.get('updates', 0) + 1
+        if updates > self.get('jacobianUpdates', 5):
+            new_r, J = self.residualsJacobian(
+                model, new_parameters, xrange(nTrain)
             )
+            updates = 0
+        else:
+            step = new_parameters - parameters
+            if numpy.dot(step, step) > 0:
+                J += numpy.outer(
+                    new_r - r - numpy.dot(J, step), step
+                )/numpy.dot(step, step)
+
+        return new_parameters.tolist(), new_r, J, updates
+
+
+    def fitCacheKey(self, model):
+        """
+        @brief    Settings the residuals in the cache depend on
+        @returns  (dict) output factors and residual transforms
+        """
+        outputFactors = self.outputFactors(model)
+        return {
+            'outputFactors':
+                [] if outputFactors is None else outputFactors.tolist(),
+            'transform': self.residualTransform(model),
+        }
+
+
+    def loadFitCache(self, model):
+        """
+        @brief    Load the cache if it applies to the model
+        @returns  (dict) see setFitCache, or None
+        """
+        cache = model.loadFitCache()
+        if (
+            not cache
+         or cache['parameters'] != list(model.parameters)
+         or cache['nSamples'] > model.nSamples
+         or cache.get('key') != self.fitCacheKey(model)
+        ):
+            return None
+        return cache
+
+
+    def setFitCache(self, model, parameters, nSamples, r, J, updates=0):
+        """
+        @brief    Store the residuals and Jacobian at parameters
+        @param    nSamples (int) number of samples r and J belong to
+        @param    r (numpy.ndarray) residuals of the samples
+        @param    J (numpy.ndarray) Jacobian of r
+        @param    updates (int) Broyden updates of J since it was evaluated
+        """
+        model.storeFitCache({
+            'parameters': list(parameters),
+            'nSamples': nSamples,
+            'key': self.fitCacheKey(model),
+            'r': r.tolist(),
+            'J': J.ravel().tolist(),
+            'updates': updates,
+        })
+
+
+    def newPointsFWAction(self, model, **kwargs):
+
+        # Without new samples there is nothing to hold out from the cache
+        cache = self.loadFitCache(model)
+        if cache and cache['nSamples'] == model.nSamples:
+            cache = None
 
-            parameterError = errorTest(nlfb[nlfb.names.index('coefficients')])
-            if parameterError < maxError:
-                maxError = parameterError
-                new_parameters = list(nlfb[nlfb.names.index('coefficients')])
-                coeffs = nlfb
+        nTrain = self.splitNewSamples(
+            model, cache['nSamples'] if cache else 0
+        )
+        testIndices = range(nTrain, model.nSamples)
 
+        update = self.updateStep(model, cache, nTrain) if cache else None
+        if update is not None:
+            new_parameters, r, J, updates = update
+            maxError = self.validate(model, new_parameters, testIndices)
 
-        # optimised coefficients and sum of squares
-        nlfb_coeffs = coeffs[nlfb.names.index('coefficients')]
-        nlfb_ssqres = coeffs[nlfb.names.index('ssquares')]
+        if update is None or self.maxErrorExceeded(maxError):
+            print(
+                'Incremental update ' + term.red + 'not' + term.normal
+              + ' possible, fitting all samples.'
+            )
+            new_parameters = self.fit(model, testIndices)
+            r = J = None
+            maxError = self.validate(model, new_parameters, testIndices)
 
         print 'Maximum Error = %s' % maxError
-        print(
-            'old parameters = [%s]' % ', '.join(
-                '%g' % k for k in model.parameters
+        if self.maxErrorExceeded(maxError):
+            print(
+                'Parameters ' + term.red + 'not' + term.normal
+              + ' valid, adding samples.'
             )
-        )
-        print(
-            'new parameters = [%s]' % ', '.join(
-                '%g' % k for k in new_parameters
+            print(
+                'current parameters = [%s]' % ', '.join(
+                    '%g' % k for k in new_parameters
+                )
             )
-        )
 
-        # Update database
-        # TODO: This is not save if the model is updated by another fitting
-        #                                         task running concurrently
-        model.parameters = new_parameters
-        model.updateMinMax()
-        model.save()
+            return FWAction(
+                detours=self['improveErrorStrategy'].workflow(model)
+            )
+
+        else:
+            print(
+                'old parameters = [%s]' % ', '.join(
+                    '%g' % k for k in model.parameters
+                )
+            )
+            print(
+                'new parameters = [%s]' % ', '.join(
+                    '%g' % k for k in new_parameters
+                )
+            )
 
-        del parameterError
-        del max_parameters
-        del min_parameters
-        del coeffs
+            # Update database, the cache only if these parameters were stored
+            stored = self.commitParameters(
+                model, new_parameters, testIndices
+            )
+            if list(stored) == list(new_parameters):
+                if r is None:
+                    r, J = self.residualsJacobian(
+                        model, new_parameters, xrange(nTrain)
+                    )
+                    updates = 0
+                self.setFitCache(model, new_parameters, nTrain, r, J, updates)
 
-        # return nothing to restart normal operation
-        return FWAction()
+            # return nothing to restart normal operation
+            return FWAction()
 
 
 @explicit_serialize
@@ -1050,7 +1719,11 @@ class ParameterFitting(FireTaskBase):
               + term.normal
             );
             model.updateFitDataFromFwSpec(fw_spec)
-            return model.parameterFittingStrategy().newPointsFWAction(model)
+            strategy = model.parameterFittingStrategy()
+
+            # Record the cost of the fit in the fitting history
+            with FitProfiler(model, strategy):
+                return strategy.newPointsFWAction(model)
         except Exception as e:
             import traceback
             traceback.print_exc()
@@ -1089,6 +1762,10 @@ class ParametersNotValid(Exception):
     pass
 
 
+class ConcurrentUpdate(Exception):
+    pass
+
+
 class TerminateWorkflow(Exception):
     pass
 
@@ -1114,7 +1791,8 @@ class ModenaFireTask(FireTaskBase):
             op()
 
         except OutOfBounds as e:
-            model = e.args[1]
+            # The model may be an evaluation-only view, see loadView
+            model = modena.SurrogateModel.load(e.args[1]._id)
             print(
                 term.cyan
               + '%s out-of-bounds, executing outOfBoundsStrategy for model %s'
@@ -1126,7 +1804,8 @@ class ModenaFireTask(FireTaskBase):
             # task in order to resume normal operation
             wf = model.outOfBoundsStrategy().workflow(
                 model,
-                outsidePoint=model.outsidePoint
+                outsidePoint=model.outsidePoint,
+                outsidePoints=model.outsidePoints
             )
             wf.append_wf(
                 Workflow([Firework(self)], name='original task'),
@@ -1135,7 +1814,7 @@ class ModenaFireTask(FireTaskBase):
             raise ModifyWorkflow(FWAction(detours=wf))
 
         except ParametersNotValid as e:
-            model = e.args[1]
+            model = modena.SurrogateModel.load(e.args[1]._id)
             print(
                 term.cyan
               + '%s is not initialised, ' % text
@@ -1187,7 +1866,7 @@ class ModenaFireTask(FireTaskBase):
               + term.normal
             )
 
-            model = modena.SurrogateModel.load(self['modelId'])
+            model = modena.SurrogateModel.loadView(self['modelId'])
             oldP = copy.copy(p)
             for m in model.substituteModels:
                 self.executeAndCatchExceptions(
@@ -42,19 +42,34 @@ License
 
 import os
 import six
+import copy
+import fcntl
+import shutil
+import tempfile
+import subprocess
+import contextlib
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import abc
+import ast
+import __future__
 import hashlib
 import modena
 from modena.Strategy import *
+from modena.FittingHistory import FitProfiler
 import weakref
 import re
 import random
+import struct
+import numpy
 from mongoengine import *
 from mongoengine.document import TopLevelDocumentMetaclass
 from mongoengine.base import BaseField
+from mongoengine.errors import SaveConditionError
 import pymongo
 from fireworks import Firework, FireTaskBase
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import jinja2
 
 
@@ -72,10 +87,150 @@ MODENA_PARSED_URI['host'], MODENA_PARSED_URI['port'] = \
 MODENA_PARSED_URI['name'] = MODENA_PARSED_URI.pop('database')
 del MODENA_PARSED_URI['collection'], MODENA_PARSED_URI['options']
 
+# Cache of compiled surrogate functions shared between processes
+MODENA_CACHE_DIR = os.environ.get(
+    'MODENA_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.modena', 'cache')
+)
+
+# Must match the SOVERSION of libmodena (src/src/CMakeLists.txt)
+LIBMODENA_SOVERSION = 1
+
+# Compiler configuration found when libmodena was installed
+try:
+    from modena.BuildConfig import MODENA_C_COMPILER, MODENA_C_FLAGS, \
+        MODENA_INCLUDE_DIRS, MODENA_LIBRARIES
+except ImportError:
+    MODENA_C_COMPILER = None
+
+# Backend used to compile surrogate functions: 'direct' invokes the compiler
+# once per function, 'cmake' generates and builds a CMake project
+MODENA_COMPILE_BACKEND = os.environ.get(
+    'MODENA_COMPILE_BACKEND',
+    'direct' if MODENA_C_COMPILER else 'cmake'
+)
+
+# Compilations started within parallelCompile
+compileJobs = None
+
+# Number of loaded surrogate models kept per process, see ModelCache. If
+# MODENA_MODEL_CACHE_WATCH is set, the cache is invalidated by a change stream
+# (requires a replica set) instead of checking the versions on every load
+MODENA_MODEL_CACHE_SIZE = int(os.environ.get('MODENA_MODEL_CACHE_SIZE', 64))
+MODENA_MODEL_CACHE_WATCH = bool(os.environ.get('MODENA_MODEL_CACHE_WATCH'))
+
+# Identification of binary model descriptors read by libmodena
+DESCRIPTOR_MAGIC = 'MODENADS'
+DESCRIPTOR_VERSION = 1
+
+# Operators of the formulas of Function and their C equivalent
+FUNCTION_C_OPERATORS = {
+    ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/',
+    ast.UAdd: '+', ast.USub: '-',
+}
+
+# Functions of math.h available in the formulas of Function evaluated by NumPy
+FUNCTION_NUMPY_NAMESPACE = {
+    '__builtins__': {},
+    'exp': numpy.exp, 'log': numpy.log, 'log10': numpy.log10,
+    'sqrt': numpy.sqrt, 'fabs': numpy.fabs, 'sin': numpy.sin,
+    'cos': numpy.cos, 'tan': numpy.tan, 'asin': numpy.arcsin,
+    'acos': numpy.arccos, 'atan': numpy.arctan, 'sinh': numpy.sinh,
+    'cosh': numpy.cosh, 'tanh': numpy.tanh, 'floor': numpy.floor,
+    'ceil': numpy.ceil,
+}
+
+# Transformations of the residuals of the outputs, see residualTransform
+RESIDUAL_TRANSFORMS = ('absolute', 'relative', 'log')
+
 ##
 # @addtogroup python_interface_library
 # @{
 
+@contextlib.contextmanager
+def parallelCompile(processes=None):
+    """Context manager compiling the surrogate functions created within the
+    block in parallel.
+
+    CFunctions created inside the block return as soon as their compilation
+    has been started. The compilers run as up to 'processes' (default: number
+    of CPUs) parallel processes, and leaving the block waits for all of them
+    and raises the first compilation error.
+
+    ~~~~{.py}
+    with parallelCompile():
+        f1 = CFunction(Ccode=..., inputs=..., outputs=..., parameters=...)
+        f2 = CFunction(Ccode=..., inputs=..., outputs=..., parameters=...)
+    ~~~~
+
+    @param processes (int) maximum number of parallel compilations
+    """
+    global compileJobs
+    if compileJobs is not None:
+        yield
+        return
+
+    pool = ThreadPool(processes or multiprocessing.cpu_count())
+    compileJobs = (pool, [])
+    try:
+        yield
+    finally:
+        results = compileJobs[1]
+        compileJobs = None
+        pool.close()
+        pool.join()
+
+    for r in results:
+        r.get()
+
+
+def residualTransform(transform, outputs, out):
+    """
+    @brief    Calculate the transformed residuals of the outputs
+    @details
+              'absolute' is the difference of the sample and the surrogate
+              model, 'relative' divides it by the magnitude of the sample and
+              'log' is the difference of the logarithms of their magnitudes.
+              The derivatives with respect to the outputs of the surrogate
+              model are returned as well, they turn the derivatives of the
+              surrogate model into those of the residuals.
+
+    @param    transform (str|list) one of RESIDUAL_TRANSFORMS, or a list with
+              one transform per column, default 'absolute'
+    @param    outputs (numpy.ndarray) samples, one column per output
+    @param    out (numpy.ndarray) outputs of the surrogate model
+    @returns  (tuple) residuals and their derivatives as numpy.ndarray
+    """
+    if transform is None or isinstance(transform, six.string_types):
+        transform = [transform or 'absolute']*outputs.shape[1]
+
+    r = numpy.empty_like(out)
+    d = numpy.empty_like(out)
+    tiny = numpy.finfo(float).tiny
+    for j, t in enumerate(transform):
+        y = outputs[:, j]
+        f = out[:, j]
+        if t == 'absolute':
+            r[:, j] = y - f
+            d[:, j] = -1.0
+        elif t == 'relative':
+            scale = numpy.where(y != 0.0, abs(y), 1.0)
+            r[:, j] = (y - f)/scale
+            d[:, j] = -1.0/scale
+        elif t == 'log':
+            f = numpy.where(abs(f) > tiny, f, tiny)
+            r[:, j] = numpy.log(numpy.maximum(abs(y), tiny)) \
+                - numpy.log(abs(f))
+            d[:, j] = -1.0/f
+        else:
+            raise ValueError(
+                'Unknown residual transform %s, use one of %s'
+                % (t, ', '.join(RESIDUAL_TRANSFORMS))
+            )
+
+    return r, d
+
+
 class ArgPosNotFound(Exception):
     pass
 
@@ -130,6 +285,148 @@ def loadType(obj, name, cls):
         return var
 
 
+class ModelCache(object):
+    """
+    @brief    Process-local LRU cache of loaded surrogate models
+    @details
+              A cached model is only returned if it has no unsaved changes
+              and if the versions of the model and all its substitute models
+              are unchanged, which is checked with a single query. If a
+              change stream is running (see watch), changed models are
+              evicted by it and the query is skipped. The strategies loaded
+              by loadType are cached with the model.
+    """
+
+    def __init__(self, size):
+        """
+        @brief    Constructor
+        @param    size (int) maximum number of cached models, 0 disables
+                  the cache
+        """
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.watchPid = None
+
+
+    def watching(self):
+        """
+        @brief    Check whether the change stream runs in this process
+        @returns  (bool) True if models are evicted by the change stream
+        """
+        return self.watchPid == os.getpid()
+
+
+    def get(self, key, collection):
+        """
+        @brief    Return a cached model if it is up to date
+        @param    key (tuple) kind of load and _id of the model
+        @param    collection collection of the surrogate models
+        @returns  SurrogateModel or None
+        """
+        with self.lock:
+            model = self.entries.pop(key, None)
+        if model is None:
+            return None
+
+        versions = ModelCache.versions(model)
+        if model._get_changed_fields():
+            return None
+
+        if not self.watching():
+            for doc in collection.find(
+                { '_id': { '$in': versions.keys() } },
+                projection=['version']
+            ):
+                if doc.get('version', 0) != versions.pop(doc['_id']):
+                    return None
+            if versions:
+                return None
+
+        with self.lock:
+            self.entries[key] = model
+        return model
+
+
+    def put(self, key, model):
+        """
+        @brief    Store a model and evict the least recently used one
+        @param    key (tuple) kind of load and _id of the model
+        @param    model SurrogateModel
+        """
+        if not self.size:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = model
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+    def invalidate(self, modelId):
+        """
+        @brief    Evict all entries containing a model
+        @param    modelId (str) _id of the model or a substitute model
+        """
+        with self.lock:
+            for key, model in self.entries.items():
+                if modelId in ModelCache.versions(model):
+                    del self.entries[key]
+
+
+    def clear(self):
+        """
+        @brief    Evict all entries
+        """
+        with self.lock:
+            self.entries.clear()
+
+
+    @staticmethod
+    def versions(model):
+        """
+        @brief    Collect the versions of a model tree
+        @param    model SurrogateModel
+        @returns  (dict) versions of the model and its loaded substitute
+                  models by _id
+        """
+        v = { model._id: model.version or 0 }
+        for m in model._data.get('substituteModels') or []:
+            if isinstance(m, SurrogateModel):
+                v.update(ModelCache.versions(m))
+        return v
+
+
+    def watch(self, collection):
+        """
+        @brief    Start a thread evicting models changed in the database
+        @details
+                  Falls back to checking the versions if the database does
+                  not support change streams.
+        @param    collection collection of the surrogate models
+        """
+        if self.watching():
+            return
+
+        def run():
+            try:
+                with collection.watch() as stream:
+                    for change in stream:
+                        self.invalidate(change['documentKey']['_id'])
+            except Exception as e:
+                print 'Model cache change stream stopped: %s' % e
+            self.watchPid = None
+            self.clear()
+
+        thread = threading.Thread(target=run, name='ModelCache.watch')
+        thread.daemon = True
+        self.watchPid = os.getpid()
+        thread.start()
+
+
+modelCache = ModelCache(MODENA_MODEL_CACHE_SIZE)
+
+
 class EmbDoc(DynamicEmbeddedDocument):
     """Class wrapper for DynamicEmbeddedDocument from MongeEngine"""
     meta = {'allow_inheritance': False}
@@ -350,6 +647,8 @@ class SurrogateFunction(DynamicDocument):
     @var     parameters (field) Maps a embedded document field.
     @var     functionName (string) Name of the surrogate function.
     @var     libraryName (string) Collection name.
+    @var     jacobianName (string) Name of the function computing the
+             derivatives of the outputs w.r.t. the parameters (optional).
     @var     indices (field) Reference to 'IndexSet' document.
     @var     meta mongoengine-specific variable
     """
@@ -360,6 +659,7 @@ class SurrogateFunction(DynamicDocument):
     parameters = MapField(EmbeddedDocumentField(MinMaxArgPos))
     functionName = StringField(required=True)
     libraryName = StringField(required=True)
+    jacobianName = StringField()
     indices = MapField(ReferenceField(IndexSet))
     meta = {'allow_inheritance': True}
 
@@ -496,6 +796,21 @@ class CFunction(SurrogateFunction):
     """
     @brief   Class for defining Surrogate Functions where the executable code
              is a C-function.
+    @details
+             The optional 'Jcode' defines the derivatives of the outputs with
+             respect to the parameters. It is compiled into the same library
+             and must define a function named <functionName>_jacobian:
+
+                 void f_jacobian
+                 (
+                     const modena_model_t* model,
+                     const double* inputs,
+                     double *jacobian
+                 )
+
+             which stores d(outputs[i])/d(parameters[j]) in
+             jacobian[i*parameters_size + j]. The variables of the inputs and
+             parameters are declared by the block 'variables' as in 'Ccode'.
     """
     def __init__(self, *args, **kwargs):
         super(CFunction, self).__init__(*args, **kwargs)
@@ -525,48 +840,143 @@ class CFunction(SurrogateFunction):
         self.libraryName = ln
         self.functionName = fn
 
+        if kwargs.get('Jcode'):
+            jn = re.search(
+                'void\s*(.*)\s*\('
+                '\s*const\s*modena_model_t\s*\*\s*model\s*,'
+                '\s*const\s*double\s*\*\s*inputs\s*,'
+                '\s*double\s*\*\s*jacobian\s*\)',
+                kwargs['Jcode']
+            ).group(1).strip(' \t\n\r')
+
+            if jn != '%s_jacobian' % fn:
+                raise Exception(
+                    'Jacobian of %s must be named %s_jacobian' % (fn, fn)
+                )
+
+            self.jacobianName = jn
+
 
     def compileCcode(self, kwargs):
         """
-        @brief   Helper function to compile a model into local library.
+        @brief   Helper function to compile a model into a shared library.
+        @details
+                 Libraries are kept in a cache shared between processes, which
+                 is located in MODENA_CACHE_DIR (default ~/.modena/cache). An
+                 entry is keyed by the hash of the rendered code, the compiler
+                 settings and the version of libmodena, so that a cache hit
+                 skips compilation completely. Entries are built in a
+                 temporary directory while holding a lock on the key and are
+                 renamed into place when complete.
         @return  (str) name of the compiled function, i.e. the shared library.
         """
+        env = jinja2.Environment(lstrip_blocks=True, trim_blocks=True)
+
+        child = env.from_string(r'''
+{% extends Ccode %}
+{% block variables %}
+const double* parameters = model->parameters;
+{% for k, v in pFunction.inputs.iteritems() %}
+{% if 'index' in v %}
+const size_t {{k}}_argPos = {{v.argPos}};
+const double* {{k}} = &inputs[{{k}}_argPos];
+const size_t {{k}}_size = {{ v.index.iterator_size() }};
+{% else %}
+const size_t {{k}}_argPos = {{v['argPos']}};
+const double {{k}} = inputs[{{k}}_argPos];
+{% endif %}
+{% endfor %}
+{% endblock %}
+        ''')
+
+        parent = env.from_string(kwargs['Ccode'])
+        code = child.render(pFunction=kwargs, Ccode=parent)
+
+        # The Jacobian is compiled into the same library
+        if kwargs.get('Jcode'):
+            parent = env.from_string(kwargs['Jcode'])
+            code += '\n' + child.render(pFunction=kwargs, Ccode=parent)
 
         m = hashlib.md5()
-        m.update(kwargs['Ccode'])
+        m.update(code.encode('utf-8'))
+        for k in ('CC', 'CFLAGS', 'LDFLAGS'):
+            m.update('%s=%s;' % (k, os.environ.get(k, '')))
+        m.update('modena=%s;%s' % (modena.__version__, LIBMODENA_SOVERSION))
+        m.update('backend=%s' % MODENA_COMPILE_BACKEND)
         h = m.hexdigest()
-        d = 'func_' + h
-        ln = '%s/%s/lib%s.so' % (os.getcwd(), d, h)
-
-        if(True or not os.path.exists(ln)):
-            if(not os.path.isdir(d)): os.mkdir(d)
-            os.chdir(d)
-
-            env = jinja2.Environment(lstrip_blocks=True, trim_blocks=True)
-
-            child = env.from_string(r'''
-    {% extends Ccode %}
-    {% block variables %}
-    const double* parameters = model->parameters;
-    {% for k, v in pFunction.inputs.iteritems() %}
-    {% if 'index' in v %}
-    const size_t {{k}}_argPos = {{v.argPos}};
-    const double* {{k}} = &inputs[{{k}}_argPos];
-    const size_t {{k}}_size = {{ v.index.iterator_size() }};
-    {% else %}
-    const size_t {{k}}_argPos = {{v['argPos']}};
-    const double {{k}} = inputs[{{k}}_argPos];
-    {% endif %}
-    {% endfor %}
-    {% endblock %}
-            ''')
-
-            parent = env.from_string(kwargs['Ccode'])
-
-            #print child.render(pFunction=kwargs, Ccode=parent)
-            child.stream(pFunction=kwargs, Ccode=parent).dump('%s.c' % h)
-
-            f = open('CMakeLists.txt', 'w')
+
+        d = os.path.join(MODENA_CACHE_DIR, h)
+        ln = os.path.join(d, 'lib%s.so' % h)
+
+        if os.path.exists(ln):
+            return ln
+
+        if compileJobs is not None:
+            pool, results = compileJobs
+            results.append(pool.apply_async(self.cacheLibrary, (h, code)))
+        else:
+            self.cacheLibrary(h, code)
+
+        return ln
+
+
+    def cacheLibrary(self, h, code):
+        """
+        @brief   Build the library for the key h into the cache unless another
+                 process did so already
+        """
+        d = os.path.join(MODENA_CACHE_DIR, h)
+        ln = os.path.join(d, 'lib%s.so' % h)
+
+        try:
+            os.makedirs(MODENA_CACHE_DIR)
+        except OSError:
+            if not os.path.isdir(MODENA_CACHE_DIR):
+                raise
+
+        with open(os.path.join(MODENA_CACHE_DIR, '%s.lock' % h), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # Another process may have built the library meanwhile
+                if not os.path.exists(ln):
+                    tmp = tempfile.mkdtemp(prefix='%s.' % h, dir=MODENA_CACHE_DIR)
+                    try:
+                        self.buildLibrary(tmp, h, code)
+                        if os.path.isdir(d):
+                            shutil.rmtree(d)
+                        os.rename(tmp, d)
+                    except:
+                        shutil.rmtree(tmp, ignore_errors=True)
+                        raise
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+    def buildLibrary(self, d, h, code):
+        """
+        @brief   Build the shared library lib<h>.so from code in directory d
+        @details
+                 The process working directory is not changed, so that
+                 libraries can be built from several threads.
+        """
+        with open(os.path.join(d, '%s.c' % h), 'w') as f:
+            f.write(code.encode('utf-8'))
+
+        if MODENA_COMPILE_BACKEND == 'direct':
+            subprocess.check_call(
+                [ MODENA_C_COMPILER ]
+              + MODENA_C_FLAGS
+              + os.environ.get('CFLAGS', '').split()
+              + [ '-shared', '-fPIC' ]
+              + [ '-I%s' % i for i in MODENA_INCLUDE_DIRS ]
+              + [ '-o', 'lib%s.so' % h, '%s.c' % h ]
+              + os.environ.get('LDFLAGS', '').split()
+              + MODENA_LIBRARIES,
+                cwd=d
+            )
+            return
+
+        with open(os.path.join(d, 'CMakeLists.txt'), 'w') as f:
             f.write("""
 cmake_minimum_required (VERSION 2.8)
 project (%(h)s C)
@@ -581,32 +991,40 @@ target_link_libraries(%(h)s MODENA::modena ${LTDL_LIBRARIES})
 
 install(TARGETS %(h)s DESTINATION ${CMAKE_INSTALL_PREFIX}/lib )
 """ % {'h': h})
-            f.close()
-
-            from subprocess import call
-            call(['cmake', '.'])
-            call(['make'])
-            os.chdir('..')
 
-            return ln
+        subprocess.check_call(['cmake', '.'], cwd=d)
+        subprocess.check_call(['make'], cwd=d)
 
 
 class Function(CFunction):
     """
-    @todo This is a draft for a class that can parse simple functions and
-          write the Ccode that is compiled by CFunction.
+    @brief   Surrogate function defined by simple algebraic formulas
+    @details
+             The formulas are given in 'function' as a dictionary mapping the
+             names of the outputs to expressions of the inputs and
+             parameters, e.g. {'name': 'f', 'y': 'p0*x^2 + p1'}. They are
+             translated into the Ccode compiled by CFunction and stored in
+             'expressions', so that the function can also be evaluated by
+             NumPy without a compiled library (see numpyFunction).
+
+    @var     expressions (dict) parsed formula of every output
     """
+    expressions = MapField(StringField())
+
     def __init__(self, *args, **kwargs):
-        if kwargs.has_key('_cls'):
-            super(Function, self).__init__(*args, **kwargs)
-        if kwargs.has_key('libraryName'):
+        if kwargs.has_key('_cls') or kwargs.has_key('libraryName'):
             super(Function, self).__init__(*args, **kwargs)
         else:
             # This is a bad check, make a better one...
             if not kwargs.has_key('function'):
                 raise Exception('Algebraic representation not found')
 
-            # lambda function writing inputs, parameters
+            kwargs['expressions'] = {
+                O: self.Parse(kwargs['function'][O])
+                for O in kwargs['outputs']
+            }
+
+            # lambda function writing parameters
             cDouble = lambda VAR: '\n'.join(
                 [
                     'const double %s = %s[%s];' % (
@@ -616,37 +1034,36 @@ class Function(CFunction):
                 ]
             )
 
-            # lambda function parsing 'function' and writing outputs
+            # lambda function translating 'expressions' and writing outputs
             outPut = lambda OUT: '\n'.join(
                 [
                     'outputs[%s] = %s;' % (
                         kwargs['outputs'][O]['argPos'],
-                        self.Parse(kwargs['function'][O])
+                        self.Cexpression(kwargs['expressions'][O])
                     )
                     for O in kwargs[OUT]
                 ]
             )
 
-            # Main body of the Ccode
+            # Main body of the Ccode, inputs are declared by CFunction
             Ccode='''
 #include "modena.h"
 #include "math.h"
 
 void {name}
 (
-    const modena_model* model,
+    const modena_model_t* model,
     const double* inputs,
     double *outputs
 )
 {{
-{inputs}
+{{% block variables %}}{{% endblock %}}
 {parameters}
 {outputs}
 }}
 '''
             kwargs['Ccode'] = Ccode.format(
                 name=kwargs['function']['name'],
-                inputs=cDouble('inputs'),
                 parameters=cDouble('parameters'),
                 outputs=outPut('outputs')
             )
@@ -654,6 +1071,111 @@ void {name}
             super(Function, self).__init__(*args, **kwargs)
 
 
+    def initKwargs(self, kwargs):
+        """
+        @brief   Compile the Ccode and keep the parsed formulas
+        @param   kwargs (dict) initialisation dictionary.
+        """
+        super(Function, self).initKwargs(kwargs)
+        self.expressions = kwargs['expressions']
+
+
+    @staticmethod
+    def pythonExpression(expression):
+        """
+        @brief   Translate a parsed formula into a Python expression
+        @param   expression (str) formula returned by Parse
+        @returns (str) expression in which '^' is replaced by '**'
+        """
+        return expression.replace('^', '**')
+
+
+    def Cexpression(self, expression):
+        """
+        @brief   Translate a parsed formula into a C expression
+        @details
+                 The formula is read by the Python parser, so that '^' becomes
+                 pow() with the precedence and associativity it has in the
+                 NumPy backend. Numbers are written as floating point
+                 literals, since C truncates integer division while Python 2
+                 floors it. The NumPy backend uses true division as well.
+        @param   expression (str) formula returned by Parse
+        @returns (str) C expression
+        """
+        def emit(node):
+            if isinstance(node, ast.BinOp):
+                if isinstance(node.op, ast.Pow):
+                    return 'pow(%s, %s)' % (emit(node.left), emit(node.right))
+                return '(%s %s %s)' % (
+                    emit(node.left),
+                    FUNCTION_C_OPERATORS[type(node.op)],
+                    emit(node.right)
+                )
+            elif isinstance(node, ast.UnaryOp):
+                return '(%s%s)' % (
+                    FUNCTION_C_OPERATORS[type(node.op)], emit(node.operand)
+                )
+            elif isinstance(node, ast.Name):
+                return node.id
+            elif isinstance(node, ast.Num):
+                return repr(float(node.n))
+            elif isinstance(node, ast.Call):
+                return '%s(%s)' % (
+                    node.func.id, ', '.join(emit(a) for a in node.args)
+                )
+            raise Exception('The expression syntax is not suported.')
+
+        return emit(
+            ast.parse(self.pythonExpression(expression), mode='eval').body
+        )
+
+
+    def numpyFunction(self):
+        """
+        @brief   Return the surrogate function as a vectorized NumPy callable
+        @details
+                 The callable takes the same arguments as the compiled
+                 function, f(model, inputs, outputs), but inputs and outputs
+                 are arrays of shape (nPoints, inputs_size) and
+                 (nPoints, outputs_size). Every formula is evaluated once for
+                 all points. Functions of math.h map to their NumPy
+                 equivalents (see FUNCTION_NUMPY_NAMESPACE).
+        @returns (function) evaluating all outputs of the surrogate function
+        """
+        if not self.expressions:
+            raise Exception('Algebraic representation not found')
+
+        code = [
+            (
+                self.outputs[O].argPos,
+                compile(
+                    self.pythonExpression(e),
+                    '<%s:%s>' % (self.name, O),
+                    'eval',
+                    __future__.division.compiler_flag,
+                    True
+                )
+            )
+            for O, e in self.expressions.iteritems()
+        ]
+        inputsArgPos = [
+            (k, v.argPos) for k, v in self.inputs.iteritems()
+            if not 'index' in v
+        ]
+        parametersArgPos = [
+            (k, v.argPos) for k, v in self.parameters.iteritems()
+        ]
+
+        def function(model, inputs, outputs):
+            parameters = model.parameters
+            variables = {k: inputs[:, i] for k, i in inputsArgPos}
+            variables.update((k, parameters[i]) for k, i in parametersArgPos)
+            for i, c in code:
+                outputs[:, i] = eval(c, FUNCTION_NUMPY_NAMESPACE, variables)
+
+        return function
+
+
     def Parse(self, formula, debug=False, model='', stack={}, delim=0, \
               var=r'[A-Za-z]+\d*',add=r'\+',sub=r'-',mul=r'\*',\
               div=r'/',pow=r'\^',dig=r'\d+\.?\d*'\
@@ -725,6 +1247,166 @@ void {name}
             return model
 
 
+class NumpyModel(object):
+    """
+    @brief   Surrogate model evaluated by NumPy instead of libmodena
+    @details
+             Mimics the Python interface of modena_model_t for surrogate
+             functions providing numpyFunction(), e.g. Function. Batches of
+             points are evaluated in one vectorized call and no shared
+             library is loaded. Substitute models are evaluated by their own
+             evaluator and mapped into the inputs like in libmodena.
+
+    @var     model (SurrogateModel) model that is evaluated
+    """
+    def __init__(self, model, parameters=None):
+        f = model.surrogateFunction
+        if not hasattr(f, 'numpyFunction'):
+            raise TypeError(
+                'Surrogate function %s has no NumPy representation' % f.name
+            )
+
+        self.model = model
+        self.function = f.numpyFunction()
+
+        minValues, maxValues = model.minMax()[:2]
+        self.inputs_min = numpy.array(minValues, dtype=float)
+        self.inputs_max = numpy.array(maxValues, dtype=float)
+        self.inputs_internal_size = len(minValues)
+        self.inputs_size = len(model.inputs)
+        self.outputs_size = len(model.outputs)
+        self.parameters_size = len(f.parameters)
+
+        if parameters is None:
+            parameters = model.parameters
+        if not len(parameters) and self.parameters_size:
+            raise ParametersNotValid(
+                'Surrogate model does not have valid parameters', model
+            )
+        self.parameters = parameters
+
+        self.substituteModels = []
+        for sm in model.substituteModels:
+            map_outputs, map_inputs = model.calculate_maps(sm)
+            self.substituteModels.append((
+                sm.evaluator(),
+                map_outputs[0::2], map_outputs[1::2],
+                map_inputs[0::2], map_inputs[1::2]
+            ))
+
+
+    def clone(self, parameters=None):
+        """
+        @brief   Copy of the model with its own parameters
+        @param   parameters (list) parameters of the copy, default the same
+        """
+        clone = copy.copy(self)
+        if parameters is not None:
+            clone.parameters = parameters
+        return clone
+
+
+    @property
+    def parameters(self):
+        return list(self.___parameters___)
+
+
+    @parameters.setter
+    def parameters(self, value):
+        if len(value) != self.parameters_size:
+            raise ParametersNotValid('Wrong number of parameters', self.model)
+        self.___parameters___ = [float(v) for v in value]
+
+
+    def __call__(self, inputs, checkBounds=True, outputs=None):
+        """
+        @brief   Evaluate the surrogate model
+        @param   inputs (list|numpy.ndarray) input vector of a single point
+                 or matrix of shape (nPoints, inputs_internal_size)
+        @param   checkBounds (bool) check the bounds of the model
+        @param   outputs (numpy.ndarray) optional matrix of shape
+                 (nPoints, outputs_size) receiving the results
+        @returns outputs, or the results as (nested) list if not given
+        """
+        # Substitute models write into the inputs, so work on a copy
+        x = numpy.array(inputs, dtype=float)
+        single = x.ndim == 1
+        x = x.reshape(-1, self.inputs_internal_size)
+
+        o = outputs
+        if o is None:
+            o = numpy.empty((x.shape[0], self.outputs_size))
+        elif o.shape != (x.shape[0], self.outputs_size):
+            raise ValueError(
+                'outputs must have shape (%i, %i)'
+                % (x.shape[0], self.outputs_size)
+            )
+
+        for sm, oFrom, oTo, iFrom, iTo in self.substituteModels:
+            smInputs = numpy.zeros((x.shape[0], sm.inputs_internal_size))
+            smInputs[:, iTo] = x[:, iFrom]
+            smOutputs = numpy.empty((x.shape[0], sm.outputs_size))
+            sm(smInputs, checkBounds=checkBounds, outputs=smOutputs)
+            x[:, oTo] = smOutputs[:, oFrom]
+
+        if checkBounds:
+            outside = numpy.flatnonzero(
+                ((x < self.inputs_min) | (x > self.inputs_max)).any(axis=1)
+            )
+            if len(outside):
+                self.model.exceptionOutOfBounds(x[outside[0]].tolist())
+                raise OutOfBounds(
+                    'Surrogate model is used out-of-bounds', self.model
+                )
+
+        self.function(self, x, o)
+
+        if outputs is not None:
+            return outputs
+        return o[0].tolist() if single else o.tolist()
+
+
+class SampleChunk(Document):
+    """
+    @brief    Chunk of samples of a surrogate model
+    @details
+              The samples of the surrogate models are stored column by
+              column in chunks in a collection of their own, so that the
+              size of the model document does not depend on the number of
+              samples. Every call of SurrogateModel.appendSamples adds one
+              chunk. The samples are numbered in the order of the _id of
+              their chunks, i.e. the chunk migrated from the model document
+              (a string _id) comes first, followed by the chunks appended in
+              the order they were created.
+    """
+    model = StringField(required=True)
+    data = MapField(ListField(FloatField()))
+    weights = ListField(FloatField())
+    meta = {
+        'collection': 'fit_data',
+        'indexes': [('model', 'id')],
+    }
+
+
+class FitCache(Document):
+    """
+    @brief    Residuals and Jacobian of the last fit of a surrogate model
+    @details
+              Stored by IncrementalNonLinFit in a collection of its own, so
+              that the model document does not grow with the number of
+              samples and loading a model does not read the cache. The _id
+              is the one of the model. 'key' holds the output factors and
+              transforms the residuals were computed with.
+    """
+    _id = StringField(primary_key=True)
+    parameters = ListField(FloatField())
+    nSamples = IntField()
+    key = DictField()
+    r = ListField(FloatField())
+    J = ListField(FloatField())
+    meta = { 'collection': 'fit_cache' }
+
+
 class SurrogateModel(DynamicDocument):
     """
     @brief  The surrogate model is the workhorse of the MoDeNa framework.
@@ -742,6 +1424,7 @@ class SurrogateModel(DynamicDocument):
     @var    _id (str) database collection definition
     @var    surrogateFunction reference to 'modena.SurrogateFunction' object
     @var    parameters (list) parameter values surrogate function from MBDoE
+    @var    backend (str) evaluator used in Python, 'C' (libmodena) or 'numpy'
     @var    meta ensures surrogate models are saved in the same collection
     """
     ___refs___ = []
@@ -749,8 +1432,25 @@ class SurrogateModel(DynamicDocument):
     _id = StringField(primary_key=True)
     surrogateFunction = ReferenceField(SurrogateFunction, required=True)
     parameters = ListField(FloatField())
+    backend = StringField(default='C', choices=('C', 'numpy'))
+    version = IntField(default=0)
+    # Samples stored in the model document by earlier versions, see
+    # migrateFitData
+    legacyFitData = MapField(ListField(FloatField()), db_field='fitData')
+    # Range of the samples of every input and output, see appendSamples
+    sampleRange = MapField(EmbeddedDocumentField(MinMaxOpt))
     meta = {'allow_inheritance': True}
 
+    # Outside points held back instead of being stored, see
+    # deferOutsidePoints
+    deferredOutsidePoints = None
+
+    # Fields needed to evaluate a model, see loadView
+    viewFields = [
+        '_cls', 'surrogateFunction', 'parameters', 'inputs', 'outputs',
+        'substituteModels', 'backend', 'version', 'importFrom',
+    ]
+
     def __init__(self, *args, **kwargs):
         """
         @brief     Create a new Surrogate Model instance
@@ -782,7 +1482,6 @@ class SurrogateModel(DynamicDocument):
 
             self.___indices___ = self.parseIndices(kwargs['_id'])
 
-            kwargs['fitData'] = {}
             kwargs['inputs'] = {}
             for k, v in kwargs['surrogateFunction'].inputs_iterAll():
                 kwargs['inputs'][k] = v.to_mongo()
@@ -794,11 +1493,9 @@ class SurrogateModel(DynamicDocument):
             kwargs['outputs'] = {}
             for k, v in kwargs['surrogateFunction'].outputs.iteritems():
                 k = self.expandIndices(k)
-                kwargs['fitData'][k] = []
                 kwargs['outputs'][k] = MinMaxArgPosOpt(**{})
 
             for k, v in kwargs['inputs'].iteritems():
-                kwargs['fitData'][k] = []
                 kwargs['inputs'][k] = MinMaxArgPosOpt(**v)
 
             for k, v in kwargs['inputs'].iteritems():
@@ -833,7 +1530,7 @@ class SurrogateModel(DynamicDocument):
                 try:
                     self.inputs_argPos(o)
                     del self.inputs[o]
-                    del self.fitData[o]
+                    self.invalidateArgPos()
 
                     for k, v in subOutputs[o].inputs.iteritems():
                         try:
@@ -842,6 +1539,7 @@ class SurrogateModel(DynamicDocument):
                             self.inputs[k] = subOutputs[o].inputs[k]
                             self.inputs[k].argPos = nInp
                             nInp += 1
+                            self.invalidateArgPos()
 
                 except ArgPosNotFound:
                     pass
@@ -964,42 +1662,108 @@ class SurrogateModel(DynamicDocument):
         return i
 
 
+    def argPosIndex(self):
+        """
+        @brief   Return the argPos index of the model
+        @details
+                 The index maps the names of the inputs, including the
+                 expanded names of index sets (e.g. 'x[CO2]'), outputs and
+                 parameters directly to their positions. It is computed once
+                 and reset by invalidateArgPos when the inputs or substitute
+                 models change.
+        @returns (dict) {'inputs': {...}, 'outputs': {...}, 'parameters': {...}}
+        """
+        index = getattr(self, '___argPos___', None)
+        if index is not None:
+            return index
+
+        index = { 'inputs': {}, 'outputs': {}, 'parameters': {} }
+        sf = self.surrogateFunction
+
+        for k, v in sf.inputs.iteritems():
+            if 'index' not in v and 'argPos' in v:
+                index['inputs'][k] = v.argPos
+
+        for k, v in self.inputs.iteritems():
+            if 'argPos' in v:
+                index['inputs'][k] = v.argPos
+
+        for k, v in sf.inputs.iteritems():
+            if 'index' in v and 'argPos' in v:
+                for idx in v.index.names:
+                    index['inputs']['%s[%s]' % (k, idx)] = \
+                        v.argPos + v.index.get_index(idx)
+
+        for k, v in sf.outputs.iteritems():
+            if 'argPos' in v:
+                index['outputs'][k] = v.argPos
+                index['outputs'][self.expandIndices(k)] = v.argPos
+
+        for k, v in self.outputs.iteritems():
+            if 'argPos' in v:
+                index['outputs'][k] = v.argPos
+
+        for k, v in sf.parameters.iteritems():
+            if 'argPos' in v:
+                index['parameters'][k] = v.argPos
+
+        self.___argPos___ = index
+        return index
+
+
+    def invalidateArgPos(self):
+        """
+        @brief   Reset the argPos index and everything derived from it
+        """
+        object.__setattr__(self, '___argPos___', None)
+        object.__setattr__(self, '___fitDataMatrix___', None)
+
+
     def inputs_argPos(self, name):
         """
         @brief   Method mapping input argument position.
         """
+        index = self.argPosIndex()['inputs']
+        try:
+            return index[name]
+        except KeyError:
+            pass
+
         m = re.search('(.*)\[(.*=)?(.*)]', name)
         if m:
             try:
                 base = m.group(1)
-                return existsAndHasArgPos(self.surrogateFunction.inputs, base) \
-                    + self.surrogateFunction.inputs[base].index.get_index(m.group(3))
+                argPos = \
+                    existsAndHasArgPos(self.surrogateFunction.inputs, base) \
+                  + self.surrogateFunction.inputs[base].index.get_index(
+                        m.group(3)
+                    )
             except:
                 raise ArgPosNotFound('argPos for ' + name + ' not found in inputs')
         else:
             try:
-                return existsAndHasArgPos(self.inputs, name)
+                argPos = existsAndHasArgPos(self.inputs, name)
             except:
                 try:
-                    return existsAndHasArgPos(self.surrogateFunction.inputs, name)
+                    argPos = existsAndHasArgPos(
+                        self.surrogateFunction.inputs,
+                        name
+                    )
                 except:
                     raise ArgPosNotFound('argPos for ' + name + ' not found in inputs')
 
+        index[name] = argPos
+        return argPos
+
 
     def outputs_argPos(self, name):
         """
         @brief   Method mapping output argument positions.
         """
         try:
-            return existsAndHasArgPos(self.outputs, name)
-        except:
-            try:
-                return existsAndHasArgPos(
-                    self.surrogateFunction.outputs,
-                    name
-                )
-            except:
-                raise ArgPosNotFound('argPos for ' + name + ' not found in outputs')
+            return self.argPosIndex()['outputs'][name]
+        except KeyError:
+            raise ArgPosNotFound('argPos for ' + name + ' not found in outputs')
 
 
     def parameters_argPos(self, name):
@@ -1007,15 +1771,9 @@ class SurrogateModel(DynamicDocument):
         @brief   Mapping parameter argument position.
         """
         try:
-            return existsAndHasArgPos(self.parameters, name)
-        except:
-            try:
-                return existsAndHasArgPos(
-                    self.surrogateFunction.parameters,
-                    name
-                )
-            except:
-                raise ArgPosNotFound('argPos for ' + name + ' not found in parameters')
+            return self.argPosIndex()['parameters'][name]
+        except KeyError:
+            raise ArgPosNotFound('argPos for ' + name + ' not found in parameters')
 
 
     def calculate_maps(self, sm):
@@ -1051,9 +1809,10 @@ class SurrogateModel(DynamicDocument):
         minValues = [-9e99] * l
         maxValues = [9e99] * l
 
+        # A range of zero width is widened slightly
         for k, v in self.inputs.iteritems():
             minValues[self.inputs_argPos(k)] = v.min
-            maxValues[self.inputs_argPos(k)] = v.max
+            maxValues[self.inputs_argPos(k)] = max(v.max, v.min*1.000001)
 
         #print 'min =', minValues, 'max =', maxValues, 
         return minValues, maxValues, \
@@ -1062,11 +1821,112 @@ class SurrogateModel(DynamicDocument):
             self.surrogateFunction.parameters.keys()
 
 
+    def exportDescriptor(self, filename):
+        """
+        @brief   Write the model and its substitute models into a descriptor
+        @details
+                 The descriptor is a flat binary file read by
+                 modena_model_new_from_descriptor, so that compiled
+                 applications can evaluate the model without Python or a
+                 database connection. The file is written to a temporary
+                 location first and renamed, so that readers never see a
+                 partially written descriptor.
+        @param   filename (str) path of the descriptor
+        """
+        tmp = '%s.%i.tmp' % (filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(struct.pack('<8sI', DESCRIPTOR_MAGIC, DESCRIPTOR_VERSION))
+            self.writeDescriptorRecord(f)
+        os.rename(tmp, filename)
+
+
+    def writeDescriptorRecord(self, f):
+        """
+        @brief   Write the descriptor record of the model to the file f
+        @details
+                 All values are little-endian, sizes are unsigned 64-bit
+                 integers and strings are prefixed by their length as unsigned
+                 32-bit integer. A record holds, in this order:
+                   - _id, libraryName and functionName
+                   - inputs, outputs and parameters size of the function
+                   - inputs_internal_size followed by the min and max bounds
+                   - names of the inputs, outputs and parameters
+                   - parameter values
+                   - argPos tables of the inputs and outputs
+                   - substitute models as output and input maps followed by
+                     their own record
+        @param   f (file) file open for binary writing
+        """
+        sf = self.surrogateFunction
+        if len(self.parameters) != len(sf.parameters):
+            raise ParametersNotValid(
+                'Surrogate model does not have valid parameters', self
+            )
+
+        def writeSize(n):
+            f.write(struct.pack('<Q', n))
+
+        def writeString(s):
+            s = str(s)
+            f.write(struct.pack('<I', len(s)))
+            f.write(s)
+
+        def writeStrings(l):
+            writeSize(len(l))
+            for s in l:
+                writeString(s)
+
+        def writeDoubles(l):
+            writeSize(len(l))
+            f.write(struct.pack('<%id' % len(l), *l))
+
+        def writeSizes(l):
+            writeSize(len(l)/2)
+            f.write(struct.pack('<%iQ' % len(l), *l))
+
+        def writeTable(d):
+            writeSize(len(d))
+            for k, v in sorted(d.iteritems()):
+                writeString(k)
+                writeSize(v)
+
+        writeString(self._id)
+        writeString(os.path.abspath(sf.libraryName))
+        writeString(sf.functionName)
+        writeSize(len(sf.inputs))
+        writeSize(len(sf.outputs))
+        writeSize(len(sf.parameters))
+
+        minValues, maxValues, iNames, oNames, pNames = self.minMax()
+        writeDoubles(minValues)
+        writeDoubles(maxValues)
+        writeStrings(iNames)
+        writeStrings(oNames)
+        writeStrings(pNames)
+        writeDoubles(self.parameters)
+
+        index = self.argPosIndex()
+        writeTable(index['inputs'])
+        writeTable(index['outputs'])
+
+        writeSize(len(self.substituteModels))
+        for sm in self.substituteModels:
+            map_outputs, map_inputs = self.calculate_maps(sm)
+            writeSizes(map_outputs)
+            writeSizes(map_inputs)
+            sm.writeDescriptorRecord(f)
+
+
     def updateMinMax(self):
         """
         @brief   Update min and max bounds of the design and response space
+        @details
+                 The bounds are copied from the range of the samples, see
+                 currentSampleRange, i.e. the samples are not loaded.
         """
-        if not self.nSamples:
+        sampleRange = self.currentSampleRange()
+
+        if not sampleRange:
             for v in self.inputs.values():
                 v.min = 9e99
                 v.max = -9e99
@@ -1075,48 +1935,339 @@ class SurrogateModel(DynamicDocument):
                 v.min = 9e99
                 v.max = -9e99
 
+            return
+
         for k, v in self.inputs.iteritems():
-            v.min = min(self.fitData[k])
-            v.max = max(max(self.fitData[k]), v.min*1.000001)
+            v.min = sampleRange[k].min
+            v.max = sampleRange[k].max
 
         for k, v in self.outputs.iteritems():
-            v.min = min(self.fitData[k])
-            v.max = max(self.fitData[k])
+            v.min = sampleRange[k].min
+            v.max = sampleRange[k].max
 
 
-    def error(self, cModel, **kwargs):
+    def currentSampleRange(self):
         """
-        @brief Generate an iterator that yields the error
+        @brief   Return the range of the samples
+        @details
+                 sampleRange is maintained by appendSamples. Missing ranges,
+                 e.g. of models stored before sampleRange existed, are
+                 recomputed by recomputeMinMax.
+        @returns (dict) MinMaxOpt of every input and output, empty if there
+                 are no samples
+        """
+        if not self.nSamples:
+            return {}
 
-        @param cModel (modena_model_t)
-        @param idxGenerator 
-        @returns (iterator) iterator object
+        sampleRange = self.sampleRange or {}
+        if any(
+            k not in sampleRange or sampleRange[k].min is None
+         or sampleRange[k].max is None
+            for k in self.inputs.keys() + self.outputs.keys()
+        ):
+            sampleRange = self.recomputeMinMax()
+
+        return sampleRange
+
+
+    def recomputeMinMax(self):
         """
-        idxGenerator = kwargs.pop('idxGenerator', xrange(self.nSamples))
+        @brief   Recompute sampleRange from the sample store
+        @details
+                 The range of every input and output is computed by an
+                 aggregation in the database and stored in sampleRange.
+        @returns (dict) MinMaxOpt of every input and output
+        """
+        self.migrateFitData()
+
+        names = self.inputs.keys() + self.outputs.keys()
+        project = {}
+        group = { '_id': None }
+        for i, k in enumerate(names):
+            project['min%i' % i] = { '$min': '$data.%s' % k }
+            project['max%i' % i] = { '$max': '$data.%s' % k }
+            group['min%i' % i] = { '$min': '$min%i' % i }
+            group['max%i' % i] = { '$max': '$max%i' % i }
+
+        result = list(
+            SampleChunk._get_collection().aggregate([
+                { '$match': { 'model': self._id } },
+                { '$project': project },
+                { '$group': group },
+            ])
+        )
+        if not result:
+            return {}
+
+        sampleRange = dict(
+            (
+                k,
+                MinMaxOpt(
+                    min=result[0]['min%i' % i], max=result[0]['max%i' % i]
+                )
+            ) for i, k in enumerate(names)
+        )
+
+        doc = self._get_collection().find_one_and_update(
+            { '_id': self._id },
+            {
+                '$set': dict(
+                    ('sampleRange.%s' % k, v.to_mongo())
+                    for k, v in sampleRange.iteritems()
+                ),
+                '$inc': { 'version': 1 },
+            },
+            projection=['version'],
+            return_document=pymongo.ReturnDocument.BEFORE
+        )
+        self.sampleRange = sampleRange
+        self.unmarkChanged('sampleRange')
+        self.followVersion(doc.get('version', 0))
+
+        return sampleRange
+
+
+    def fitDataMatrix(self):
+        """
+        @brief    Return the fitting data as matrices for batch evaluation
+        @details
+                  The inputs are arranged in a (nSamples x inputs_size) matrix
+                  whose columns are ordered by argPos, i.e. every row can be
+                  passed to the surrogate model directly. The outputs are
+                  arranged in a (nSamples x nOutputs) matrix whose columns are
+                  ordered as the keys of 'outputs'. The matrices are cached
+                  until the number of samples changes.
+        @returns  (tuple) inputs and outputs as numpy.ndarray
+        """
+        fitData = self.fitData
+        cache = getattr(self, '___fitDataMatrix___', None)
+        if cache is not None and cache[0] == self.nSamples:
+            return cache[1], cache[2]
+
+        inputs = numpy.zeros(
+            (self.nSamples, self.surrogateFunction.inputs_size())
+        )
+        for k in self.inputs.keys():
+            inputs[:, self.inputs_argPos(k)] = fitData[k]
+
+        outputs = numpy.empty((self.nSamples, len(self.outputs)))
+        for j, k in enumerate(self.outputs.keys()):
+            outputs[:, j] = fitData[k]
+
+        self.___fitDataMatrix___ = (self.nSamples, inputs, outputs)
+        return inputs, outputs
+
+
+    def evaluator(self, parameters=None):
+        """
+        @brief    Instantiate the surrogate model for evaluation in Python
+        @details
+                  The backend of the model selects libmodena (modena_model_t)
+                  or NumPy (NumpyModel). Both take the same arguments when
+                  called.
+        @param    parameters (list) parameters, default those of the model
+        @returns  modena_model_t or NumpyModel
+        """
+        if self.backend == 'numpy':
+            return NumpyModel(self, parameters)
+        if parameters is None:
+            return modena.libmodena.modena_model_t(model=self)
+        return modena.libmodena.modena_model_t(
+            model=self, parameters=list(parameters)
+        )
+
+
+    def fitDataIndices(self, idxGenerator):
+        """
+        @brief    Convert indices of samples into an index array
+        @param    idxGenerator (iterable) indices of the samples, or None
+        @returns  (numpy.ndarray) indices, or None for all samples
+        """
+        if idxGenerator is None or isinstance(idxGenerator, numpy.ndarray):
+            return idxGenerator
+        return numpy.fromiter(idxGenerator, dtype=numpy.intp)
+
+
+    def sampleWeights(self, idxGenerator=None):
+        """
+        @brief    Weights of the samples in the fit
+        @details
+                  The weights are stored with the samples, see appendSamples.
+                  Samples without a weight have the weight 1.
+        @param    idxGenerator (iterable) indices of the samples, default all
+        @returns  (numpy.ndarray) weights, or None if all weights are 1
+        """
+        fitWeights = self.fitWeights
+        if not fitWeights:
+            return None
+
+        weights = numpy.ones(self.nSamples)
+        n = min(len(fitWeights), self.nSamples)
+        weights[:n] = fitWeights[:n]
+
+        idx = self.fitDataIndices(idxGenerator)
+        if idx is not None:
+            weights = weights[idx]
+        return weights
+
+
+    def errorMatrix(self, cModel, **kwargs):
+        """
+        @brief    Calculate the residuals of all outputs of a set of samples
+        @details
+                  All samples are passed to the surrogate model as a single
+                  matrix, i.e. the model is called once for all samples.
+
+        @param    cModel (modena_model_t|NumpyModel)
+        @param    idxGenerator (iterable) indices of the samples, default all
+        @param    checkBounds (bool) check the bounds of the model
+        @param    transform (str|list) see residualTransform
+        @returns  (numpy.ndarray) nSamples x nOutputs residuals, the columns
+                  are ordered as the keys of 'outputs'
+        """
+        return self.errorMatrixAndDerivative(cModel, **kwargs)[0]
+
+
+    def errorMatrixAndDerivative(self, cModel, **kwargs):
+        """
+        @brief    Calculate the residuals of all outputs and their derivatives
+                  with respect to the outputs of the surrogate model
+        @details
+                  See errorMatrix and residualTransform.
+        @returns  (tuple) residuals and derivatives as numpy.ndarray
+        """
+        idx = self.fitDataIndices(kwargs.pop('idxGenerator', None))
         checkBounds = kwargs.pop('checkBounds', True)
+        transform = kwargs.pop('transform', None)
 
-        i = [0] * self.surrogateFunction.inputs_size()
+        inputs, outputs = self.fitDataMatrix()
 
-        # TODO: Deal with multivalued functions
-        output = self.fitData[six.next(six.iterkeys(self.outputs))]
+        if idx is not None:
+            inputs = inputs[idx]
+            outputs = outputs[idx]
 
-        for idx in idxGenerator:
-            # Load inputs
-            for k, v in self.inputs.iteritems():
-                i[self.inputs_argPos(k)] = self.fitData[k][idx]
+        out = numpy.empty((inputs.shape[0], cModel.outputs_size))
+        if inputs.shape[0]:
+            with FitProfiler.evaluation(
+                'residualEvaluations', inputs.shape[0]
+            ):
+                cModel(inputs, checkBounds=checkBounds, outputs=out)
 
-            #print 'i = {', ', '.join('%s: %g' % (
-            #    k, self.fitData[k][idx]
-            #) for k in self.inputs.keys()), '}'
-            #print 'i =', str(i)
+        argPos = [self.outputs_argPos(k) for k in self.outputs.keys()]
+        return residualTransform(transform, outputs, out[:, argPos])
 
-            # Call the surrogate model
-            out = cModel(i, checkBounds= checkBounds)
 
-            #print '%i %g - %g = %g' % (
-            #    idx, out[0], output[idx], out[0] - output[idx]
-            #)
-            yield output[idx] - out[0]
+    def errorVector(self, cModel, **kwargs):
+        """
+        @brief    Calculate the stacked residuals of a set of samples
+        @details
+                  The residuals of errorMatrix are multiplied by the factor
+                  of their output (e.g. weight/scale) and the weight of their
+                  sample (see sampleWeights) and stacked sample by sample,
+                  i.e. the residual of output j of the i-th sample is element
+                  i*nOutputs + j.
+
+        @param    cModel (modena_model_t|NumpyModel)
+        @param    idxGenerator (iterable) indices of the samples, default all
+        @param    checkBounds (bool) check the bounds of the model
+        @param    transform (str|list) see residualTransform
+        @param    outputFactors (numpy.ndarray) factor of every output,
+                  ordered as the keys of 'outputs', default 1
+        @returns  (numpy.ndarray) residuals
+        """
+        outputFactors = kwargs.pop('outputFactors', None)
+        idx = self.fitDataIndices(kwargs.pop('idxGenerator', None))
+
+        R = self.errorMatrix(cModel, idxGenerator=idx, **kwargs)
+        if outputFactors is not None:
+            R = R*outputFactors
+
+        weights = self.sampleWeights(idx)
+        if weights is not None:
+            R = R*weights[:, numpy.newaxis]
+
+        return R.ravel()
+
+
+    def hasJacobian(self):
+        """
+        @brief    Check whether the evaluator provides analytic derivatives
+        @returns  (bool) True if errorJacobian may be used
+        """
+        return self.backend == 'C' \
+            and bool(getattr(self.surrogateFunction, 'jacobianName', None))
+
+
+    def errorJacobian(self, cModel, **kwargs):
+        """
+        @brief    Calculate the Jacobian of the residuals of errorVector
+        @details
+                  The derivatives of the surrogate function with respect to
+                  its parameters are evaluated for all samples in one call,
+                  see 'Jcode' of CFunction. The rows are ordered as the
+                  residuals of errorVector.
+
+        @param    cModel (modena_model_t)
+        @param    idxGenerator (iterable) indices of the samples, default all
+        @param    checkBounds (bool) check the bounds of the model
+        @param    transform (str|list) see residualTransform
+        @param    outputFactors (numpy.ndarray) see errorVector
+        @returns  (numpy.ndarray) (nSamples*nOutputs) x parameters_size
+                  derivatives
+        """
+        idx = self.fitDataIndices(kwargs.pop('idxGenerator', None))
+        checkBounds = kwargs.pop('checkBounds', True)
+        transform = kwargs.pop('transform', None)
+        outputFactors = kwargs.pop('outputFactors', None)
+
+        inputs, outputs = self.fitDataMatrix()
+
+        if idx is not None:
+            inputs = inputs[idx]
+
+        n = cModel.parameters_size
+        J = numpy.empty((inputs.shape[0], cModel.outputs_size*n))
+        if inputs.shape[0]:
+            with FitProfiler.evaluation(
+                'jacobianEvaluations', inputs.shape[0]
+            ):
+                cModel.jacobian(inputs, checkBounds=checkBounds, jacobian=J)
+
+        argPos = [self.outputs_argPos(k) for k in self.outputs.keys()]
+        J = J.reshape(inputs.shape[0], cModel.outputs_size, n)[:, argPos, :]
+
+        # Chain rule, the transforms only depend on the outputs
+        if transform is None or transform == 'absolute':
+            J = -J
+        else:
+            d = self.errorMatrixAndDerivative(
+                cModel,
+                idxGenerator=idx,
+                checkBounds=checkBounds,
+                transform=transform
+            )[1]
+            J = J*d[:, :, numpy.newaxis]
+
+        if outputFactors is not None:
+            J = J*numpy.asarray(outputFactors)[:, numpy.newaxis]
+
+        weights = self.sampleWeights(idx)
+        if weights is not None:
+            J = J*weights[:, numpy.newaxis, numpy.newaxis]
+
+        return J.reshape(-1, n)
+
+
+    def error(self, cModel, **kwargs):
+        """
+        @brief Generate an iterator that yields the error
+
+        @param cModel (modena_model_t|NumpyModel)
+        @param idxGenerator 
+        @returns (iterator) iterator object
+        """
+        for e in self.errorVector(cModel, **kwargs):
+            yield e
 
 
     def __getattribute__(self, name):
@@ -1131,6 +2282,15 @@ class SurrogateModel(DynamicDocument):
             return super(SurrogateModel, self).__getattribute__(name)
 
 
+    def __setattr__(self, name, value):
+        """Modified magic method. Invalidate the argPos index when the
+        inputs, the surrogate function or the substitute models are replaced.
+        """
+        if name in ('inputs', 'surrogateFunction', 'substituteModels'):
+            self.invalidateArgPos()
+        super(SurrogateModel, self).__setattr__(name, value)
+
+
     def __setattribute__(self, name, value):
         """Modified magic method. Call __setattribute__ from parent class, i.e.
         DynamocDocument, when accessing instance variables not starting with
@@ -1151,10 +2311,104 @@ class SurrogateModel(DynamicDocument):
             k: oPoint[self.inputs_argPos(k)] for k in self.inputs.keys()
         }
         self.outsidePoint = EmbDoc(**oPointDict)
-        self.save()
+        self.outsidePoints = [ self.outsidePoint ]
+        self.updateOutsidePoints()
+        return 200
+
+
+    def exceptionOutOfBoundsBatch(self, oPoints):
+        """
+        @brief   Store all points collected outside the bounds of the model
+        @details
+                 Called by libmodena when the points collected in
+                 MODENA_OUTSIDE_COLLECT mode are written. The first point is
+                 stored in outsidePoint as well, so that strategies that only
+                 handle a single point keep working.
+        @param   oPoints (list) input vectors outside the bounds
+        @returns (int) error code
+        """
+        self.outsidePoints = [
+            EmbDoc(**{
+                k: oPoint[self.inputs_argPos(k)] for k in self.inputs.keys()
+            }) for oPoint in oPoints
+        ]
+        self.outsidePoint = self.outsidePoints[0]
+        self.updateOutsidePoints()
         return 200
 
 
+    def updateOutsidePoints(self):
+        """
+        @brief   Store outsidePoint and outsidePoints with an atomic $set
+        @details
+                 Only these fields are written, so that the update does not
+                 overwrite changes of other tasks (see commitParameters).
+        """
+        outsidePoint = self.outsidePoint.to_mongo().to_dict()
+        outsidePoints = [p.to_mongo().to_dict() for p in self.outsidePoints]
+        self.unmarkChanged('outsidePoint', 'outsidePoints')
+
+        deferred = SurrogateModel.deferredOutsidePoints
+        if deferred is not None:
+            deferred.append((self._id, outsidePoint, outsidePoints))
+            return
+
+        self.followVersion(
+            SurrogateModel.storeOutsidePoints(
+                self._id, outsidePoint, outsidePoints
+            )
+        )
+
+
+    @classmethod
+    def storeOutsidePoints(cls, modelId, outsidePoint, outsidePoints):
+        """
+        @brief   Store outside points of a model with an atomic $set
+        @param   modelId (str) _id of the model
+        @param   outsidePoint (dict) point outside the bounds
+        @param   outsidePoints (list) all points outside the bounds
+        @returns (int) version of the model before the update
+        """
+        doc = cls._get_collection().find_one_and_update(
+            { '_id': modelId },
+            {
+                '$set': {
+                    'outsidePoint': outsidePoint,
+                    'outsidePoints': outsidePoints,
+                },
+                '$inc': { 'version': 1 },
+            },
+            projection=['version'],
+            return_document=pymongo.ReturnDocument.BEFORE
+        )
+        return doc.get('version', 0) if doc else 0
+
+
+    @classmethod
+    def deferOutsidePoints(cls):
+        """
+        @brief   Hold back outside points instead of storing them
+        @details
+                 Used in the worker processes of fitEach, which must not use
+                 the database connection inherited from the parent process.
+                 The points are returned by takeDeferredOutsidePoints and
+                 stored by the parent with storeOutsidePoints.
+        """
+        SurrogateModel.deferredOutsidePoints = []
+
+
+    @classmethod
+    def takeDeferredOutsidePoints(cls):
+        """
+        @brief   Return and clear the outside points held back
+        @returns (list) tuples of the arguments of storeOutsidePoints
+        """
+        deferred = SurrogateModel.deferredOutsidePoints or []
+        if SurrogateModel.deferredOutsidePoints is not None:
+            SurrogateModel.deferredOutsidePoints = []
+        return deferred
+
+
     @classmethod
     def exceptionLoad(cls, surrogateModelId):
         """
@@ -1192,7 +2446,7 @@ class SurrogateModel(DynamicDocument):
         """
         #print 'In callModel', self._id
         # Instantiate the surrogate model
-        cModel = modena.libmodena.modena_model_t(model=self)
+        cModel = self.evaluator()
 
         i = [0] * self.surrogateFunction.inputs_size()
 
@@ -1220,35 +2474,293 @@ class SurrogateModel(DynamicDocument):
 
     def updateFitDataFromFwSpec(self, fw_spec):
         """
-        @brief   Updating parameters of the surrogate model
+        @brief   Append the samples in fw_spec to the fitting data
+        @details
+                 The values of every input and output are taken from fw_spec
+                 and appended in one batch, see appendSamples. The weight of
+                 the new samples may be given as 'fitWeight'. All samples are
+                 loaded afterwards, i.e. including those of other tasks.
         """
-        # Load the fitting data
-        # Removed temporarily, probably bug in mongo engine
-
-        #  %%%
-        #  %%%
-        #  %%%
-        # %%%%%
-        #  %%%
-        #   %
-        #if not self["fitData"]:
-        #    self.reload("fitData")
-
-        for k, v in self.inputs.iteritems():
+        samples = {}
+        for k in self.inputs.keys() + self.outputs.keys():
             if fw_spec[k][0].__class__ == list:
-                self["fitData"][k].extend(fw_spec[k][0])
+                samples[k] = fw_spec[k][0]
             else:
-                self.fitData[k].extend(fw_spec[k])
+                samples[k] = fw_spec[k]
 
-        for k in self.outputs:
-            if fw_spec[k][0].__class__ == list:
-                self.fitData[k].extend(fw_spec[k][0])
-            else:
-                self.fitData[k].extend(fw_spec[k])
+        self.appendSamples(samples, fw_spec.get('fitWeight'))
+        self.loadFitData()
+
+
+    @property
+    def fitData(self):
+        """
+        @brief   Samples of the model, loaded on first use
+        @details
+                 dict of lists of the values of every input and output. The
+                 samples are not part of the model document, see
+                 loadFitData.
+        """
+        if getattr(self, '___fitData___', None) is None:
+            self.loadFitData()
+        return self.___fitData___
+
+
+    @property
+    def fitWeights(self):
+        """
+        @brief   Weights of the samples, empty if all weights are 1
+        """
+        if getattr(self, '___fitData___', None) is None:
+            self.loadFitData()
+        return self.___fitWeights___
+
+
+    def loadFitData(self):
+        """
+        @brief   Load the samples from the sample store
+        @details
+                 The chunks of the model (see SampleChunk) are concatenated
+                 in the order of their _id. A chunk is inserted before
+                 nSamples of the model is incremented (see appendSamples),
+                 so that at least nSamples samples are found. More samples
+                 are found if samples were appended since the model was
+                 loaded. They are used, and nSamples is set to the number of
+                 samples loaded. Fewer samples mean that samples were lost,
+                 which raises an exception.
+        """
+        self.migrateFitData()
+
+        names = self.inputs.keys() + self.outputs.keys()
+        fitData = dict((k, []) for k in names)
+        fitWeights = []
+        for chunk in SampleChunk._get_collection().find(
+            { 'model': self._id }, sort=[('_id', pymongo.ASCENDING)]
+        ):
+            n = len(six.next(six.itervalues(chunk['data'])))
+            for k in names:
+                fitData[k].extend(chunk['data'][k])
+            fitWeights.extend(chunk.get('weights') or [1.0]*n)
+
+        if all(w == 1.0 for w in fitWeights):
+            fitWeights = []
+
+        nSamples = len(six.next(six.itervalues(fitData)))
+        if nSamples < (self.nSamples or 0):
+            raise Exception(
+                'Model %s has %i samples, but only %i were found' % (
+                    self._id, self.nSamples, nSamples
+                )
+            )
+        elif nSamples > (self.nSamples or 0):
+            print(
+                'Model %s: %i samples were appended by other tasks' % (
+                    self._id, nSamples - (self.nSamples or 0)
+                )
+            )
+
+        self.___fitData___ = fitData
+        self.___fitWeights___ = fitWeights
+        self.___fitDataMatrix___ = None
+        self.nSamples = nSamples
+        self.unmarkChanged('nSamples')
+
+
+    def loadFitCache(self):
+        """
+        @brief   Load the residuals and Jacobian of the last fit
+        @returns (dict) see FitCache, or None if there is none
+        """
+        return FitCache._get_collection().find_one({ '_id': self._id })
+
+
+    def storeFitCache(self, cache):
+        """
+        @brief   Replace the residuals and Jacobian of the last fit
+        @details
+                 A cache exceeding the size limit of a document is dropped.
+        @param   cache (dict) see FitCache
+        """
+        collection = FitCache._get_collection()
+        cache = dict(cache, _id=self._id)
+        try:
+            collection.replace_one({ '_id': self._id }, cache, upsert=True)
+        except pymongo.errors.DocumentTooLarge:
+            collection.delete_one({ '_id': self._id })
 
-        # Get first set
-        firstSet = six.next(six.itervalues(self.fitData))
-        self.nSamples = len(firstSet)
+
+    def migrateFitData(self):
+        """
+        @brief   Move samples stored in the model document to the sample store
+        @details
+                 Earlier versions stored the samples in the field 'fitData'
+                 of the model (legacyFitData). They become the first chunk
+                 and are removed from the model. The chunk has a fixed _id,
+                 so that concurrent migrations insert it only once.
+        """
+        collection = self._get_collection()
+        doc = collection.find_one(
+            { '_id': self._id, 'fitData': { '$exists': True } },
+            projection=['fitData']
+        )
+        if doc is None:
+            return
+
+        data = doc['fitData']
+        if data and len(six.next(six.itervalues(data))):
+            try:
+                SampleChunk._get_collection().insert_one({
+                    '_id': '%s/fitData' % self._id,
+                    'model': self._id,
+                    'data': data,
+                })
+            except pymongo.errors.DuplicateKeyError:
+                pass
+
+        # The range of the migrated samples, see appendSamples
+        update = { '$unset': { 'fitData': '' } }
+        columns = dict((k, v) for k, v in (data or {}).iteritems() if v)
+        if columns:
+            update['$min'] = dict(
+                ('sampleRange.%s.min' % k, min(v))
+                for k, v in columns.iteritems()
+            )
+            update['$max'] = dict(
+                ('sampleRange.%s.max' % k, max(v))
+                for k, v in columns.iteritems()
+            )
+        collection.update_one({ '_id': self._id }, update)
+
+
+    def appendSamples(self, samples, fitWeight=None):
+        """
+        @brief   Append a batch of samples to the sample store
+        @details
+                 The samples are inserted as one chunk (see SampleChunk).
+                 Afterwards one atomic update of the model increments
+                 nSamples and the version and extends sampleRange with $min
+                 and $max, i.e. any number of samples takes two round trips.
+                 Since the chunk is inserted first, nSamples never counts
+                 samples that cannot be loaded, see loadFitData. The samples
+                 are not loaded, fitData is reloaded on its next use.
+        @param   samples (dict|list) lists of the values of every input and
+                 output, or a list of dicts holding one sample each
+        @param   fitWeight (float) weight of the new samples, see
+                 sampleWeights
+        """
+        names = self.inputs.keys() + self.outputs.keys()
+        if isinstance(samples, dict):
+            columns = dict(
+                (k, [float(x) for x in samples[k]]) for k in names
+            )
+        else:
+            columns = dict(
+                (k, [float(row[k]) for row in samples]) for k in names
+            )
+
+        n = len(columns[names[0]])
+        if any(len(v) != n for v in columns.itervalues()):
+            raise Exception('All inputs and outputs need %i samples' % n)
+        if not n:
+            return
+
+        self.migrateFitData()
+
+        chunk = { 'model': self._id, 'data': columns }
+        if fitWeight is not None:
+            chunk['weights'] = [float(fitWeight)]*n
+        SampleChunk._get_collection().insert_one(chunk)
+
+        update = {
+            '$inc': { 'nSamples': n, 'version': 1 },
+            '$min': {},
+            '$max': {},
+        }
+        for k, v in columns.iteritems():
+            update['$min']['sampleRange.%s.min' % k] = min(v)
+            update['$max']['sampleRange.%s.max' % k] = max(v)
+
+        doc = self._get_collection().find_one_and_update(
+            { '_id': self._id },
+            update,
+            projection=['nSamples', 'version', 'sampleRange'],
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+
+        self.followVersion(doc['version'] - 1)
+        self.sampleRange = dict(
+            (k, MinMaxOpt(**v)) for k, v in doc['sampleRange'].iteritems()
+        )
+        self.nSamples = doc['nSamples']
+        self.___fitData___ = None
+        self.___fitDataMatrix___ = None
+        self.unmarkChanged('nSamples', 'sampleRange')
+
+
+    def commitParameters(self, parameters):
+        """
+        @brief   Store new parameters unless another task changed the model
+        @details
+                 The parameters and the bounds of the inputs and outputs (see
+                 updateMinMax) are written by one atomic update that only
+                 matches the version of the model that was loaded, and the
+                 version is incremented. Hence, of two tasks fitting the same
+                 version only the first one succeeds.
+        @param   parameters (list) new parameters
+        @returns (bool) True if the parameters were stored
+        """
+        self.updateMinMax()
+
+        fields = { 'parameters': list(parameters) }
+        for name in ('inputs', 'outputs'):
+            for k, v in self[name].iteritems():
+                fields['%s.%s.min' % (name, k)] = v.min
+                fields['%s.%s.max' % (name, k)] = v.max
+
+        # Documents stored before versioning have no version
+        version = self.version or 0
+        result = self._get_collection().update_one(
+            {
+                '_id': self._id,
+                'version': version if version else { '$in': [0, None] }
+            },
+            { '$set': fields, '$inc': { 'version': 1 } }
+        )
+        if not result.matched_count:
+            return False
+
+        self.parameters = list(parameters)
+        self.version = version + 1
+        self.unmarkChanged('parameters', 'inputs', 'outputs', 'version')
+        return True
+
+
+    def followVersion(self, version):
+        """
+        @brief   Account for an atomic update that incremented the version
+        @details
+                 The model stays up to date only if the version before the
+                 update was the one loaded. Otherwise another task changed
+                 the model in between and commitParameters has to fail.
+        @param   version (int) version before the update
+        """
+        if version == (self.version or 0):
+            self.version = version + 1
+            self.unmarkChanged('version')
+
+
+    def unmarkChanged(self, *names):
+        """
+        @brief   Exclude fields that were written atomically from save()
+        @details
+                 save() writes all changed fields, which would overwrite
+                 concurrent updates of fields written by appendSamples,
+                 commitParameters and updateOutsidePoints.
+        @param   names (str) names of the fields
+        """
+        self._changed_fields = [
+            f for f in self._changed_fields if f.split('.')[0] not in names
+        ]
 
 
     def initialisationStrategy(self):
@@ -1309,7 +2821,6 @@ class SurrogateModel(DynamicDocument):
             print " "*8 + inp + " = " + "[ %g, %g ]" %(mmp["min"], mmp["max"]) + " \subset " + "[ %g, %g ]" %(self.surrogateFunction.inputs[inp]["min"], self.surrogateFunction.inputs[inp]["max"])
 
 
-            self.reload("fitData")
         print
         print "Outputs:"
         for (inp, mmp) in self.outputs.iteritems():
@@ -1324,12 +2835,157 @@ class SurrogateModel(DynamicDocument):
         @brief     Load SurrogateModel from database by "_id"
         @parameter surrogateModelId string _id field of the surrogate model
         @details
-                   The load method excludes the 'fitData' field of the SM in
-                   order to reduce the network traffic.
+                   The samples are not loaded, see fitData, so that the size
+                   of the model does not depend on the number of samples.
+                   Models are cached within the process, see ModelCache.
+        @return    Surrogate Model
+        """
+        return cls.cachedLoad(
+            'load',
+            surrogateModelId,
+            lambda: cls.objects.exclude('legacyFitData').get(
+                _id=surrogateModelId
+            )
+        )
+
+
+    @classmethod
+    def cachedLoad(cls, kind, surrogateModelId, loader):
+        """
+        @brief     Return a model from the process cache or load it
+        @parameter kind (str) kind of load, e.g. 'load' or 'loadView'
+        @parameter surrogateModelId string _id field of the surrogate model
+        @parameter loader (function) loading the model from the database
         @return    Surrogate Model
         """
-        #return cls.objects.exclude('fitData').get(_id=surrogateModelId)
-        return cls.objects.get( _id=surrogateModelId )
+        collection = cls._get_collection()
+        if MODENA_MODEL_CACHE_WATCH:
+            modelCache.watch(collection)
+
+        key = (kind, surrogateModelId)
+        model = modelCache.get(key, collection)
+        if model is None:
+            model = loader()
+            modelCache.put(key, model)
+        return model
+
+
+    @classmethod
+    def loadView(cls, surrogateModelId):
+        """
+        @brief     Load a read-only SurrogateModel for evaluation
+        @parameter surrogateModelId string _id field of the surrogate model
+        @details
+                   Only the fields needed to evaluate the model (viewFields)
+                   are fetched. The tree of substitute models is loaded with
+                   one query per level, followed by one query for all their
+                   surrogate functions, and the references are replaced by
+                   the loaded documents, i.e. they are not dereferenced one
+                   by one. Used by libmodena to instantiate models. Views
+                   are cached within the process, see ModelCache.
+        @return    Surrogate Model, save() raises an exception
+        """
+        return cls.cachedLoad(
+            'loadView',
+            surrogateModelId,
+            lambda: cls.loadViewTree(surrogateModelId)
+        )
+
+
+    @classmethod
+    def loadViewTree(cls, surrogateModelId):
+        """
+        @brief     Load the view of a model and its substitute models
+        @details
+                   See loadView.
+        """
+        def refId(ref):
+            return getattr(ref, 'id', ref)
+
+        docs = {}
+        level = [surrogateModelId]
+        while level:
+            for doc in cls._get_collection().find(
+                { '_id': { '$in': level } }, projection=cls.viewFields
+            ):
+                docs[doc['_id']] = doc
+
+            level = list(set(
+                refId(ref)
+                for doc in docs.itervalues()
+                for ref in doc.get('substituteModels', [])
+                if refId(ref) not in docs
+            ) - set(level))
+
+        if surrogateModelId not in docs:
+            raise cls.DoesNotExist(
+                'Surrogate model %s does not exist' % surrogateModelId
+            )
+
+        functions = dict(
+            (doc['_id'], SurrogateFunction._from_son(doc))
+            for doc in SurrogateFunction._get_collection().find({
+                '_id': {
+                    '$in': list(set(
+                        refId(doc['surrogateFunction'])
+                        for doc in docs.itervalues()
+                    ))
+                }
+            })
+        )
+
+        models = dict(
+            (k, SurrogateModel._from_son(doc)) for k, doc in docs.iteritems()
+        )
+        for m in models.itervalues():
+            # Unresolved references stay in place as usual in mongoengine
+            ref = m._data['surrogateFunction']
+            m._data['surrogateFunction'] = functions.get(refId(ref), ref)
+            m._data['substituteModels'] = [
+                models.get(refId(modelRef), modelRef)
+                for modelRef in m._data.get('substituteModels') or []
+            ]
+            m.invalidateArgPos()
+            m.___readOnly___ = True
+
+        return models[surrogateModelId]
+
+
+    def save(self, *args, **kwargs):
+        """
+        @brief     Save the model, unless it was loaded by loadView
+        @details
+                   The version is incremented by the same update that writes
+                   the changes, and the update only matches the version that
+                   was loaded (see commitParameters and ModelCache).
+                   ConcurrentUpdate is raised if another task changed the
+                   model in between. Nothing is written if no field changed.
+        """
+        if getattr(self, '___readOnly___', False):
+            raise Exception(
+                'Model %s was loaded by loadView and is read-only' % self._id
+            )
+
+        if self._created:
+            return super(SurrogateModel, self).save(*args, **kwargs)
+
+        # Nothing to write, the version must not change (see ModelCache)
+        if not self._get_changed_fields():
+            return self
+
+        # Documents stored before versioning have no version
+        version = self.version or 0
+        kwargs['save_condition'] = \
+            { 'version': version } if version \
+            else { 'version__in': [0, None] }
+        self.version = version + 1
+        try:
+            return super(SurrogateModel, self).save(*args, **kwargs)
+        except SaveConditionError:
+            self.version = version
+            raise ConcurrentUpdate(
+                'Model %s was changed by another task' % self._id
+            )
 
 
     @classmethod
@@ -1341,7 +2997,9 @@ class SurrogateModel(DynamicDocument):
         #return self.objects(
         #    __raw__={'outsidePoint': { '$exists': True}}
         #).exclude('fitData').first()
-        return cls.objects(__raw__={'outsidePoint': {'$exists':True} }).first()
+        return cls.objects(
+            __raw__={'outsidePoint': {'$exists':True} }
+        ).exclude('legacyFitData').first()
 
 
     @classmethod
@@ -1367,7 +3025,9 @@ class SurrogateModel(DynamicDocument):
         """
         @brief   Method importing a surrogate model module.
         """
-        return cls.objects( __raw__={ 'parameters': { '$size': 0 } } ).first()
+        return cls.objects(
+            __raw__={ 'parameters': { '$size': 0 } }
+        ).exclude('legacyFitData').first()
 
 
     @classmethod
@@ -1432,9 +3092,9 @@ class BackwardMappingModel(SurrogateModel):
     # Database definition
     inputs = IOP(EmbeddedDocumentField(MinMaxArgPosOpt))
     outputs = MapField(EmbeddedDocumentField(MinMaxArgPosOpt))
-    fitData = MapField(ListField(FloatField(required=True)))
     substituteModels = ListField(ReferenceField(SurrogateModel))
     outsidePoint = EmbeddedDocumentField(EmbDoc)
+    outsidePoints = ListField(EmbeddedDocumentField(EmbDoc))
     meta = {'allow_inheritance': True}
 
 
@@ -44,9 +44,9 @@ MODENA_INSTALL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 MODENA_WORKING_DIR = os.path.realpath(os.getcwd())
 
 from Strategy import BackwardMappingScriptTask, ModenaFireTask
-from SurrogateModel import CFunction, IndexSet, \
+from SurrogateModel import CFunction, Function, IndexSet, \
     SurrogateModel, ForwardMappingModel, BackwardMappingModel, \
-    ModenaFireTask, MODENA_PARSED_URI
+    ModenaFireTask, MODENA_PARSED_URI, parallelCompile
 
 def find_module(target, startsearch=MODENA_WORKING_DIR):
     """Function recursively searching through the file tree for "target"
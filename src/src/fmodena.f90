@@ -43,6 +43,16 @@ module fmodena !command line arguments not implemented yet
 
     implicit none
 
+    ! Memory layout of the arrays passed to modena_model_call_batch. An array
+    ! x(inputs_size,npoints) is stored in MODENA_ROW_MAJOR order. The indices
+    ! returned in outofbounds are zero-based.
+    integer(c_int), parameter :: MODENA_ROW_MAJOR = 0
+    integer(c_int), parameter :: MODENA_COLUMN_MAJOR = 1
+
+    ! Handling of points outside the bounds, see modena_model_set_outside_mode
+    integer(c_int), parameter :: MODENA_OUTSIDE_FAIL_FAST = 0
+    integer(c_int), parameter :: MODENA_OUTSIDE_COLLECT = 1
+
     interface
         function modena_inputs_new(model) result(inputs) bind(c)
             import
@@ -99,6 +109,16 @@ module fmodena !command line arguments not implemented yet
             character(c_char) :: model_name(*)
             type(c_ptr) :: model
         end function modena_model_new
+        function modena_model_new_from_descriptor(filename) result(model) bind(c)
+            import
+            character(c_char) :: filename(*)
+            type(c_ptr) :: model
+        end function modena_model_new_from_descriptor
+        function modena_model_clone(model) result(clone) bind(c)
+            import
+            type(c_ptr), value :: model
+            type(c_ptr) :: clone
+        end function modena_model_clone
         function modena_model_call(model,inputs,outputs) result(ret) bind(c)
             import
             type(c_ptr), value :: model
@@ -106,6 +126,74 @@ module fmodena !command line arguments not implemented yet
             type(c_ptr), value :: outputs
             integer(c_int) :: ret
         end function modena_model_call
+        function modena_model_call_batch(model,npoints,layout,inputs,outputs,outofbounds,noutofbounds) result(ret) bind(c)
+            import
+            type(c_ptr), value :: model
+            integer(c_size_t), value :: npoints
+            integer(c_int), value :: layout
+            real(c_double) :: inputs(*)
+            real(c_double) :: outputs(*)
+            integer(c_size_t) :: outofbounds(*)
+            integer(c_size_t) :: noutofbounds
+            integer(c_int) :: ret
+        end function modena_model_call_batch
+        subroutine modena_model_call_batch_no_check(model,npoints,layout,inputs,outputs) bind(c)
+            import
+            type(c_ptr), value :: model
+            integer(c_size_t), value :: npoints
+            integer(c_int), value :: layout
+            real(c_double) :: inputs(*)
+            real(c_double) :: outputs(*)
+        end subroutine modena_model_call_batch_no_check
+        function modena_workspace_new(model) result(workspace) bind(c)
+            import
+            type(c_ptr), value :: model
+            type(c_ptr) :: workspace
+        end function modena_workspace_new
+        subroutine modena_workspace_destroy(workspace) bind(c)
+            import
+            type(c_ptr), value :: workspace
+        end subroutine modena_workspace_destroy
+        function modena_model_call_r(model,workspace,inputs,outputs) result(ret) bind(c)
+            import
+            type(c_ptr), value :: model
+            type(c_ptr), value :: workspace
+            type(c_ptr), value :: inputs
+            type(c_ptr), value :: outputs
+            integer(c_int) :: ret
+        end function modena_model_call_r
+        function modena_model_has_jacobian(model) result(output) bind(c)
+            import
+            type(c_ptr), value :: model
+            logical(c_bool) :: output
+        end function modena_model_has_jacobian
+        function modena_model_call_jacobian(model,inputs,jacobian) result(ret) bind(c)
+            import
+            type(c_ptr), value :: model
+            type(c_ptr), value :: inputs
+            real(c_double) :: jacobian(*)
+            integer(c_int) :: ret
+        end function modena_model_call_jacobian
+        function modena_flush_outside_points() result(ret) bind(c)
+            import
+            integer(c_int) :: ret
+        end function modena_flush_outside_points
+        subroutine modena_model_set_outside_mode(model,mode,tolerance) bind(c)
+            import
+            type(c_ptr), value :: model
+            integer(c_int), value :: mode
+            real(c_double), value :: tolerance
+        end subroutine modena_model_set_outside_mode
+        function modena_model_outside_points_size(model) result(n) bind(c)
+            import
+            type(c_ptr), value :: model
+            integer(c_size_t) :: n
+        end function modena_model_outside_points_size
+        function modena_model_write_outside_points(model) result(ret) bind(c)
+            import
+            type(c_ptr), value :: model
+            integer(c_int) :: ret
+        end function modena_model_write_outside_points
         function modena_error_occurred() result(output) bind(c)
             import
             logical(c_bool) :: output
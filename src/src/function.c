@@ -35,44 +35,65 @@ License
 
 PyObject *modena_SurrogateFunction = NULL;
 
-void modena_function_load_library(modena_function_t* self)
+static void modena_function_open_library
+(
+    modena_function_t* self,
+    const char *libraryName,
+    const char *functionName
+)
 {
-    PyObject *pFunctionName =
-        PyObject_GetAttrString(self->pFunction, "functionName");
-    if(!pFunctionName){ Modena_PyErr_Print(); }
-
-    PyObject *pLibraryName =
-        PyObject_GetAttrString(self->pFunction, "libraryName");
-    if(!pLibraryName){ Modena_PyErr_Print(); }
-
-    self->handle = lt_dlopen(PyString_AsString(pLibraryName));
+    self->handle = lt_dlopen(libraryName);
 
     if(!self->handle)
     {
         Modena_Error_Print
         (
            "lt_dlopen: Could not open library %s\nlt_dlopen: %s",
-           PyString_AsString(pLibraryName),
+           libraryName,
            lt_dlerror()
         );
         exit(1);
     }
 
-    self->function = lt_dlsym(self->handle, PyString_AsString(pFunctionName));
+    self->function = lt_dlsym(self->handle, functionName);
     if(!self->function)
     {
         Modena_Error_Print
         (
             "lt_dlsym: Could not find function %s in library %s"
             "lt_dlsym: %s",
-            PyString_AsString(pFunctionName),
-            PyString_AsString(pLibraryName),
+            functionName,
+            libraryName,
             lt_dlerror()
         );
         lt_dlclose(self->handle);
         exit(1);
     }
 
+    // The Jacobian is optional
+    char *jacobianName = malloc(strlen(functionName) + 10);
+    sprintf(jacobianName, "%s_jacobian", functionName);
+    self->jacobian = lt_dlsym(self->handle, jacobianName);
+    free(jacobianName);
+}
+
+void modena_function_load_library(modena_function_t* self)
+{
+    PyObject *pFunctionName =
+        PyObject_GetAttrString(self->pFunction, "functionName");
+    if(!pFunctionName){ Modena_PyErr_Print(); }
+
+    PyObject *pLibraryName =
+        PyObject_GetAttrString(self->pFunction, "libraryName");
+    if(!pLibraryName){ Modena_PyErr_Print(); }
+
+    modena_function_open_library
+    (
+        self,
+        PyString_AsString(pLibraryName),
+        PyString_AsString(pFunctionName)
+    );
+
     Py_DECREF(pFunctionName);
     Py_DECREF(pLibraryName);
 
@@ -188,6 +209,33 @@ modena_function_t *modena_function_new_from_model
     return self;
 }
 
+modena_function_t *modena_function_new_from_library
+(
+    const char *libraryName,
+    const char *functionName,
+    const size_t inputs_size,
+    const size_t outputs_size,
+    const size_t parameters_size
+)
+{
+    modena_function_t *self = malloc(sizeof(modena_function_t));
+
+    if(lt_dlinit())
+    {
+        Modena_Error_Print("lt_dlinit: %s", lt_dlerror());
+        exit(1);
+    }
+
+    self->pFunction = NULL;
+    self->inputs_size = inputs_size;
+    self->outputs_size = outputs_size;
+    self->parameters_size = parameters_size;
+
+    modena_function_open_library(self, libraryName, functionName);
+
+    return self;
+}
+
 modena_index_set_t *modena_function_get_index_set
 (
     const modena_function_t* self,
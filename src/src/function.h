@@ -92,6 +92,15 @@ typedef struct modena_function_t
         double *o
     );
 
+    /** Derivatives of the outputs with respect to the parameters, exported
+     *  by the library as <functionName>_jacobian. NULL if not available. */
+    void (*jacobian)
+    (
+        const struct modena_model_t* model,
+        const double* i,
+        double *J
+    );
+
 } modena_function_t;
 
 modena_function_t *modena_function_new
@@ -104,6 +113,15 @@ modena_function_t *modena_function_new_from_model
     const struct modena_model_t *self
 );
 
+modena_function_t *modena_function_new_from_library
+(
+    const char *libraryName,
+    const char *functionName,
+    const size_t inputs_size,
+    const size_t outputs_size,
+    const size_t parameters_size
+);
+
 modena_index_set_t *modena_function_get_index_set
 (
     const modena_function_t* self,
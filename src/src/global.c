@@ -88,7 +88,8 @@ struct modena_errordesc
     { MODENA_SUCCESS, "No error" },
     { MODENA_MODEL_NOT_FOUND, "Surrogate model not found in database" },
     { MODENA_FUNCTION_NOT_FOUND, "Surrogate function not found in database" },
-    { MODENA_INDEX_SET_NOT_FOUND, "Index set not found in database" }
+    { MODENA_INDEX_SET_NOT_FOUND, "Index set not found in database" },
+    { MODENA_DESCRIPTOR_NOT_VALID, "Model descriptor could not be read" }
 };
 
 const char* modena_error_message(int error_code)
@@ -105,7 +106,18 @@ static PyMethodDef module_methods[] = {
 #endif
 
 // TODO: Support non-Gcc compilers here
-PyMODINIT_FUNC initlibmodena(void) __attribute__((constructor));
+static void modena_init(void) __attribute__((constructor));
+
+static void modena_init(void)
+{
+    // Models are loaded from descriptors, the interpreter is started on demand
+    if(getenv("MODENA_DESCRIPTOR_DIR"))
+    {
+        return;
+    }
+
+    initlibmodena();
+}
 
 PyMODINIT_FUNC initlibmodena(void)
 {
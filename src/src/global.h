@@ -88,6 +88,7 @@ enum modena_error_t
     MODENA_MODEL_NOT_FOUND,
     MODENA_FUNCTION_NOT_FOUND,
     MODENA_INDEX_SET_NOT_FOUND,
+    MODENA_DESCRIPTOR_NOT_VALID,
     MODENA_MODEL_LAST
 };
 
@@ -113,6 +114,9 @@ INLINE_FUN int modena_error()
 
 #endif /* HAVE_INLINE */
 
+// Initialises the Python interpreter and the libmodena module
+PyMODINIT_FUNC initlibmodena(void);
+
 // Returns error message for error code
 const char* modena_error_message(int error_code);
 
@@ -31,9 +31,32 @@ License
 #include "model.h"
 #include "structmember.h"
 #include "global.h"
+#include <stdint.h>
+#include <string.h>
+#include <unistd.h>
+#include <pthread.h>
+#include <math.h>
+#include <float.h>
 
 PyObject *modena_SurrogateModel = NULL;
 
+/* Points found outside the bounds by modena_model_call_r, waiting to be
+ * reported by modena_flush_outside_points
+ */
+typedef struct modena_outside_point_t
+{
+    modena_model_t *model;
+
+    modena_inputs_t *inputs;
+
+    struct modena_outside_point_t *next;
+
+} modena_outside_point_t;
+
+static modena_outside_point_t *modena_outside_points = NULL;
+
+static pthread_mutex_t modena_outside_points_mutex = PTHREAD_MUTEX_INITIALIZER;
+
 void modena_substitute_model_calculate_maps
 (
     modena_substitute_model_t *sm,
@@ -277,6 +300,374 @@ void modena_model_get_minMax
     Py_DECREF(pObj);
 }
 
+/* Helpers reading the binary descriptor written by
+ * SurrogateModel.exportDescriptor. Values are stored little-endian and are
+ * decoded byte by byte, so that the host byte order does not matter. All
+ * helpers return false if the descriptor is truncated.
+ */
+static bool modena_descriptor_read_uint
+(
+    FILE *f,
+    const size_t nBytes,
+    uint64_t *value
+)
+{
+    unsigned char b[8];
+    if(fread(b, 1, nBytes, f) != nBytes){ return false; }
+
+    size_t i;
+    *value = 0;
+    for(i = nBytes; i > 0; i--)
+    {
+        *value = (*value << 8) | b[i-1];
+    }
+
+    return true;
+}
+
+static bool modena_descriptor_read_size(FILE *f, size_t *value)
+{
+    uint64_t v;
+    if(!modena_descriptor_read_uint(f, 8, &v)){ return false; }
+    *value = v;
+
+    return true;
+}
+
+static bool modena_descriptor_read_string(FILE *f, char **value)
+{
+    uint64_t n;
+    if(!modena_descriptor_read_uint(f, 4, &n)){ return false; }
+
+    *value = malloc(n + 1);
+    if(fread(*value, 1, n, f) != n)
+    {
+        free(*value);
+        *value = NULL;
+        return false;
+    }
+    (*value)[n] = '\0';
+
+    return true;
+}
+
+static bool modena_descriptor_read_strings
+(
+    FILE *f,
+    size_t *size,
+    char ***values
+)
+{
+    size_t n, i;
+    if(!modena_descriptor_read_size(f, &n)){ return false; }
+
+    *values = malloc(n*sizeof(char*));
+    for(i = 0; i < n; i++)
+    {
+        if(!modena_descriptor_read_string(f, &(*values)[i]))
+        {
+            while(i > 0){ free((*values)[--i]); }
+            free(*values);
+            *values = NULL;
+            return false;
+        }
+    }
+    *size = n;
+
+    return true;
+}
+
+static bool modena_descriptor_read_doubles
+(
+    FILE *f,
+    size_t *size,
+    double **values
+)
+{
+    size_t n, i;
+    if(!modena_descriptor_read_size(f, &n)){ return false; }
+
+    *values = malloc(n*sizeof(double));
+    for(i = 0; i < n; i++)
+    {
+        uint64_t v;
+        if(!modena_descriptor_read_uint(f, 8, &v))
+        {
+            free(*values);
+            *values = NULL;
+            return false;
+        }
+        memcpy(&(*values)[i], &v, sizeof(double));
+    }
+    *size = n;
+
+    return true;
+}
+
+/* Reads a map of size pairs, i.e. 2*size entries
+ */
+static bool modena_descriptor_read_map
+(
+    FILE *f,
+    size_t *size,
+    size_t **values
+)
+{
+    size_t n, i;
+    if(!modena_descriptor_read_size(f, &n)){ return false; }
+
+    *values = malloc(2*n*sizeof(size_t));
+    for(i = 0; i < 2*n; i++)
+    {
+        if(!modena_descriptor_read_size(f, &(*values)[i]))
+        {
+            free(*values);
+            *values = NULL;
+            return false;
+        }
+    }
+    *size = n;
+
+    return true;
+}
+
+static bool modena_descriptor_read_table
+(
+    FILE *f,
+    modena_argPos_table_t *table
+)
+{
+    size_t n, i;
+    if(!modena_descriptor_read_size(f, &n)){ return false; }
+
+    table->names = calloc(n, sizeof(char*));
+    table->argPos = malloc(n*sizeof(size_t));
+    table->size = n;
+    for(i = 0; i < n; i++)
+    {
+        if
+        (
+            !modena_descriptor_read_string(f, &table->names[i])
+         || !modena_descriptor_read_size(f, &table->argPos[i])
+        )
+        {
+            return false;
+        }
+    }
+
+    return true;
+}
+
+static void modena_argPos_table_destroy(modena_argPos_table_t *table)
+{
+    size_t i;
+    for(i = 0; i < table->size; i++)
+    {
+        free(table->names[i]);
+    }
+    free(table->names);
+    free(table->argPos);
+}
+
+static bool modena_argPos_table_lookup
+(
+    const modena_argPos_table_t *table,
+    const char *name,
+    size_t *argPos
+)
+{
+    size_t i;
+    for(i = 0; i < table->size; i++)
+    {
+        if(!strcmp(table->names[i], name))
+        {
+            *argPos = table->argPos[i];
+            return true;
+        }
+    }
+
+    return false;
+}
+
+/* Reads one model record including the records of its substitute models.
+ * Returns NULL if the descriptor is truncated or inconsistent.
+ */
+static modena_model_t *modena_model_read_descriptor
+(
+    FILE *f,
+    const char *filename
+)
+{
+    // Models loaded from a descriptor are plain C structures which are never
+    // handed to Python. The header is set up so that Py_XDECREF and
+    // modena_model_destroy work without an interpreter.
+    modena_model_t *self = calloc(1, sizeof(modena_model_t));
+    self->ob_refcnt = 1;
+    self->ob_type = &modena_model_tType;
+    self->descriptor = strdup(filename);
+
+    char *modelId = NULL, *libraryName = NULL, *functionName = NULL;
+    size_t fInputs, fOutputs, fParameters, nMax, nParameters, i, j;
+    double *inputs_max = NULL;
+
+    bool ok =
+        modena_descriptor_read_string(f, &modelId)
+     && modena_descriptor_read_string(f, &libraryName)
+     && modena_descriptor_read_string(f, &functionName)
+     && modena_descriptor_read_size(f, &fInputs)
+     && modena_descriptor_read_size(f, &fOutputs)
+     && modena_descriptor_read_size(f, &fParameters)
+     && modena_descriptor_read_doubles
+        (
+            f, &self->inputs_internal_size, &self->inputs_min
+        )
+     && modena_descriptor_read_doubles(f, &nMax, &inputs_max)
+     && nMax == self->inputs_internal_size
+     && modena_descriptor_read_strings
+        (
+            f, &self->inputs_size, &self->inputs_names
+        )
+     && modena_descriptor_read_strings
+        (
+            f, &self->outputs_size, &self->outputs_names
+        )
+     && modena_descriptor_read_strings
+        (
+            f, &self->parameters_size, &self->parameters_names
+        )
+     && modena_descriptor_read_doubles(f, &nParameters, &self->parameters)
+     && nParameters == self->parameters_size
+     && modena_descriptor_read_table(f, &self->inputs_argPos_table)
+     && modena_descriptor_read_table(f, &self->outputs_argPos_table)
+     && modena_descriptor_read_size(f, &j);
+
+    self->inputs_max = inputs_max;
+
+    if(ok)
+    {
+        self->substituteModels = calloc(j, sizeof(modena_substitute_model_t));
+        for(i = 0; ok && i < j; i++)
+        {
+            modena_substitute_model_t *sm = &self->substituteModels[i];
+
+            ok =
+                modena_descriptor_read_map
+                (
+                    f, &sm->map_outputs_size, &sm->map_outputs
+                )
+             && modena_descriptor_read_map
+                (
+                    f, &sm->map_inputs_size, &sm->map_inputs
+                );
+
+            if(ok)
+            {
+                sm->model = modena_model_read_descriptor(f, filename);
+                ok = sm->model != NULL;
+            }
+
+            if(ok)
+            {
+                sm->inputs = modena_inputs_new(sm->model);
+                sm->outputs = modena_outputs_new(sm->model);
+                self->substituteModels_size = i + 1;
+            }
+            else
+            {
+                free(sm->map_inputs);
+                free(sm->map_outputs);
+            }
+        }
+    }
+
+    if(ok)
+    {
+        self->mf = modena_function_new_from_library
+        (
+            libraryName,
+            functionName,
+            fInputs,
+            fOutputs,
+            fParameters
+        );
+        self->function = self->mf->function;
+
+        self->argPos_used = malloc(self->inputs_internal_size*sizeof(bool));
+        for(j = 0; j < self->inputs_internal_size; j++)
+        {
+            self->argPos_used[j] = false;
+        }
+
+        for(j = 0; j < self->substituteModels_size; j++)
+        {
+            modena_substitute_model_t *sm = &self->substituteModels[j];
+            for(i = 0; i < sm->map_outputs_size; i++)
+            {
+                self->argPos_used[sm->map_outputs[2*i+1]] = true;
+            }
+        }
+    }
+    else
+    {
+        fprintf
+        (
+            stderr,
+            "Reading model %s from descriptor %s failed\n",
+            modelId ? modelId : "?",
+            filename
+        );
+        modena_model_destroy(self);
+        self = NULL;
+    }
+
+    free(modelId);
+    free(libraryName);
+    free(functionName);
+
+    return self;
+}
+
+modena_model_t *modena_model_new_from_descriptor
+(
+    const char *filename
+)
+{
+    FILE *f = fopen(filename, "rb");
+    if(!f)
+    {
+        fprintf(stderr, "Could not open descriptor %s\n", filename);
+        modena_error_code = MODENA_DESCRIPTOR_NOT_VALID;
+        return NULL;
+    }
+
+    char magic[8];
+    uint64_t version;
+    modena_model_t *self = NULL;
+
+    if
+    (
+        fread(magic, 1, 8, f) == 8
+     && !memcmp(magic, "MODENADS", 8)
+     && modena_descriptor_read_uint(f, 4, &version)
+     && version == 1
+    )
+    {
+        self = modena_model_read_descriptor(f, filename);
+    }
+    else
+    {
+        fprintf(stderr, "%s is not a valid model descriptor\n", filename);
+    }
+    fclose(f);
+
+    if(!self)
+    {
+        modena_error_code = MODENA_DESCRIPTOR_NOT_VALID;
+    }
+
+    return self;
+}
+
 modena_model_t *modena_model_new
 (
     const char *modelId
@@ -284,6 +675,29 @@ modena_model_t *modena_model_new
 {
     //Modena_Info_Print("In %s", __func__);
 
+    const char *descriptorDir = getenv("MODENA_DESCRIPTOR_DIR");
+    if(descriptorDir)
+    {
+        char *filename =
+            malloc(strlen(descriptorDir) + strlen(modelId) + 9);
+        sprintf(filename, "%s/%s.modena", descriptorDir, modelId);
+
+        if(!access(filename, R_OK))
+        {
+            modena_model_t *self = modena_model_new_from_descriptor(filename);
+            free(filename);
+            return self;
+        }
+        free(filename);
+    }
+
+    // The interpreter is started on demand if models are loaded from
+    // descriptors (see modena_init)
+    if(!modena_SurrogateModel)
+    {
+        initlibmodena();
+    }
+
     PyObject *args = PyTuple_New(0);
     PyObject *kw = Py_BuildValue("{s:s}", "modelId", modelId);
 
@@ -365,18 +779,62 @@ modena_model_t *modena_model_new
     return (modena_model_t *) pNewObj;
 }
 
+/* Look up name in the argPos index of the model. Returns a borrowed reference
+ * or NULL if the name is not (yet) in the index.
+ */
+static PyObject* modena_model_argPos_lookup(PyObject *pIndex, const char *name)
+{
+    if(!pIndex)
+    {
+        return NULL;
+    }
+
+    return PyDict_GetItemString(pIndex, name);
+}
+
 size_t modena_model_inputs_argPos(const modena_model_t *self, const char *name)
 {
-    PyObject *pRet = PyObject_CallMethod
-    (
-        self->pModel,
-        "inputs_argPos",
-        "(z)",
-        name
-    );
-    if(!pRet){ Modena_PyErr_Print(); }
-    size_t argPos = PyInt_AsSsize_t(pRet);
-    Py_DECREF(pRet);
+    size_t argPos;
+    PyObject *pArgPos = modena_model_argPos_lookup(self->pInputsArgPos, name);
+
+    if(self->descriptor)
+    {
+        if
+        (
+            !modena_argPos_table_lookup
+            (
+                &self->inputs_argPos_table,
+                name,
+                &argPos
+            )
+        )
+        {
+            Modena_Error_Print
+            (
+                "argPos for %s not found in inputs of %s",
+                name,
+                self->descriptor
+            );
+            exit(1);
+        }
+    }
+    else if(pArgPos)
+    {
+        argPos = PyInt_AsSsize_t(pArgPos);
+    }
+    else
+    {
+        PyObject *pRet = PyObject_CallMethod
+        (
+            self->pModel,
+            "inputs_argPos",
+            "(z)",
+            name
+        );
+        if(!pRet){ Modena_PyErr_Print(); }
+        argPos = PyInt_AsSsize_t(pRet);
+        Py_DECREF(pRet);
+    }
 
     if(self->argPos_used)
     {
@@ -393,6 +851,38 @@ size_t modena_model_inputs_argPos(const modena_model_t *self, const char *name)
 
 size_t modena_model_outputs_argPos(const modena_model_t *self, const char *name)
 {
+    PyObject *pArgPos = modena_model_argPos_lookup(self->pOutputsArgPos, name);
+
+    if(self->descriptor)
+    {
+        size_t argPos;
+        if
+        (
+            !modena_argPos_table_lookup
+            (
+                &self->outputs_argPos_table,
+                name,
+                &argPos
+            )
+        )
+        {
+            Modena_Error_Print
+            (
+                "argPos for %s not found in outputs of %s",
+                name,
+                self->descriptor
+            );
+            exit(1);
+        }
+
+        return argPos;
+    }
+
+    if(pArgPos)
+    {
+        return PyInt_AsSsize_t(pArgPos);
+    }
+
     PyObject *pRet = PyObject_CallMethod
     (
         self->pModel,
@@ -461,59 +951,369 @@ size_t modena_model_parameters_size(const modena_model_t *self)
     return self->parameters_size;
 }
 
-int modena_substitute_model_call
+static int modena_model_call_reporting
+(
+    modena_model_t *self,
+    modena_inputs_t *inputs,
+    modena_outputs_t *outputs,
+    const bool report
+);
+
+/* Evaluates a substitute model using the scratch vectors smInputs and
+ * smOutputs. With a workspace, the re-entrant call is used. Unless report is
+ * set, a point outside the bounds returns 200 without being reported.
+ */
+static int modena_substitute_model_call_scratch
 (
     const modena_substitute_model_t *sm,
-    const modena_model_t *parent,
-    modena_inputs_t *inputs
+    modena_inputs_t *smInputs,
+    modena_outputs_t *smOutputs,
+    modena_workspace_t *workspace,
+    modena_inputs_t *inputs,
+    const bool report
 )
 {
     size_t j;
     for(j = 0; j < sm->map_inputs_size; j++)
     {
-        /*
-        printf
-        (
-            "i%zu <- ip%zu (%g)\n",
-            sm->map_inputs[2*j+1],
-            sm->map_inputs[2*j],
-            inputs->inputs[sm->map_inputs[2*j]]
-        );
-        */
-        sm->inputs->inputs[sm->map_inputs[2*j+1]] =
+        smInputs->inputs[sm->map_inputs[2*j+1]] =
             inputs->inputs[sm->map_inputs[2*j]];
     }
 
-    int ret = modena_model_call(sm->model, sm->inputs, sm->outputs);
+    int ret = workspace
+      ? modena_model_call_r(sm->model, workspace, smInputs, smOutputs)
+      : modena_model_call_reporting(sm->model, smInputs, smOutputs, report);
     if(ret){ return ret; }
 
     for(j = 0; j < sm->map_outputs_size; j++)
     {
-        /*
-        printf
-        (
-            "ip%zu <- o%zu (%g)\n",
-            sm->map_outputs[2*j+1],
-            sm->map_outputs[2*j],
-            sm->outputs->outputs[sm->map_outputs[2*j]]
-        );
-        */
         inputs->inputs[sm->map_outputs[2*j+1]] =
-            sm->outputs->outputs[sm->map_outputs[2*j]];
+            smOutputs->outputs[sm->map_outputs[2*j]];
     }
 
     return 0;
 }
 
+int modena_substitute_model_call
+(
+    const modena_substitute_model_t *sm,
+    const modena_model_t *parent,
+    modena_inputs_t *inputs
+)
+{
+    return modena_substitute_model_call_scratch
+    (
+        sm,
+        sm->inputs,
+        sm->outputs,
+        NULL,
+        inputs,
+        true
+    );
+}
+
+/* Reports a point outside the bounds of a model loaded from a descriptor
+ */
+static void modena_model_print_outside_point
+(
+    const modena_model_t *self,
+    const double *x
+)
+{
+    fprintf
+    (
+        stderr,
+        "Point outside the bounds of the model loaded from %s:",
+        self->descriptor
+    );
+
+    size_t j;
+    for(j = 0; j < self->inputs_internal_size; j++)
+    {
+        fprintf(stderr, " %g", x[j]);
+    }
+    fprintf(stderr, "\n");
+}
+
+/* Returns the cell of component x of a point outside the bounds. Cells
+ * grow geometrically by a factor 1 + tolerance, so that their relative width
+ * is tolerance. Without tolerance every value is a cell of its own.
+ */
+static int64_t modena_outside_cell(const double x, const double tolerance)
+{
+    if(tolerance < DBL_EPSILON || !isfinite(x) || x == 0.0)
+    {
+        int64_t bits;
+        memcpy(&bits, &x, sizeof(bits));
+        return bits;
+    }
+
+    // Distinct from the bit patterns of 0.0 and of non-finite values
+    const int64_t c = (int64_t) floor(log(fabs(x))/log1p(tolerance));
+    return 2*c + (x < 0.0) + 1;
+}
+
+/* Returns the hash of the cells of a point outside the bounds
+ */
+static size_t modena_outside_hash
+(
+    const modena_model_t *self,
+    const double *x
+)
+{
+    uint64_t h = 0;
+    size_t j;
+    for(j = 0; j < self->inputs_internal_size; j++)
+    {
+        // Mix all bits of the cell into the low bits used by the table
+        h += (uint64_t) modena_outside_cell(x[j], self->outside_tolerance);
+        h += 0x9e3779b97f4a7c15ULL;
+        h = (h ^ (h >> 30))*0xbf58476d1ce4e5b9ULL;
+        h = (h ^ (h >> 27))*0x94d049bb133111ebULL;
+        h ^= h >> 31;
+    }
+
+    return (size_t) h;
+}
+
+/* Returns true if the points x and y are in the same cells
+ */
+static bool modena_outside_same_cells
+(
+    const modena_model_t *self,
+    const double *x,
+    const double *y
+)
+{
+    size_t j;
+    for(j = 0; j < self->inputs_internal_size; j++)
+    {
+        if
+        (
+            modena_outside_cell(x[j], self->outside_tolerance)
+         != modena_outside_cell(y[j], self->outside_tolerance)
+        )
+        {
+            return false;
+        }
+    }
+
+    return true;
+}
+
+/* Returns the slot of the hash table of the collected points holding the
+ * point in the same cells as x, or the empty slot where it belongs
+ */
+static size_t *modena_outside_slot(const modena_model_t *self, const double *x)
+{
+    const size_t n = self->inputs_internal_size;
+    const size_t mask = 2*self->outside_points_capacity - 1;
+    size_t i = modena_outside_hash(self, x) & mask;
+
+    // Slots hold the index of the point plus one, zero is empty
+    while
+    (
+        self->outside_hash[i]
+     && !modena_outside_same_cells
+        (
+            self, x, &self->outside_points[(self->outside_hash[i] - 1)*n]
+        )
+    )
+    {
+        i = (i + 1) & mask;
+    }
+
+    return &self->outside_hash[i];
+}
+
+/* Rebuilds the hash table of the collected points, e.g. after the capacity
+ * or the tolerance changed
+ */
+static void modena_outside_rehash(modena_model_t *self)
+{
+    if(!self->outside_points_capacity)
+    {
+        return;
+    }
+
+    const size_t n = self->inputs_internal_size;
+    self->outside_hash = realloc
+    (
+        self->outside_hash,
+        2*self->outside_points_capacity*sizeof(size_t)
+    );
+    memset
+    (
+        self->outside_hash, 0, 2*self->outside_points_capacity*sizeof(size_t)
+    );
+
+    size_t p;
+    for(p = 0; p < self->outside_points_size; p++)
+    {
+        size_t *slot =
+            modena_outside_slot(self, &self->outside_points[p*n]);
+        if(!*slot){ *slot = p + 1; }
+    }
+}
+
+/* Stores a point outside the bounds in the buffer of the model unless a point
+ * in the same cells (see modena_outside_cell) is stored already. The points
+ * are found through a hash table of their cells, so that collecting the
+ * points of a mesh takes linear time.
+ */
+static void modena_model_collect_outside_point
+(
+    modena_model_t *self,
+    const double *x
+)
+{
+    const size_t n = self->inputs_internal_size;
+
+    if(self->outside_points_size == self->outside_points_capacity)
+    {
+        self->outside_points_capacity =
+            self->outside_points_capacity
+          ? 2*self->outside_points_capacity
+          : 16;
+        self->outside_points = realloc
+        (
+            self->outside_points,
+            self->outside_points_capacity*n*sizeof(double)
+        );
+        modena_outside_rehash(self);
+    }
+
+    size_t *slot = modena_outside_slot(self, x);
+    if(*slot)
+    {
+        return;
+    }
+
+    memcpy
+    (
+        &self->outside_points[self->outside_points_size*n],
+        x,
+        n*sizeof(double)
+    );
+    self->outside_points_size++;
+    *slot = self->outside_points_size;
+}
+
+void modena_model_set_outside_mode
+(
+    modena_model_t *self,
+    const modena_outside_mode_t mode,
+    const double tolerance
+)
+{
+    self->outside_mode = mode;
+    if(tolerance != self->outside_tolerance)
+    {
+        self->outside_tolerance = tolerance;
+        modena_outside_rehash(self);
+    }
+
+    size_t i;
+    for(i = 0; i < self->substituteModels_size; i++)
+    {
+        modena_model_set_outside_mode
+        (
+            self->substituteModels[i].model,
+            mode,
+            tolerance
+        );
+    }
+}
+
+size_t modena_model_outside_points_size(const modena_model_t *self)
+{
+    return self->outside_points_size;
+}
+
+int modena_model_write_outside_points(modena_model_t *self)
+{
+    int ret = 0;
+    size_t i, j;
+
+    for(i = 0; i < self->substituteModels_size; i++)
+    {
+        int smRet =
+            modena_model_write_outside_points(self->substituteModels[i].model);
+        if(smRet){ ret = smRet; }
+    }
+
+    if(!self->outside_points_size)
+    {
+        if(ret){ modena_error_code = ret; }
+        return ret;
+    }
+
+    const size_t n = self->inputs_internal_size;
+
+    if(self->descriptor)
+    {
+        for(i = 0; i < self->outside_points_size; i++)
+        {
+            modena_model_print_outside_point(self, &self->outside_points[i*n]);
+        }
+        ret = 200;
+    }
+    else
+    {
+        PyObject* pPoints = PyList_New(self->outside_points_size);
+        for(i = 0; i < self->outside_points_size; i++)
+        {
+            PyObject* pOutside = PyList_New(n);
+            for(j = 0; j < n; j++)
+            {
+                PyList_SET_ITEM
+                (
+                    pOutside, j, PyFloat_FromDouble(self->outside_points[i*n + j])
+                );
+            }
+            PyList_SET_ITEM(pPoints, i, pOutside);
+        }
+
+        PyObject *pRet = PyObject_CallMethod
+        (
+           self->pModel,
+           "exceptionOutOfBoundsBatch",
+           "(O)",
+           pPoints
+        );
+        Py_DECREF(pPoints);
+        if(!pRet){ Modena_PyErr_Print(); }
+        ret = PyInt_AsLong(pRet);
+        Py_DECREF(pRet);
+    }
+
+    self->outside_points_size = 0;
+    modena_outside_rehash(self);
+    modena_error_code = ret;
+
+    return ret;
+}
+
 int write_outside_point
 (
     modena_model_t *self,
     modena_inputs_t *inputs
 )
 {
+    size_t j;
+
+    // Without Python the point can only be reported and the run stopped
+    if(self->descriptor)
+    {
+        modena_model_print_outside_point(self, inputs->inputs);
+
+        modena_error_code = 200;
+
+        return 200;
+    }
+
     PyObject* pOutside = PyList_New(self->inputs_internal_size);
 
-    size_t j;
     for(j = 0; j < self->inputs_internal_size; j++)
     {
         PyList_SET_ITEM
@@ -551,11 +1351,16 @@ modena_model_call returns:
 If exit is requested, do what's necessary and exit with the same error code!
 
 */
-int modena_model_call
+/* Implements modena_model_call. Unless report is set, a point outside the
+ * bounds of the model or a substitute model returns 200 without being
+ * reported, see modena_model_call_batch.
+ */
+static int modena_model_call_reporting
 (
     modena_model_t *self,
     modena_inputs_t *inputs,
-    modena_outputs_t *outputs
+    modena_outputs_t *outputs,
+    const bool report
 )
 {
     if
@@ -564,17 +1369,21 @@ int modena_model_call
        && self->parameters_size != self->mf->parameters_size
     )
     {
-        return write_outside_point(self, inputs);
+        return report ? write_outside_point(self, inputs) : 200;
     }
 
     size_t j;
     for(j = 0; j < self->substituteModels_size; j++)
     {
-        int ret = modena_substitute_model_call
+        modena_substitute_model_t *sm = &self->substituteModels[j];
+        int ret = modena_substitute_model_call_scratch
         (
-            &self->substituteModels[j],
-            self,
-            inputs
+            sm,
+            sm->inputs,
+            sm->outputs,
+            NULL,
+            inputs,
+            report
         );
         if(ret){ return ret; }
     }
@@ -599,7 +1408,13 @@ int modena_model_call
          || inputs->inputs[j] > self->inputs_max[j]
         )
         {
-            return write_outside_point(self, inputs);
+            if(self->outside_mode == MODENA_OUTSIDE_COLLECT)
+            {
+                modena_model_collect_outside_point(self, inputs->inputs);
+                break;
+            }
+
+            return report ? write_outside_point(self, inputs) : 200;
         }
     }
 
@@ -613,6 +1428,16 @@ int modena_model_call
     return 0;
 }
 
+int modena_model_call
+(
+    modena_model_t *self,
+    modena_inputs_t *inputs,
+    modena_outputs_t *outputs
+)
+{
+    return modena_model_call_reporting(self, inputs, outputs, true);
+}
+
 void modena_model_call_no_check
 (
     modena_model_t *self,
@@ -662,88 +1487,986 @@ void modena_model_call_no_check
     );
 }
 
-/* Destructor, frees the memory block occupied by a model.
+bool modena_model_has_jacobian(const modena_model_t *self)
+{
+    return self->mf->jacobian != NULL;
+}
+
+/* Evaluates the Jacobian of a single point, the bounds are only checked if
+ * checkBounds is set.
  */
-void modena_model_destroy(modena_model_t *self)
+static int modena_model_call_jacobian_check
+(
+    modena_model_t *self,
+    modena_inputs_t *inputs,
+    double *jacobian,
+    const bool checkBounds
+)
 {
-    size_t i;
-    for(i = 0; i < self->substituteModels_size; i++)
+    if(!self->mf->jacobian)
     {
-        Py_XDECREF(self->substituteModels[i].model);
-        modena_inputs_destroy(self->substituteModels[i].inputs);
-        modena_outputs_destroy(self->substituteModels[i].outputs);
-        free(self->substituteModels[i].map_inputs);
-        free(self->substituteModels[i].map_outputs);
+        Modena_Error_Print("Surrogate function has no Jacobian");
+        exit(1);
+    }
+
+    if
+    (
+          self->parameters_size == 0
+       && self->parameters_size != self->mf->parameters_size
+    )
+    {
+        return write_outside_point(self, inputs);
+    }
+
+    size_t j;
+    for(j = 0; j < self->substituteModels_size; j++)
+    {
+        int ret = modena_substitute_model_call
+        (
+            &self->substituteModels[j],
+            self,
+            inputs
+        );
+        if(ret && checkBounds){ return ret; }
+    }
+
+    for(j = 0; j < self->inputs_internal_size && checkBounds; j++)
+    {
+        if
+        (
+            inputs->inputs[j] < self->inputs_min[j]
+         || inputs->inputs[j] > self->inputs_max[j]
+        )
+        {
+            if(self->outside_mode == MODENA_OUTSIDE_COLLECT)
+            {
+                modena_model_collect_outside_point(self, inputs->inputs);
+                break;
+            }
+
+            return write_outside_point(self, inputs);
+        }
+    }
+
+    self->mf->jacobian
+    (
+        self,
+        inputs->inputs,
+        jacobian
+    );
+
+    return 0;
+}
+
+int modena_model_call_jacobian
+(
+    modena_model_t *self,
+    modena_inputs_t *inputs,
+    double *jacobian
+)
+{
+    return modena_model_call_jacobian_check(self, inputs, jacobian, true);
+}
+
+modena_workspace_t *modena_workspace_new(const modena_model_t *model)
+{
+    modena_workspace_t *self = malloc(sizeof(modena_workspace_t));
+    size_t n = model->substituteModels_size;
+
+    self->substituteModels_size = n;
+    self->inputs = malloc(n*sizeof(modena_inputs_t*));
+    self->outputs = malloc(n*sizeof(modena_outputs_t*));
+    self->workspaces = malloc(n*sizeof(modena_workspace_t*));
+
+    size_t j;
+    for(j = 0; j < n; j++)
+    {
+        const modena_model_t *sm = model->substituteModels[j].model;
+        self->inputs[j] = modena_inputs_new(sm);
+        self->outputs[j] = modena_outputs_new(sm);
+        self->workspaces[j] = modena_workspace_new(sm);
+    }
+
+    return self;
+}
+
+void modena_workspace_destroy(modena_workspace_t *self)
+{
+    size_t j;
+    for(j = 0; j < self->substituteModels_size; j++)
+    {
+        modena_inputs_destroy(self->inputs[j]);
+        modena_outputs_destroy(self->outputs[j]);
+        modena_workspace_destroy(self->workspaces[j]);
+    }
+    free(self->inputs);
+    free(self->outputs);
+    free(self->workspaces);
+    free(self);
+}
+
+/* Appends a copy of the point to the queue of points outside the bounds
+ */
+static void modena_queue_outside_point
+(
+    const modena_model_t *self,
+    const modena_inputs_t *inputs
+)
+{
+    modena_outside_point_t *p = malloc(sizeof(modena_outside_point_t));
+    p->model = (modena_model_t *) self;
+    p->inputs = modena_inputs_new(self);
+    memcpy
+    (
+        p->inputs->inputs,
+        inputs->inputs,
+        self->inputs_internal_size*sizeof(double)
+    );
+
+    pthread_mutex_lock(&modena_outside_points_mutex);
+    p->next = modena_outside_points;
+    modena_outside_points = p;
+    pthread_mutex_unlock(&modena_outside_points_mutex);
+}
+
+int modena_model_call_r
+(
+    const modena_model_t *self,
+    modena_workspace_t *workspace,
+    modena_inputs_t *inputs,
+    modena_outputs_t *outputs
+)
+{
+    if
+    (
+          self->parameters_size == 0
+       && self->parameters_size != self->mf->parameters_size
+    )
+    {
+        modena_queue_outside_point(self, inputs);
+        modena_error_code = 200;
+        return 200;
+    }
+
+    size_t j;
+    for(j = 0; j < self->substituteModels_size; j++)
+    {
+        int ret = modena_substitute_model_call_scratch
+        (
+            &self->substituteModels[j],
+            workspace->inputs[j],
+            workspace->outputs[j],
+            workspace->workspaces[j],
+            inputs,
+            true
+        );
+        if(ret){ return ret; }
+    }
+
+    for(j = 0; j < self->inputs_internal_size; j++)
+    {
+        if
+        (
+            inputs->inputs[j] < self->inputs_min[j]
+         || inputs->inputs[j] > self->inputs_max[j]
+        )
+        {
+            modena_queue_outside_point(self, inputs);
+
+            if(self->outside_mode == MODENA_OUTSIDE_COLLECT)
+            {
+                break;
+            }
+
+            modena_error_code = 200;
+            return 200;
+        }
+    }
+
+    self->function
+    (
+        self,
+        inputs->inputs,
+        outputs->outputs
+    );
+
+    return 0;
+}
+
+int modena_flush_outside_points()
+{
+    pthread_mutex_lock(&modena_outside_points_mutex);
+    modena_outside_point_t *p = modena_outside_points;
+    modena_outside_points = NULL;
+    pthread_mutex_unlock(&modena_outside_points_mutex);
+
+    // The queue is in reverse order of arrival. Reporting the oldest point
+    // last makes it the one stored, as in the serial call.
+    int ret = 0;
+    while(p)
+    {
+        modena_outside_point_t *next = p->next;
+        if(p->model->outside_mode == MODENA_OUTSIDE_COLLECT)
+        {
+            modena_model_collect_outside_point(p->model, p->inputs->inputs);
+        }
+        else
+        {
+            ret = write_outside_point(p->model, p->inputs);
+        }
+        modena_inputs_destroy(p->inputs);
+        free(p);
+        p = next;
+    }
+
+    return ret;
+}
+
+/* Removes all queued points of a model that is being destroyed
+ */
+static void modena_discard_outside_points(const modena_model_t *self)
+{
+    pthread_mutex_lock(&modena_outside_points_mutex);
+    modena_outside_point_t **p = &modena_outside_points;
+    while(*p)
+    {
+        if((*p)->model == self)
+        {
+            modena_outside_point_t *next = (*p)->next;
+            modena_inputs_destroy((*p)->inputs);
+            free(*p);
+            *p = next;
+        }
+        else
+        {
+            p = &(*p)->next;
+        }
+    }
+    pthread_mutex_unlock(&modena_outside_points_mutex);
+}
+
+/* Returns a pointer to the vector of point p in the batch array x. For the
+ * column-major layout the values are gathered into scratch.
+ */
+static double *modena_batch_get
+(
+    double *x,
+    const size_t nPoints,
+    const size_t size,
+    const modena_layout_t layout,
+    const size_t p,
+    double *scratch
+)
+{
+    if(layout == MODENA_ROW_MAJOR)
+    {
+        return &x[p*size];
+    }
+
+    size_t j;
+    for(j = 0; j < size; j++)
+    {
+        scratch[j] = x[j*nPoints + p];
+    }
+
+    return scratch;
+}
+
+/* Writes the vector of point p back into the batch array x. Nothing needs to
+ * be done for the row-major layout since modena_batch_get returned a pointer
+ * into x.
+ */
+static void modena_batch_set
+(
+    double *x,
+    const size_t nPoints,
+    const size_t size,
+    const modena_layout_t layout,
+    const size_t p,
+    const double *scratch
+)
+{
+    if(layout == MODENA_ROW_MAJOR)
+    {
+        return;
+    }
+
+    size_t j;
+    for(j = 0; j < size; j++)
+    {
+        x[j*nPoints + p] = scratch[j];
+    }
+}
+
+/* Calls the substitute models for all points of a batch. If checkBounds is
+ * set, the first error code returned by a substitute model is returned and
+ * the points a substitute model failed for are marked in outside (which may
+ * be NULL). Only the first point outside the bounds of a substitute model is
+ * reported, the evaluation continues with the next point. Other errors stop
+ * the evaluation.
+ */
+static int modena_model_call_batch_substitute_models
+(
+    modena_model_t *self,
+    const size_t nPoints,
+    const modena_layout_t layout,
+    double *inputs,
+    const bool checkBounds,
+    bool *outside
+)
+{
+    if(!self->substituteModels_size)
+    {
+        return 0;
+    }
+
+    const size_t size = self->inputs_internal_size;
+    double *scratch = malloc(size*sizeof(double));
+
+    modena_inputs_t point;
+    point.inherited_inputs = NULL;
+
+    int ret = 0;
+    size_t p, j;
+    for(p = 0; p < nPoints; p++)
+    {
+        point.inputs =
+            modena_batch_get(inputs, nPoints, size, layout, p, scratch);
+
+        for(j = 0; j < self->substituteModels_size; j++)
+        {
+            modena_substitute_model_t *sm = &self->substituteModels[j];
+            int smRet = modena_substitute_model_call_scratch
+            (
+                sm, sm->inputs, sm->outputs, NULL, &point, !ret
+            );
+            if(smRet && checkBounds)
+            {
+                if(!ret){ ret = smRet; }
+                if(outside){ outside[p] = true; }
+                break;
+            }
+        }
+
+        modena_batch_set(inputs, nPoints, size, layout, p, point.inputs);
+
+        if(ret && ret != 200 && checkBounds){ break; }
+    }
+
+    free(scratch);
+
+    return checkBounds ? ret : 0;
+}
+
+/* Evaluates the surrogate function for all points of a batch that are not
+ * marked in outside (which may be NULL).
+ */
+static void modena_model_call_batch_function
+(
+    modena_model_t *self,
+    const size_t nPoints,
+    const modena_layout_t layout,
+    double *inputs,
+    double *outputs,
+    const bool *outside
+)
+{
+    const size_t ni = self->inputs_internal_size;
+    const size_t no = self->outputs_size;
+    size_t p;
+
+    if(layout == MODENA_ROW_MAJOR)
+    {
+        for(p = 0; p < nPoints; p++)
+        {
+            if(outside && outside[p]){ continue; }
+            self->function(self, &inputs[p*ni], &outputs[p*no]);
+        }
+
+        return;
+    }
+
+    double *i = malloc(ni*sizeof(double));
+    double *o = malloc(no*sizeof(double));
+    for(p = 0; p < nPoints; p++)
+    {
+        if(outside && outside[p]){ continue; }
+        self->function
+        (
+            self,
+            modena_batch_get(inputs, nPoints, ni, layout, p, i),
+            o
+        );
+        modena_batch_set(outputs, nPoints, no, layout, p, o);
+    }
+    free(i);
+    free(o);
+}
+
+/* Marks all points of a batch that are outside the bounds of the model in
+ * addition to those already marked in outside and returns the number of
+ * marked points. The bounds are checked in the memory order of the layout.
+ */
+static size_t modena_model_check_batch_bounds
+(
+    const modena_model_t *self,
+    const size_t nPoints,
+    const modena_layout_t layout,
+    const double *inputs,
+    bool *outside
+)
+{
+    const size_t ni = self->inputs_internal_size;
+    size_t p, j;
+
+    if(layout == MODENA_ROW_MAJOR)
+    {
+        for(p = 0; p < nPoints; p++)
+        {
+            const double *x = &inputs[p*ni];
+            for(j = 0; j < ni; j++)
+            {
+                outside[p] |=
+                    x[j] < self->inputs_min[j] || x[j] > self->inputs_max[j];
+            }
+        }
+    }
+    else
+    {
+        for(j = 0; j < ni; j++)
+        {
+            const double *x = &inputs[j*nPoints];
+            const double min = self->inputs_min[j];
+            const double max = self->inputs_max[j];
+            for(p = 0; p < nPoints; p++)
+            {
+                outside[p] |= x[p] < min || x[p] > max;
+            }
+        }
+    }
+
+    size_t n = 0;
+    for(p = 0; p < nPoints; p++)
+    {
+        n += outside[p];
+    }
+
+    return n;
+}
+
+int modena_model_call_batch
+(
+    modena_model_t *self,
+    const size_t nPoints,
+    const modena_layout_t layout,
+    double *inputs,
+    double *outputs,
+    size_t *outOfBounds,
+    size_t *nOutOfBounds
+)
+{
+    size_t p, n = 0;
+
+    if(nOutOfBounds){ *nOutOfBounds = 0; }
+
+    if(!nPoints)
+    {
+        return 0;
+    }
+
+    const size_t ni = self->inputs_internal_size;
+    double *scratch = malloc(ni*sizeof(double));
+    modena_inputs_t point;
+    point.inherited_inputs = NULL;
+
+    if
+    (
+          self->parameters_size == 0
+       && self->parameters_size != self->mf->parameters_size
+    )
+    {
+        // Nothing can be evaluated - report all points
+        for(p = 0; p < nPoints; p++)
+        {
+            if(outOfBounds){ outOfBounds[p] = p; }
+        }
+        if(nOutOfBounds){ *nOutOfBounds = nPoints; }
+
+        point.inputs =
+            modena_batch_get(inputs, nPoints, ni, layout, 0, scratch);
+        int ret = write_outside_point(self, &point);
+        free(scratch);
+
+        return ret;
+    }
+
+    // Points a substitute model failed for are marked as well
+    bool *outside = malloc(nPoints*sizeof(bool));
+    for(p = 0; p < nPoints; p++)
+    {
+        outside[p] = false;
+    }
+
+    int ret = modena_model_call_batch_substitute_models
+    (
+        self, nPoints, layout, inputs, true, outside
+    );
+    if(ret && ret != 200)
+    {
+        free(outside);
+        free(scratch);
+        return ret;
+    }
+
+    size_t nSubstitute = 0;
+    for(p = 0; p < nPoints; p++)
+    {
+        nSubstitute += outside[p];
+    }
+
+    bool *substitute = NULL;
+    if(nSubstitute)
+    {
+        substitute = malloc(nPoints*sizeof(bool));
+        memcpy(substitute, outside, nPoints*sizeof(bool));
+    }
+
+    n = modena_model_check_batch_bounds(self, nPoints, layout, inputs, outside);
+    const bool collect = self->outside_mode == MODENA_OUTSIDE_COLLECT;
+
+    // In collect mode points outside the bounds of this model are evaluated
+    modena_model_call_batch_function
+    (
+        self,
+        nPoints,
+        layout,
+        inputs,
+        outputs,
+        n && !collect ? outside : substitute
+    );
+
+    if(n)
+    {
+        size_t first = nPoints, k = 0;
+        for(p = 0; p < nPoints; p++)
+        {
+            if(!outside[p]){ continue; }
+            if(outOfBounds){ outOfBounds[k] = p; }
+            k++;
+
+            // Points of substitute models were reported by them
+            if(substitute && substitute[p]){ continue; }
+            if(first == nPoints){ first = p; }
+
+            if(collect)
+            {
+                modena_model_collect_outside_point
+                (
+                    self,
+                    modena_batch_get(inputs, nPoints, ni, layout, p, scratch)
+                );
+            }
+        }
+        if(nOutOfBounds){ *nOutOfBounds = n; }
+
+        if(!collect && !ret && first < nPoints)
+        {
+            point.inputs =
+                modena_batch_get(inputs, nPoints, ni, layout, first, scratch);
+            ret = write_outside_point(self, &point);
+        }
+    }
+
+    free(substitute);
+    free(outside);
+    free(scratch);
+
+    return ret;
+}
+
+void modena_model_call_batch_no_check
+(
+    modena_model_t *self,
+    const size_t nPoints,
+    const modena_layout_t layout,
+    double *inputs,
+    double *outputs
+)
+{
+    if
+    (
+          self->parameters_size == 0
+       && self->parameters_size != self->mf->parameters_size
+       && nPoints
+    )
+    {
+        modena_inputs_t point;
+        point.inherited_inputs = NULL;
+        double *scratch = malloc(self->inputs_internal_size*sizeof(double));
+        point.inputs = modena_batch_get
+        (
+            inputs, nPoints, self->inputs_internal_size, layout, 0, scratch
+        );
+        write_outside_point(self, &point);
+        free(scratch);
+    }
+
+    modena_model_call_batch_substitute_models
+    (
+        self, nPoints, layout, inputs, false, NULL
+    );
+
+    modena_model_call_batch_function
+    (
+        self, nPoints, layout, inputs, outputs, NULL
+    );
+}
+
+/* Creates a copy of a model sharing the read-only data of its prototype,
+ * see modena_model_clone in model.h.
+ */
+modena_model_t *modena_model_clone(const modena_model_t *self)
+{
+    modena_model_t *prototype =
+        self->prototype ? self->prototype : (modena_model_t *) self;
+
+    modena_model_t *clone = malloc(sizeof(modena_model_t));
+    memcpy(clone, prototype, sizeof(modena_model_t));
+    clone->ob_refcnt = 1;
+
+    Py_INCREF(prototype);
+    clone->prototype = prototype;
+
+    clone->parameters = malloc(self->parameters_size*sizeof(double));
+    memcpy
+    (
+        clone->parameters,
+        self->parameters,
+        self->parameters_size*sizeof(double)
+    );
+
+    clone->outside_mode = self->outside_mode;
+    clone->outside_tolerance = self->outside_tolerance;
+    clone->outside_points_size = 0;
+    clone->outside_points_capacity = 0;
+    clone->outside_points = NULL;
+    clone->outside_hash = NULL;
+
+    return clone;
+}
+
+/* Destructor, frees the memory block occupied by a model.
+ */
+void modena_model_destroy(modena_model_t *self)
+{
+    modena_discard_outside_points(self);
+    free(self->outside_points);
+    free(self->outside_hash);
+
+    if(self->prototype)
+    {
+        // Everything else belongs to the prototype
+        free(self->parameters);
+        Py_DECREF(self->prototype);
+        free(self);
+        return;
+    }
+
+    size_t i;
+    for(i = 0; i < self->substituteModels_size; i++)
+    {
+        Py_XDECREF(self->substituteModels[i].model);
+        modena_inputs_destroy(self->substituteModels[i].inputs);
+        modena_outputs_destroy(self->substituteModels[i].outputs);
+        free(self->substituteModels[i].map_inputs);
+        free(self->substituteModels[i].map_outputs);
+    }
+    free(self->substituteModels);
+
+    free(self->parameters);
+    free(self->inputs_min);
+    free(self->inputs_max);
+
+    free(self->argPos_used);
+
+    if(self->mf)
+    {
+        modena_function_destroy(self->mf);
+    }
+
+    for(i = 0; i < self->inputs_size; i++)
+    {
+        free(self->inputs_names[i]);
+    }
+    free(self->inputs_names);
+
+    for(i = 0; i < self->outputs_size; i++)
+    {
+        free(self->outputs_names[i]);
+    }
+    free(self->outputs_names);
+
+    for(i = 0; i < self->parameters_size; i++)
+    {
+        free(self->parameters_names[i]);
+    }
+    free(self->parameters_names);
+
+    Py_XDECREF(self->pInputsArgPos);
+    Py_XDECREF(self->pOutputsArgPos);
+    Py_XDECREF(self->pModel);
+
+    if(self->descriptor)
+    {
+        modena_argPos_table_destroy(&self->inputs_argPos_table);
+        modena_argPos_table_destroy(&self->outputs_argPos_table);
+        free(self->descriptor);
+        free(self);
+        return;
+    }
+
+    self->ob_type->tp_free((PyObject*)self);
+}
+
+/* C-Python: Destructor, exposed as __del__ in Python
+ */
+static void modena_model_t_dealloc(modena_model_t* self)
+{
+    modena_model_destroy(self);
+}
+
+/* C-Python: Member-Table
+ *
+ * Structure which describes an attribute of a type which corresponds to a C 
+ * struct member. Its fields are:
+ *
+ * Field  C Type       Meaning
+ * ------ ----------  --------------------------------------------------------
+ * name   char *      name of the member
+ * type   int         the type of the member in the C struct
+ * offset Py_ssize_t  the offset in bytes that the member is located on the
+ *                    type's object struct
+ * flags  int         flag bits indicating if the field should be read-only or 
+ *                    writable
+ * doc    char *      points to the contents of the docstring
+ */
+static PyMemberDef modena_model_t_members[] = {
+    {"outputs_size", T_PYSSIZET,
+       offsetof(modena_model_t, outputs_size), READONLY , "number of putputs"},
+    {"inputs_size", T_PYSSIZET,
+      offsetof(modena_model_t, inputs_size), READONLY , "number of inputs"},
+    {"inputs_internal_size", T_PYSSIZET,
+      offsetof(modena_model_t, inputs_internal_size), READONLY ,
+      "length of the input vector including inputs of substitute models"},
+    {"parameters_size", T_PYSSIZET,
+      offsetof(modena_model_t, parameters_size), READONLY , "number of parameters"},
+    {NULL}  /* Sentinel */
+};
+
+/* Acquires a C-contiguous buffer of doubles holding either one vector of
+ * length size (ndim = 1) or nPoints vectors of length size (ndim = 2).
+ * Returns the number of vectors or -1 on failure with an exception set.
+ */
+static Py_ssize_t modena_model_t_get_buffer
+(
+    PyObject *pObj,
+    Py_buffer *view,
+    const size_t size,
+    const int flags,
+    const char *name
+)
+{
+    if(PyObject_GetBuffer(pObj, view, flags | PyBUF_C_CONTIGUOUS | PyBUF_FORMAT))
+    {
+        return -1;
+    }
+
+    const char *format = view->format ? view->format : "d";
+    if
+    (
+        view->itemsize != sizeof(double)
+     || format[strlen(format) - 1] != 'd'
+     || strlen(format) > 2
+    )
+    {
+        PyErr_Format
+        (
+            PyExc_TypeError,
+            "%s must be a buffer of doubles (format '%s')",
+            name,
+            format
+        );
+        PyBuffer_Release(view);
+        return -1;
+    }
+
+    if(view->ndim == 1 && view->shape[0] == size)
+    {
+        return 1;
+    }
+
+    if(view->ndim == 2 && view->shape[1] == size)
+    {
+        return view->shape[0];
+    }
+
+    PyErr_Format
+    (
+        PyExc_ValueError,
+        "%s must have shape (%zu,) or (nPoints, %zu)",
+        name,
+        size,
+        size
+    );
+    PyBuffer_Release(view);
+    return -1;
+}
+
+/* C-Python: Evaluates all points stored in an object supporting the buffer
+ * protocol, e.g. a numpy array of shape (nPoints, inputs_internal_size), in
+ * one batch. The results are written into pO if it is given, otherwise they
+ * are returned as a (nested) list.
+ */
+static PyObject *modena_model_t_call_buffer
+(
+    modena_model_t* self,
+    PyObject *pI,
+    PyObject *pO,
+    const bool checkBounds
+)
+{
+    Py_buffer in, out;
+
+    Py_ssize_t nPoints = modena_model_t_get_buffer
+    (
+        pI, &in, self->inputs_internal_size, PyBUF_SIMPLE, "inputs"
+    );
+    if(nPoints < 0)
+    {
+        return NULL;
+    }
+
+    double *o = NULL;
+    if(pO)
+    {
+        Py_ssize_t nOutputs = modena_model_t_get_buffer
+        (
+            pO, &out, self->outputs_size, PyBUF_WRITABLE, "outputs"
+        );
+        if(nOutputs < 0)
+        {
+            PyBuffer_Release(&in);
+            return NULL;
+        }
+        if(nOutputs != nPoints)
+        {
+            PyErr_Format
+            (
+                PyExc_ValueError,
+                "outputs must hold %zd points, not %zd",
+                nPoints,
+                nOutputs
+            );
+            PyBuffer_Release(&in);
+            PyBuffer_Release(&out);
+            return NULL;
+        }
+        o = out.buf;
+    }
+    else
+    {
+        o = malloc(nPoints*self->outputs_size*sizeof(double));
     }
-    free(self->substituteModels);
-
-    free(self->parameters);
-    free(self->inputs_min);
-    free(self->inputs_max);
-
-    free(self->argPos_used);
 
-    if(self->mf)
+    // Substitute models write into the inputs, so work on a copy
+    double *i = in.buf;
+    if(self->substituteModels_size)
     {
-        modena_function_destroy(self->mf);
+        i = malloc(in.len);
+        memcpy(i, in.buf, in.len);
     }
 
-    for(i = 0; i < self->inputs_size; i++)
+    int ret = 0;
+    if(checkBounds)
     {
-        free(self->inputs_names[i]);
+        ret = modena_model_call_batch
+        (
+            self, nPoints, MODENA_ROW_MAJOR, i, o, NULL, NULL
+        );
+    }
+    else
+    {
+        modena_model_call_batch_no_check
+        (
+            self, nPoints, MODENA_ROW_MAJOR, i, o
+        );
     }
-    free(self->inputs_names);
 
-    for(i = 0; i < self->outputs_size; i++)
+    if(i != in.buf)
     {
-        free(self->outputs_names[i]);
+        free(i);
     }
-    free(self->outputs_names);
 
-    for(i = 0; i < self->parameters_size; i++)
+    PyObject *pOutputs = NULL;
+    if(ret)
     {
-        free(self->parameters_names[i]);
+        PyErr_SetString
+        (
+            modena_OutOfBounds,
+            "Surrogate model is used out-of-bounds"
+        );
     }
-    free(self->parameters_names);
+    else if(pO)
+    {
+        Py_INCREF(pO);
+        pOutputs = pO;
+    }
+    else
+    {
+        Py_ssize_t p;
+        size_t j;
 
-    Py_XDECREF(self->pModel);
+        pOutputs = PyList_New(in.ndim == 1 ? self->outputs_size : nPoints);
+        for(p = 0; p < nPoints; p++)
+        {
+            PyObject *pPoint = pOutputs;
+            if(in.ndim == 2)
+            {
+                pPoint = PyList_New(self->outputs_size);
+                PyList_SET_ITEM(pOutputs, p, pPoint);
+            }
+            for(j = 0; j < self->outputs_size; j++)
+            {
+                PyList_SET_ITEM
+                (
+                    pPoint,
+                    j,
+                    PyFloat_FromDouble(o[p*self->outputs_size + j])
+                );
+            }
+        }
+    }
 
-    self->ob_type->tp_free((PyObject*)self);
-}
+    if(pO)
+    {
+        PyBuffer_Release(&out);
+    }
+    else
+    {
+        free(o);
+    }
+    PyBuffer_Release(&in);
 
-/* C-Python: Destructor, exposed as __del__ in Python
- */
-static void modena_model_t_dealloc(modena_model_t* self)
-{
-    modena_model_destroy(self);
+    return pOutputs;
 }
 
-/* C-Python: Member-Table
- *
- * Structure which describes an attribute of a type which corresponds to a C 
- * struct member. Its fields are:
- *
- * Field  C Type       Meaning
- * ------ ----------  --------------------------------------------------------
- * name   char *      name of the member
- * type   int         the type of the member in the C struct
- * offset Py_ssize_t  the offset in bytes that the member is located on the
- *                    type's object struct
- * flags  int         flag bits indicating if the field should be read-only or 
- *                    writable
- * doc    char *      points to the contents of the docstring
- */
-static PyMemberDef modena_model_t_members[] = {
-    {"outputs_size", T_PYSSIZET,
-       offsetof(modena_model_t, outputs_size), READONLY , "number of putputs"},
-    {"inputs_size", T_PYSSIZET,
-      offsetof(modena_model_t, inputs_size), READONLY , "number of inputs"},
-    {"parameters_size", T_PYSSIZET,
-      offsetof(modena_model_t, parameters_size), READONLY , "number of parameters"},
-    {NULL}  /* Sentinel */
-};
-
 /* C-Python: Method exposed in Python as __call__
+ *
+ * The inputs are either given as a list holding a single point or as an
+ * object supporting the buffer protocol (e.g. a numpy array of doubles of
+ * shape (nPoints, inputs_internal_size)). In the latter case the results are
+ * written into the optional argument "outputs" of shape
+ * (nPoints, outputs_size) without creating intermediate Python objects.
  *
  * TODO: The method is also exposed as "call", but this should be deprecated
  */
@@ -756,10 +2479,10 @@ static PyObject *modena_model_t_call
 {
     //Modena_Info_Print("In %s", __func__);
 
-    PyObject *pI=NULL, *pCheckBounds=NULL;
+    PyObject *pI=NULL, *pCheckBounds=NULL, *pO=NULL;
     bool checkBounds = true;
 
-    static char *kwlist[] = { "inputs", "checkBounds", NULL };
+    static char *kwlist[] = { "inputs", "checkBounds", "outputs", NULL };
 
     if
     (
@@ -767,10 +2490,11 @@ static PyObject *modena_model_t_call
         (
             args,
             kwds,
-            "O|O",
+            "O|OO",
             kwlist,
             &pI,
-            &pCheckBounds
+            &pCheckBounds,
+            &pO
         )
     )
     {
@@ -782,6 +2506,16 @@ static PyObject *modena_model_t_call
         checkBounds = PyObject_IsTrue(pCheckBounds);
     }
 
+    if(pO == Py_None)
+    {
+        pO = NULL;
+    }
+
+    if(PyObject_CheckBuffer(pI))
+    {
+        return modena_model_t_call_buffer(self, pI, pO, checkBounds);
+    }
+
     if(!PyList_Check(pI))
     {
         printf("First argument is not a list\n");
@@ -850,6 +2584,232 @@ static PyObject *modena_model_t_call
     return pOutputs;
 }
 
+/* C-Python: Method exposed in Python as jacobian
+ *
+ * Evaluates the derivatives of the outputs with respect to the parameters for
+ * all points stored in an object supporting the buffer protocol, e.g. a numpy
+ * array of shape (nPoints, inputs_internal_size). The results are written
+ * into the optional argument "jacobian" of shape
+ * (nPoints, outputs_size*parameters_size), otherwise they are returned as a
+ * (nested) list. The derivative of output i with respect to parameter j of a
+ * point is stored at i*parameters_size + j.
+ */
+static PyObject *modena_model_t_jacobian
+(
+    modena_model_t* self,
+    PyObject *args,
+    PyObject *kwds
+)
+{
+    PyObject *pI=NULL, *pCheckBounds=NULL, *pJ=NULL;
+    bool checkBounds = true;
+
+    static char *kwlist[] = { "inputs", "checkBounds", "jacobian", NULL };
+
+    if
+    (
+        !PyArg_ParseTupleAndKeywords
+        (
+            args,
+            kwds,
+            "O|OO",
+            kwlist,
+            &pI,
+            &pCheckBounds,
+            &pJ
+        )
+    )
+    {
+        return NULL;
+    }
+
+    if(pCheckBounds)
+    {
+        checkBounds = PyObject_IsTrue(pCheckBounds);
+    }
+
+    if(pJ == Py_None)
+    {
+        pJ = NULL;
+    }
+
+    if(!self->mf->jacobian)
+    {
+        PyErr_SetString
+        (
+            PyExc_NotImplementedError,
+            "Surrogate function has no Jacobian"
+        );
+        return NULL;
+    }
+
+    Py_buffer in, out;
+    const size_t size = self->outputs_size*self->parameters_size;
+
+    Py_ssize_t nPoints = modena_model_t_get_buffer
+    (
+        pI, &in, self->inputs_internal_size, PyBUF_SIMPLE, "inputs"
+    );
+    if(nPoints < 0)
+    {
+        return NULL;
+    }
+
+    double *J = NULL;
+    if(pJ)
+    {
+        Py_ssize_t nJ = modena_model_t_get_buffer
+        (
+            pJ, &out, size, PyBUF_WRITABLE, "jacobian"
+        );
+        if(nJ < 0)
+        {
+            PyBuffer_Release(&in);
+            return NULL;
+        }
+        if(nJ != nPoints)
+        {
+            PyErr_Format
+            (
+                PyExc_ValueError,
+                "jacobian must hold %zd points, not %zd",
+                nPoints,
+                nJ
+            );
+            PyBuffer_Release(&in);
+            PyBuffer_Release(&out);
+            return NULL;
+        }
+        J = out.buf;
+    }
+    else
+    {
+        J = malloc(nPoints*size*sizeof(double));
+    }
+
+    // Substitute models write into the inputs, so work on a copy
+    modena_inputs_t *inputs = modena_inputs_new(self);
+    const double *i = in.buf;
+
+    int ret = 0;
+    Py_ssize_t p;
+    for(p = 0; p < nPoints && !ret; p++)
+    {
+        memcpy
+        (
+            inputs->inputs,
+            &i[p*self->inputs_internal_size],
+            self->inputs_internal_size*sizeof(double)
+        );
+        ret = modena_model_call_jacobian_check
+        (
+            self, inputs, &J[p*size], checkBounds
+        );
+    }
+    modena_inputs_destroy(inputs);
+
+    PyObject *pJacobian = NULL;
+    if(ret)
+    {
+        PyErr_SetString
+        (
+            modena_OutOfBounds,
+            "Surrogate model is used out-of-bounds"
+        );
+    }
+    else if(pJ)
+    {
+        Py_INCREF(pJ);
+        pJacobian = pJ;
+    }
+    else
+    {
+        size_t j;
+
+        pJacobian = PyList_New(in.ndim == 1 ? size : nPoints);
+        for(p = 0; p < nPoints; p++)
+        {
+            PyObject *pPoint = pJacobian;
+            if(in.ndim == 2)
+            {
+                pPoint = PyList_New(size);
+                PyList_SET_ITEM(pJacobian, p, pPoint);
+            }
+            for(j = 0; j < size; j++)
+            {
+                PyList_SET_ITEM
+                (
+                    pPoint,
+                    j,
+                    PyFloat_FromDouble(J[p*size + j])
+                );
+            }
+        }
+    }
+
+    if(pJ)
+    {
+        PyBuffer_Release(&out);
+    }
+    else
+    {
+        free(J);
+    }
+    PyBuffer_Release(&in);
+
+    return pJacobian;
+}
+
+static int
+modena_model_t_set_parameters(modena_model_t *self, PyObject *value, void *closure);
+
+/* C-Python: Method exposed in Python as clone
+ *
+ * Returns a copy of the model sharing everything but the parameters, see
+ * modena_model_clone. The optional argument "parameters" sets the parameters
+ * of the copy.
+ */
+static PyObject *modena_model_t_clone
+(
+    modena_model_t* self,
+    PyObject *args,
+    PyObject *kwds
+)
+{
+    PyObject *pParameters=NULL;
+
+    static char *kwlist[] = { "parameters", NULL };
+
+    if
+    (
+        !PyArg_ParseTupleAndKeywords
+        (
+            args,
+            kwds,
+            "|O",
+            kwlist,
+            &pParameters
+        )
+    )
+    {
+        return NULL;
+    }
+
+    modena_model_t *clone = modena_model_clone(self);
+
+    if
+    (
+        pParameters && pParameters != Py_None
+     && modena_model_t_set_parameters(clone, pParameters, NULL)
+    )
+    {
+        Py_DECREF(clone);
+        return NULL;
+    }
+
+    return (PyObject *) clone;
+}
+
 /* C-Python: Method-Table
  *
  * Structure used to describe a method of an extension type. This structure has
@@ -865,7 +2825,13 @@ static PyObject *modena_model_t_call
  */
 static PyMethodDef modena_model_t_methods[] = {
     {"call", (PyCFunction) modena_model_t_call, METH_KEYWORDS,
-        "Call surrogate model and return outputs"
+        "Call surrogate model and return outputs (list or buffer inputs)"
+    },
+    {"jacobian", (PyCFunction) modena_model_t_jacobian, METH_KEYWORDS,
+        "Derivatives of the outputs with respect to the parameters"
+    },
+    {"clone", (PyCFunction) modena_model_t_clone, METH_KEYWORDS,
+        "Copy of the model with its own parameters"
     },
     {NULL}  /* Sentinel */
 };
@@ -884,42 +2850,64 @@ modena_model_t_get_parameters(modena_model_t *self, void *closure)
     return pParams;
 }
 
+/*
+ */
+PyObject*
+modena_model_t_get_has_jacobian(modena_model_t *self, void *closure)
+{
+    return PyBool_FromLong(modena_model_has_jacobian(self));
+}
+
 /*
  */
 static int
 modena_model_t_set_parameters(modena_model_t *self, PyObject *value, void *closure)
 {
-    // TODO: Error checks for the following cases:
-    //       1. len(value) == self->parameters_size
-    //       2. type(value) == list or tuple
-    //       3. value != NULL
+    if(!value)
+    {
+        PyErr_SetString(PyExc_TypeError, "Cannot delete parameter values");
+        return -1;
+    }
 
-    if(self->parameters_size != PySequence_Size(value))
+    // Accept any sequence, e.g. list, tuple or numpy array
+    PyObject *pSeq = PySequence_Fast(value, "parameters must be a sequence");
+    if(!pSeq)
     {
-        printf
-        (
-            "Wrong number of parameters\n"
-        );
-        exit(1);
+        return -1;
     }
 
-    /*if (value == NULL)
+    size_t i, n = PySequence_Fast_GET_SIZE(pSeq);
+    if(self->parameters_size != n)
     {
-          PyErr_SetString(PyExc_TypeError, "Cannot delete parameter values");
-          return -1;
+        PyErr_Format
+        (
+            PyExc_ValueError,
+            "Wrong number of parameters. Requires %zu -- Given %zu",
+            self->parameters_size,
+            n
+        );
+        Py_DECREF(pSeq);
+        return -1;
     }
-    if (! PyString_Check(value)) {
-          PyErr_SetString(PyErr_TypeError, "First attribute must be a string");
-          return -1;
-    }*/
 
-    size_t i;
-    for(i = 0; i < self->parameters_size; i++)
+    // Convert all values before changing any parameter
+    PyObject **items = PySequence_Fast_ITEMS(pSeq);
+    double *parameters = malloc(n*sizeof(double));
+    for(i = 0; i < n; i++)
     {
-         self->parameters[i] = PyFloat_AsDouble(PyList_GetItem(value, i));
+        parameters[i] = PyFloat_AsDouble(items[i]);
+        if(parameters[i] == -1.0 && PyErr_Occurred())
+        {
+            free(parameters);
+            Py_DECREF(pSeq);
+            return -1;
+        }
     }
+    Py_DECREF(pSeq);
+
+    memcpy(self->parameters, parameters, n*sizeof(double));
+    free(parameters);
 
-    // PyErr_SetString(PyExc_TypeError, "Attribute is read-only!");
     return 0;
 }
 
@@ -931,6 +2919,11 @@ static PyGetSetDef modena_model_t_getset[] = {
       (setter)modena_model_t_set_parameters,
      "parameters",
       NULL},
+    {"has_jacobian",
+      (getter)modena_model_t_get_has_jacobian,
+      NULL,
+     "surrogate function provides derivatives w.r.t. the parameters",
+      NULL},
     {NULL} /* Sentinel */
 };
 
@@ -970,10 +2963,11 @@ static int modena_model_t_init
 
     if(!pModel)
     {
+        // Fetch only what is needed for the evaluation, see loadView
         self->pModel = PyObject_CallMethod
         (
             modena_SurrogateModel,
-            "load",
+            "loadView",
             "(z)",
             modelId
         );
@@ -998,6 +2992,15 @@ static int modena_model_t_init
     //PyObject_Print(self->pModel, stdout, 0);
     //printf("\n");
 
+    // Fetch the argPos index once, subsequent lookups are dictionary accesses
+    PyObject *pIndex = PyObject_CallMethod(self->pModel, "argPosIndex", NULL);
+    if(!pIndex){ Modena_PyErr_Print(); }
+    self->pInputsArgPos = PyDict_GetItemString(pIndex, "inputs");
+    Py_XINCREF(self->pInputsArgPos);
+    self->pOutputsArgPos = PyDict_GetItemString(pIndex, "outputs");
+    Py_XINCREF(self->pOutputsArgPos);
+    Py_DECREF(pIndex);
+
     // Avoiding double indirection in modena_model_call
     // Use modena_function_new to construct, then copy function pointer
     self->mf = modena_function_new_from_model(self);
@@ -1127,6 +3130,15 @@ static PyObject * modena_model_t_new
     {
         // Set everything to zero
         self->pModel = NULL;
+        self->pInputsArgPos = NULL;
+        self->pOutputsArgPos = NULL;
+        self->descriptor = NULL;
+        self->outside_mode = MODENA_OUTSIDE_FAIL_FAST;
+        self->outside_tolerance = 0.0;
+        self->outside_points_size = 0;
+        self->outside_points_capacity = 0;
+        self->outside_points = NULL;
+        self->outside_hash = NULL;
         self->outputs_size = 0;
         self->inputs_size = 0;
         self->inputs_internal_size = 0;
@@ -66,6 +66,39 @@ extern PyObject *modena_SurrogateModel;
 @{
 */
 
+/**
+ * @brief memory layout of the contiguous arrays used for batch evaluation
+*/
+typedef enum modena_layout_t
+{
+    MODENA_ROW_MAJOR,  /**< Point after point: `x[point*size + argPos]` */
+    MODENA_COLUMN_MAJOR /**< Argument after argument: `x[argPos*nPoints + point]` */
+
+} modena_layout_t;
+
+/**
+ * @brief handling of points outside the bounds of a model
+*/
+typedef enum modena_outside_mode_t
+{
+    MODENA_OUTSIDE_FAIL_FAST, /**< Report the first point and return 200 (default) */
+    MODENA_OUTSIDE_COLLECT    /**< Evaluate anyway and collect the points until `modena_model_write_outside_points` */
+
+} modena_outside_mode_t;
+
+/**
+ * @brief maps argument names to positions for models loaded from a descriptor
+*/
+typedef struct modena_argPos_table_t
+{
+    size_t size;
+
+    char **names;
+
+    size_t *argPos;
+
+} modena_argPos_table_t;
+
 /**
  * @brief stores a model and mapping for substitution
 */
@@ -97,6 +130,10 @@ typedef struct modena_model_t
 
     PyObject *pModel;                        /**< Reference to python object.*/
 
+    PyObject *pInputsArgPos;     /**< argPos index of the inputs (dict).    */
+
+    PyObject *pOutputsArgPos;    /**< argPos index of the outputs (dict).   */
+
     size_t outputs_size;                        /**< Length of output vector.*/
 
     size_t inputs_size;                         /**< Length of input vector. */
@@ -130,8 +167,46 @@ typedef struct modena_model_t
     char** outputs_names;               /**< Surrogate model outputs names */
     char** parameters_names;            /**< Surrogate model parameter names */
 
+    char *descriptor;  /**< Descriptor the model was loaded from, NULL otherwise */
+
+    modena_argPos_table_t inputs_argPos_table;  /**< argPos of the inputs (descriptor only) */
+
+    modena_argPos_table_t outputs_argPos_table; /**< argPos of the outputs (descriptor only) */
+
+    modena_outside_mode_t outside_mode;  /**< Handling of points outside the bounds */
+
+    double outside_tolerance;  /**< Relative width of the cells in which collected points are merged */
+
+    size_t outside_points_size;         /**< Number of collected points */
+
+    size_t outside_points_capacity;     /**< Capacity of outside_points */
+
+    double *outside_points;  /**< Collected points, `inputs_internal_size` values each */
+
+    size_t *outside_hash;  /**< Hash table of the cells of the collected points */
+
+    struct modena_model_t *prototype;  /**< Model this one was cloned from, NULL otherwise */
+
 } modena_model_t;
 
+/**
+ * @brief stores the scratch vectors of the substitute models of a model
+ *
+ * A workspace belongs to one thread and allows that thread to evaluate the
+ * model with `modena_model_call_r` concurrently to other threads.
+*/
+typedef struct modena_workspace_t
+{
+    size_t substituteModels_size;
+
+    modena_inputs_t **inputs;     /**< Inputs of the substitute models */
+
+    modena_outputs_t **outputs;   /**< Outputs of the substitute models */
+
+    struct modena_workspace_t **workspaces; /**< Workspaces of the substitute models */
+
+} modena_workspace_t;
+
 /**
  * @brief Function fetching a surrogate model from MongoDB.
  *
@@ -250,6 +325,13 @@ typedef struct modena_model_t
  *   mongo --eval 'db.surrogate_model.find({"_id":"MY_MODEL"}).forEach(printjson)'
  *   ~~~~
  *
+ * #### Descriptors
+ *
+ * If the environment variable `MODENA_DESCRIPTOR_DIR` is set and the file
+ * `$MODENA_DESCRIPTOR_DIR/MY_MODEL.modena` exists, the model is loaded from
+ * that descriptor (see `modena_model_new_from_descriptor`) without starting
+ * the Python interpreter or contacting the database.
+ *
  * ---
  *
  * @param modelId (char) database '_id' if the desired surrogate model.
@@ -260,6 +342,34 @@ modena_model_t *modena_model_new
     const char *modelId
 );
 
+/**
+ * @brief Function loading a surrogate model from a binary descriptor.
+ *
+ * A descriptor is written by `SurrogateModel.exportDescriptor` and contains
+ * everything needed to evaluate the model and its substitute models: the path
+ * of the compiled surrogate function, bounds, parameters, argPos tables and
+ * the substitution maps. Loading it neither requires the Python interpreter
+ * nor a database connection.
+ *
+ * Models loaded from a descriptor are read-only snapshots. When an input is
+ * out of bounds, the point is reported on stderr and the call returns 200, so
+ * that the workflow can extend the model before the descriptor is exported
+ * again.
+ *
+ * ~~~~{.sh}
+ * python -c "from modena import SurrogateModel; \
+ *     SurrogateModel.load('MY_MODEL').exportDescriptor('MY_MODEL.modena')"
+ * ~~~~
+ *
+ * @param filename (char) path of the descriptor.
+ * @return modena_model_t pointer to a surrogate model or NULL on failure, in
+ *         which case the error code is set.
+*/
+modena_model_t *modena_model_new_from_descriptor
+(
+    const char *filename
+);
+
 /**
  * @brief Function determining position of an argument in the input vector.
  *
@@ -403,6 +513,258 @@ void modena_model_call_no_check
     modena_outputs_t *outputs
 );
 
+/**
+ *  @brief Function creating a copy of a surrogate model with its own
+ *         parameter vector.
+ *
+ *  The copy shares the compiled function, the bounds and the substitute
+ *  models with @p model, so that creating it is cheap. Only the parameters
+ *  and the points collected outside the bounds belong to the copy. It is
+ *  meant for evaluating several parameter vectors, e.g. in parallel fits,
+ *  and must be destroyed before @p model. Like @p model, the copy must not
+ *  be called from several threads at once, see modena_model_call_r.
+ *  @param model modena_model_t pointer to a surrogate model.
+ *  @return pointer to the copy
+*/
+modena_model_t *modena_model_clone(const modena_model_t *model);
+
+/**
+ *  @brief Function checking whether the surrogate function provides its
+ *         derivatives with respect to the parameters.
+ *  @param model modena_model_t pointer to a surrogate model.
+ *  @return true if modena_model_call_jacobian may be used
+*/
+bool modena_model_has_jacobian(const modena_model_t *model);
+
+/**
+ *  @brief Function evaluating the derivatives of the outputs of the
+ *         surrogate model with respect to its parameters.
+ *
+ *  The derivatives are computed by the code given in 'Jcode' of the
+ *  CFunction. @p jacobian must hold `outputs_size*parameters_size` values,
+ *  the derivative of output i with respect to parameter j is stored in
+ *  `jacobian[i*parameters_size + j]`. Substitute models are evaluated and
+ *  the bounds are checked as in `modena_model_call`. Calling the function for
+ *  a model without Jacobian is an error.
+ *  @param model modena_model_t pointer to a surrogate model.
+ *  @param inputs modena_inputs_t pointer to the input vector
+ *  @param jacobian pointer to the derivatives
+ *  @return error code as returned by modena_model_call
+*/
+int modena_model_call_jacobian
+(
+    modena_model_t *model,
+    modena_inputs_t *inputs,
+    double *jacobian
+);
+
+/**
+ *  @brief Function calling the surrogate model for a batch of points.
+ *
+ *  The @p nPoints input vectors are stored contiguously in @p inputs, which
+ *  holds `nPoints*inputs_internal_size` values in the memory order given by
+ *  @p layout. Positions are obtained from `modena_model_inputs_argPos` as for
+ *  `modena_model_call`. As in the single point call, values computed by
+ *  substitute models are written back into @p inputs. The results are stored
+ *  in @p outputs, which must hold `nPoints*outputs_size` values in the same
+ *  layout.
+ *
+ *  The bounds of all points are checked in a single pass before the
+ *  surrogate function is evaluated. Points inside the bounds are always
+ *  evaluated. The indices of the points outside the bounds of the model or
+ *  of one of its substitute models are stored in @p outOfBounds (which must
+ *  hold @p nPoints values, or be NULL) and their number in @p nOutOfBounds.
+ *  The first of them is reported to the framework in the same way as
+ *  `modena_model_call` does. In `MODENA_OUTSIDE_COLLECT` mode all points are
+ *  evaluated and the points outside the bounds are collected instead.
+ *
+ * ~~~~{.c}
+ * double *i = malloc(nPoints*modena_model_inputs_size(model)*sizeof(double));
+ * double *o = malloc(nPoints*modena_model_outputs_size(model)*sizeof(double));
+ * size_t *oob = malloc(nPoints*sizeof(size_t));
+ * size_t nOob;
+ *
+ * int ret = modena_model_call_batch
+ * (
+ *     model, nPoints, MODENA_ROW_MAJOR, i, o, oob, &nOob
+ * );
+ * ~~~~
+ *
+ *  @param model modena_model_t pointer to a surrogate model.
+ *  @param nPoints number of points in the batch
+ *  @param layout memory layout of @p inputs and @p outputs
+ *  @param inputs pointer to `nPoints*inputs_internal_size` input values
+ *  @param outputs pointer to `nPoints*outputs_size` output values
+ *  @param outOfBounds indices of the points outside the bounds (may be NULL)
+ *  @param nOutOfBounds number of points outside the bounds (may be NULL)
+ *  @return error code as returned by `modena_model_call`
+*/
+int modena_model_call_batch
+(
+    modena_model_t *model,
+    const size_t nPoints,
+    const modena_layout_t layout,
+    double *inputs,
+    double *outputs,
+    size_t *outOfBounds,
+    size_t *nOutOfBounds
+);
+
+/**
+ *  @brief Function calling the surrogate model for a batch of points w/o
+ *         checking for errors.
+ *  @param model modena_model_t pointer to a surrogate model.
+ *  @param nPoints number of points in the batch
+ *  @param layout memory layout of @p inputs and @p outputs
+ *  @param inputs pointer to `nPoints*inputs_internal_size` input values
+ *  @param outputs pointer to `nPoints*outputs_size` output values
+ *  @return void
+*/
+void modena_model_call_batch_no_check
+(
+    modena_model_t *model,
+    const size_t nPoints,
+    const modena_layout_t layout,
+    double *inputs,
+    double *outputs
+);
+
+/**
+ *  @brief Function setting how points outside the bounds are handled.
+ *
+ *  By default (`MODENA_OUTSIDE_FAIL_FAST`) the first point outside the bounds
+ *  is reported to the framework and the call returns 200, which requests the
+ *  application to exit so that the model can be extended around this point.
+ *
+ *  In `MODENA_OUTSIDE_COLLECT` mode the model is evaluated anyway, i.e. it
+ *  extrapolates, and the point is stored in a buffer. Every component is
+ *  assigned to a cell whose width relative to the value is @p tolerance. A
+ *  point is not stored if all its components fall into the same cells as a
+ *  point already in the buffer, so that clusters of similar points are
+ *  represented by one of them. With a tolerance of zero only identical
+ *  points are merged. At the end of a time step the application calls
+ *  `modena_model_write_outside_points`, which reports all collected points at
+ *  once, so that the model can be extended to cover all of them in a single
+ *  refit.
+ *
+ *  The mode is applied to the substitute models as well.
+ *
+ * ~~~~{.c}
+ * modena_model_set_outside_mode(model, MODENA_OUTSIDE_COLLECT, 1e-3);
+ *
+ * for(i = 0; i < nCells; i++)
+ * {
+ *     modena_model_call(model, inputs, outputs);
+ * }
+ *
+ * if(modena_model_write_outside_points(model)){ exit(modena_error()); }
+ * ~~~~
+ *
+ *  @param model modena_model_t pointer to a surrogate model.
+ *  @param mode handling of points outside the bounds
+ *  @param tolerance relative width of the cells in which points are merged
+ *  @return void
+*/
+void modena_model_set_outside_mode
+(
+    modena_model_t *model,
+    const modena_outside_mode_t mode,
+    const double tolerance
+);
+
+/**
+ *  @brief Function returning the number of collected points outside the
+ *         bounds of the model (excluding its substitute models).
+ *  @param model modena_model_t pointer to a surrogate model.
+ *  @return size_t number of points
+*/
+size_t modena_model_outside_points_size(const modena_model_t *model);
+
+/**
+ *  @brief Function reporting the points collected by the model and its
+ *         substitute models to the framework and clearing the buffers.
+ *  @param model modena_model_t pointer to a surrogate model.
+ *  @return 200 if points were reported, 0 if none were collected
+*/
+int modena_model_write_outside_points(modena_model_t *model);
+
+/**
+ *  @brief Function allocating the scratch vectors needed by one thread to
+ *         call the surrogate model using `modena_model_call_r`.
+ *  @param model modena_model_t pointer to a surrogate model.
+ *  @return modena_workspace_t pointer to the workspace
+*/
+modena_workspace_t *modena_workspace_new(const modena_model_t *model);
+
+/**
+ *  @brief Function deallocating a workspace.
+ *  @param workspace modena_workspace_t pointer to a workspace.
+ *  @return void
+*/
+void modena_workspace_destroy(modena_workspace_t *workspace);
+
+/**
+ *  @brief Re-entrant variant of `modena_model_call`.
+ *
+ *  The model is only read, and the substitute models are evaluated using the
+ *  scratch vectors in @p workspace, so several threads may call the same model
+ *  at the same time as long as every thread uses its own workspace, inputs and
+ *  outputs. The call does not use the Python interpreter.
+ *
+ *  A point outside the bounds is not reported to the framework immediately.
+ *  It is appended to a process wide queue and 200 is returned. The queue must
+ *  be flushed by calling `modena_flush_outside_points` from the thread that
+ *  owns the Python interpreter, e.g. after the parallel region. In
+ *  `MODENA_OUTSIDE_COLLECT` mode the model is evaluated anyway, 0 is returned
+ *  and flushing moves the points into the buffer of the model.
+ *
+ * ~~~~{.c}
+ * #pragma omp parallel
+ * {
+ *     modena_workspace_t *ws = modena_workspace_new(model);
+ *     modena_inputs_t *inputs = modena_inputs_new(model);
+ *     modena_outputs_t *outputs = modena_outputs_new(model);
+ *
+ *     #pragma omp for
+ *     for(i = 0; i < n; i++)
+ *     {
+ *         modena_inputs_set(inputs, T_pos, T[i]);
+ *         modena_model_call_r(model, ws, inputs, outputs);
+ *     }
+ *
+ *     modena_outputs_destroy(outputs);
+ *     modena_inputs_destroy(inputs);
+ *     modena_workspace_destroy(ws);
+ * }
+ *
+ * if(modena_flush_outside_points()){ exit(modena_error()); }
+ * ~~~~
+ *
+ *  @param model modena_model_t pointer to a surrogate model.
+ *  @param workspace modena_workspace_t pointer to the workspace of the thread
+ *  @param inputs modena_inputs_t pointer to the input vector
+ *  @param outputs modena_outputs_t pointer to the output vector
+ *  @return 200 if the point is outside the bounds, 0 otherwise
+*/
+int modena_model_call_r
+(
+    const modena_model_t *model,
+    modena_workspace_t *workspace,
+    modena_inputs_t *inputs,
+    modena_outputs_t *outputs
+);
+
+/**
+ *  @brief Function reporting the points queued by `modena_model_call_r` to
+ *         the framework.
+ *
+ *  Must not be called concurrently to calls into Python.
+ *
+ *  @return error code of the last point reported as by `modena_model_call`,
+ *          0 if the queue was empty
+*/
+int modena_flush_outside_points();
+
 /**
  *  @brief Function deallocating the memory allocated for the surrogate model.
  *  @param model modena_model_t pointer to a surrogate model.